@@ -0,0 +1,131 @@
+#!/bin/env dls-python
+# Regression suite for fault_stats.py
+#
+# The samples of a made up pv are served by the stand-in archiver of
+# read_archivertest.py, and the events, time set and clear and the duration
+# histogram that PvStats makes from them are checked against a simple count
+# over the samples one at a time. The ranges are chosen so that bits are
+# already set at the start and still set at the end, the samples are fed a
+# chunk at a time so events span the chunk boundaries, and durations that
+# are exactly on a histogram bin edge are checked to go in the bin above.
+#
+# Run the tests:
+#   dls-python fault_statstest.py
+import os, sys, bisect, unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, "..", "..", "pmacUtilApp", "src"))
+from read_archivertest import StandInTest, samples, start, pvname, masks
+from read_archiver import to_array
+from fault_stats import *
+
+## Return the rows of PvStats.rows() for some samples, counted one sample
+# and mask at a time
+def reference(samples, masks, t1, t2, edges):
+    out = []
+    for name, mask in masks:
+        events, secs, hist = 0, [0.0, 0.0], [0] * (len(edges) + 1)
+        state = since = None
+        for s, n, v, sevr in samples:
+            t = max(s + n * 1e-9, t1)
+            new = v & mask == mask
+            if state is not None and new != state:
+                secs[state] += t - since
+                if state:
+                    hist[bisect.bisect_right(edges, t - since)] += 1
+                else:
+                    events += 1
+            if state is None or new != state:
+                state, since = new, t
+        secs[state] += max(t2 - since, 0)
+        if state:
+            hist[bisect.bisect_right(edges, max(t2 - since, 0))] += 1
+        out.append((name, events, secs[0], secs[1], hist))
+    return out
+
+## Return the state of each mask in the sample at or before t
+def states_at(samples, t):
+    v = [v for s, n, v, sevr in samples if s + n * 1e-9 <= t][-1]
+    return [v & mask == mask for name, mask in masks]
+
+class PvStatsTest(StandInTest):
+    # Check PvStats rows against the reference, allowing for rounding
+    def assertRows(self, got, expected):
+        self.assertEqual(len(got), len(expected))
+        for g, e in zip(got, expected):
+            self.assertEqual((g[0], g[1], g[4]), (e[0], e[1], e[4]))
+            self.assertAlmostEqual(g[2], e[2], 6)
+            self.assertAlmostEqual(g[3], e[3], 6)
+
+    # Return the rows of the stats of pvname between t1 and t2, fetched in
+    # chunks of chunk seconds
+    def stats(self, t1, t2, chunk, edges=bin_edges):
+        archiver = self.archiver(page=40, chunk=chunk, connections=2)
+        stats = PvStats(pvname, masks, t1, t2, edges)
+        chunks = 0
+        for s in archiver.iter_samples(pvname, t1, t2):
+            stats.add(s)
+            chunks += 1
+        stats.finish()
+        return stats.rows(), chunks
+
+    def testSetAtStartAndEnd(self):
+        t1, t2 = start + 0.5, start + 300.25
+        expected = samples(pvname, int(t1), 0, t2)
+        # some masks must be set at the start and the end for the test to
+        # mean anything, and the time set only counts the part in the range
+        self.failUnless(True in states_at(expected, t1))
+        self.failUnless(True in states_at(expected, t2))
+        rows, chunks = self.stats(t1, t2, 10 ** 6)
+        self.assertEqual(chunks, 1)
+        self.assertRows(rows, reference(expected, masks, t1, t2, bin_edges))
+        for name, events, off, on, hist in rows:
+            self.assertAlmostEqual(off + on, t2 - t1, 6)
+
+    def testChunks(self):
+        t1, t2 = start, start + 600
+        expected = reference(samples(pvname, t1, 0, t2), masks, t1, t2,
+            bin_edges)
+        for chunk in (1, 7, 60, 599):
+            rows, chunks = self.stats(t1, t2, chunk)
+            self.failUnless(chunks > 1)
+            self.assertRows(rows, expected)
+
+    def testBinEdges(self):
+        # the samples are a quarter second apart, so with these edges many
+        # durations are exactly on an edge
+        edges = [0.25, 0.5, 0.75, 1, 2]
+        t1, t2 = start, start + 300
+        rows, chunks = self.stats(t1, t2, 37, edges)
+        self.failUnless([r for r in rows if r[1]])
+        self.assertRows(rows, reference(samples(pvname, t1, 0, t2), masks,
+            t1, t2, edges))
+
+    def testHistogram(self):
+        # bit 1 set for 1, 10, 9.5 and 60 s, then from 300 s to the end at 400 s
+        samples = [(100, 0, 0, 0), (101, 0, 1, 0), (102, 0, 0, 0),
+            (110, 0, 1, 0), (120, 0, 0, 0), (130, 0, 1, 0),
+            (139, 500000000, 0, 0), (140, 0, 1, 0), (200, 0, 0, 0),
+            (300, 0, 1, 0)]
+        stats = PvStats(pvname, [("a", 1)], 100, 400, [1, 10, 60])
+        stats.add(to_array(samples[:5]))
+        stats.add(to_array(samples[5:]))
+        stats.finish()
+        self.assertEqual(stats.rows(), [("a", 5, 119.5, 180.5,
+            [0, 2, 1, 2])])
+
+    def testNoSamples(self):
+        stats = PvStats(pvname, masks, start, start + 10)
+        stats.add(to_array([]))
+        stats.finish()
+        self.assertEqual(stats.samples, 0)
+        self.assertEqual([r[1:] for r in stats.rows()],
+            [(0, 0.0, 0.0, [0] * (len(bin_edges) + 1))] * len(masks))
+
+def suite():
+    return unittest.TestSuite([unittest.makeSuite(test, "test") for test in
+        (PvStatsTest,)])
+
+if __name__ == "__main__":
+    result = unittest.TextTestRunner(verbosity=1).run(suite())
+    sys.exit(not result.wasSuccessful())
@@ -0,0 +1,282 @@
+#!/bin/env dls-python
+# Regression suite for homemanifest.py
+#
+# Small manifests are given to homemanifest as text, and the values and
+# lines that read() finds, the entries that load() returns and the exact
+# errors that it reports for bad manifests are checked. This covers syntax
+# errors, the schema, defaults, the semantic checks between motors and
+# entries, and problems that only motorhome finds when the PLC is made.
+# YAML is only tested if PyYAML is installed.
+#
+# Run the tests:
+#   dls-python homemanifesttest.py
+import os, sys, unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, "..", "..", "pmacUtilApp", "src"))
+from homemanifest import *
+import homemanifest, motorhome, motorhome_batch
+
+## A good manifest, with defaults, a list of axes, a repeated axis and a
+# supervisor
+good = """{
+  "defaults": {"ctype": "GEOBRICK", "post": "i", "timeout": 100000},
+  "plcs": [
+    {"plc": 10, "name": "M1", "motors": [
+      {"axis": [1, 2, 3], "htype": "HSW_DIR"}]},
+    {"plc": 11, "name": "M2", "post": null, "motors": [
+      {"axis": 4, "htype": "HSW", "group": 2, "jdist": -2800},
+      {"axis": 5, "htype": "LIMIT", "group": 3},
+      {"axis": 4, "htype": "NOTHING", "group": 3, "post": 1000}],
+     "groups": {"2": {"checks": [["M345", "=", 1]]}}},
+    {"plc": 12, "name": "ALL", "workers": [
+      {"plc": 13, "motors": [{"axis": [9, 10], "htype": "LIMIT"}]},
+      {"plc": 14, "motors": [{"axis": 11, "htype": "HSW"}]}]}
+  ]
+}
+"""
+
+## A manifest of the YAML in the homemanifest docs
+good_yaml = """defaults:
+  ctype: GEOBRICK
+  post: i
+plcs:
+  - {plc: 10, name: M1, motors: [{axis: [1, 2, 3], htype: HSW_DIR}]}
+  - plc: 11
+    name: M2
+    motors:
+      - {axis: [4, 5, 6], htype: HSW_DIR}
+      - {axis: 7, htype: HSW, jdist: -2800, group: 3,
+         jdist_overrides: [null, 1000, null], post: r100}
+"""
+
+## Tests of read()
+class ReadTest(unittest.TestCase):
+    def assertError(self, filename, text, expected):
+        try:
+            read(filename, text)
+        except ManifestError, e:
+            self.assertEqual(str(e), expected)
+        else:
+            self.fail("No error reading %r" % text)
+
+    def testValues(self):
+        data, lines = read("homing.json", good)
+        self.assertEqual(data["defaults"], dict(ctype="GEOBRICK", post="i",
+            timeout=100000))
+        self.assertEqual(data["plcs"][1]["motors"][0], dict(axis=4,
+            htype="HSW", group=2, jdist=-2800))
+        self.assertEqual(data["plcs"][1]["post"], None)
+        # json gives unicode, motorhome wants str
+        self.assertEqual(type(data["plcs"][0]["name"]), str)
+        self.assertEqual(type(data["plcs"][1]["groups"].keys()[0]), str)
+
+    def testLines(self):
+        data, lines = read("homing.json", good)
+        self.assertEqual(lines[()], 1)
+        self.assertEqual(lines[("defaults", "timeout")], 2)
+        self.assertEqual(lines[("plcs", 0)], 4)
+        self.assertEqual(lines[("plcs", 0, "motors", 0, "axis", 2)], 5)
+        self.assertEqual(lines[("plcs", 1, "motors", 2, "post")], 9)
+        self.assertEqual(lines[("plcs", 1, "groups", "2", "checks", 0, 2)],
+            10)
+        self.assertEqual(lines[("plcs", 2, "workers", 1, "plc")], 13)
+
+    def testSyntax(self):
+        self.assertError("a.json", '[\n{"plc": 1\n"name": "A"}]',
+            "a.json:3: Expecting ',' or '}'")
+        self.assertError("a.json", '[\n{"plc": 1, "plc": 2}]',
+            "a.json:2: Duplicate key 'plc'")
+        self.assertError("a.json", '[\n{plc: 1}]',
+            "a.json:2: Expecting a property name in quotes")
+        self.assertError("a.json", '[1, 2]\n]', "a.json:2: Extra data after "
+            "the end of the manifest")
+        self.assertError("a.json", '[\n"abc', "a.json:2: Unterminated string "
+            "starting at")
+        self.assertError("a.json", '[1,\n]', "a.json:2: Expecting a value")
+
+    def testMissing(self):
+        filename = os.path.join(here, "no_such_manifest.json")
+        self.assertError(filename, None, "%s:0: No such file or directory" %
+            filename)
+
+    def testYaml(self):
+        if homemanifest.yaml is None:
+            self.assertError("homing.yaml", good_yaml, "homing.yaml:0: "
+                "PyYAML is needed to read YAML manifests")
+            return
+        data, lines = read("homing.yaml", good_yaml)
+        self.assertEqual(data["plcs"][1]["motors"][1]["jdist_overrides"],
+            [None, 1000, None])
+        self.assertEqual(lines[("plcs", 1, "motors", 1, "post")], 11)
+        self.assertError("homing.yaml", "plcs:\n  - {plc: 10\n", "homing."
+            "yaml:3: expected ',' or '}', but got '<stream end>'")
+
+## Tests of load()
+class LoadTest(unittest.TestCase):
+    # Check that loading text from homing.json gives the expected errors
+    def assertErrors(self, text, expected, make=True):
+        try:
+            load("homing.json", text, make)
+        except ManifestError, e:
+            self.assertEqual(str(e).split("\n"), expected)
+        else:
+            self.fail("No errors loading %r" % text)
+
+    def testGood(self):
+        entries = load("homing.json", good)
+        self.assertEqual([e["plc"] for e in entries], [10, 11, 12])
+        # defaults are applied unless the entry gives its own
+        self.assertEqual(entries[0]["post"], "i")
+        self.assertEqual(entries[1]["post"], None)
+        self.assertEqual(entries[2]["ctype"], "GEOBRICK")
+        # a list of axes gives one motor per axis
+        self.assertEqual(entries[0]["motors"], [dict(axis=1,
+            htype="HSW_DIR"), dict(axis=2, htype="HSW_DIR"), dict(axis=3,
+            htype="HSW_DIR")])
+        self.assertEqual([m["axis"] for m in entries[2]["workers"][0][
+            "motors"]], [9, 10])
+        plc = motorhome_batch.make_plc(entries[0])
+        self.assertEqual((plc.ctype, plc.timeout), (motorhome.GEOBRICK,
+            100000))
+        self.assertEqual([m.ax for m in plc.motors], [1, 2, 3])
+        self.assertEqual(motorhome_batch.make_plc(entries[2]).__class__,
+            motorhome.Supervisor)
+
+    def testList(self):
+        entries = load("homing.json", '[{"plc": 10, "name": "M1", '
+            '"motors": [{"axis": 1}]}]')
+        self.assertEqual(entries, [dict(plc=10, name="M1",
+            motors=[dict(axis=1)])])
+
+    def testTopLevel(self):
+        self.assertErrors('{"plcs": 3, "other": 1}', [
+            "homing.json:1: other: Unknown key 'other', should be one of "
+                "comment, defaults, plcs",
+            "homing.json:1: plcs: 3 should be a list"])
+        self.assertErrors('"abc"', ["homing.json:1: 'abc' should be a list"])
+
+    def testSchema(self):
+        self.assertErrors("""[
+  {"plc": 40, "name": "M 1", "motors": [
+    {"axis": 40},
+    {"axis": [1, 40]},
+    {"axis": "x", "htype": "HSW_DIRR"},
+    {"group": 2, "speed": 1}],
+   "groups": {"11": {"checks": [["M345", 1.5, 1]]}}},
+  {"name": "M2", "motors": 3}
+]
+""", [
+    "homing.json:2: [0].name: 'M 1' should be a name made of letters, "
+        "numbers, '_', '-' and '.'",
+    "homing.json:2: [0].plc: 40 is not in range 0..31",
+    "homing.json:3: [0].motors[0].axis: 40 is not in range 1..32",
+    "homing.json:4: [0].motors[1].axis[1]: 40 is not in range 1..32",
+    "homing.json:5: [0].motors[2].axis: 'x' should be an integer, or 'x' "
+        "should be a list",
+    "homing.json:5: [0].motors[2].htype: 'HSW_DIRR' is not one of HOME, "
+        "LIMIT, HSW, HSW_HLIM, HSW_DIR, RLIM, NOTHING, HSW_HSTOP",
+    "homing.json:6: [0].motors[3]: 'axis' is required",
+    "homing.json:6: [0].motors[3].speed: Unknown key 'speed', should be one "
+        "of axis, comment, enc_axes, group, htype, jdist, jdist_overrides, "
+        "model, ms, post, search_speed, time",
+    "homing.json:7: [0].groups.11: Group '11' is not in range 1..10",
+    "homing.json:7: [0].groups.11.checks[0][1]: 1.5 should be a string, or "
+        "1.5 should be an integer",
+    "homing.json:8: [1]: 'plc' is required",
+    "homing.json:8: [1].motors: 3 should be a list"])
+
+    def testDefaults(self):
+        # errors in a default are reported on its line, for the defaults and
+        # each entry that takes it, but errors that motorhome finds are
+        # reported on the line of the entry
+        self.assertErrors("""{
+  "defaults": {"htype": "HSW_DIRR",
+    "name": "M1"},
+  "plcs": [{"plc": 10, "name": "M1", "motors": [{"axis": 1}]}]
+}
+""", [
+    "homing.json:2: defaults.htype: 'HSW_DIRR' is not one of HOME, LIMIT, "
+        "HSW, HSW_HLIM, HSW_DIR, RLIM, NOTHING, HSW_HSTOP",
+    "homing.json:2: [0].htype: 'HSW_DIRR' is not one of HOME, LIMIT, HSW, "
+        "HSW_HLIM, HSW_DIR, RLIM, NOTHING, HSW_HSTOP",
+    "homing.json:3: defaults.name: 'name' can't have a default"])
+        self.assertErrors("""{
+  "defaults": {"resume": 1001},
+  "plcs": [
+    {"plc": 9, "name": "M1", "motors": [{"axis": 1}]},
+    {"plc": 10, "name": "M2", "motors": [{"axis": 2}]}]
+}
+""", [
+    "homing.json:5: [1]: Can't make PLC10 M2: Resume P variables "
+        "1001..1002 overlap P1000..1099 of PLC10"])
+
+    def testSemantics(self):
+        self.assertErrors("""[
+  {"plc": 10, "name": "M1", "motors": [
+    {"axis": 1, "group": 1},
+    {"axis": 2, "group": 2},
+    {"axis": 2, "group": 3},
+    {"axis": 1, "htype": "NOTHING", "group": 3}],
+   "groups": {"4": {"pre": "P1=1"}},
+   "collisions": [[1, 5]]},
+  {"plc": 10, "name": "M1", "extra_plcs": [10], "motors": [
+    {"axis": [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17]}]},
+  {"plc": 12, "name": "ALL", "motors": [{"axis": 1}], "workers": [
+    {"plc": 13, "motors": [{"axis": 3}]},
+    {"plc": 14, "motors": [{"axis": [4, 3]}]}]}
+]
+""", [
+    "homing.json:3: [0].motors[0]: Group 1 homes all the other groups, so "
+        "can't be used with groups 2, 3",
+    "homing.json:5: [0].motors[2].axis: Axis 2 is already homed by "
+        "motors[1]",
+    "homing.json:7: [0].groups.4: No motors are in group 4",
+    "homing.json:8: [0].collisions[0]: Axis 5 has no motor in this PLC",
+    "homing.json:9: [1].plc: plc 10 is also used by the entry on line 2",
+    "homing.json:9: [1].name: name M1 is also used by the entry on line 2",
+    "homing.json:9: [1].extra_plcs[0]: plc 10 is also used by the entry on "
+        "line 2",
+    "homing.json:11: [2].motors: A supervisor entry can't have motors as "
+        "well as workers",
+    "homing.json:13: [2].workers[1].motors[0].axis: Axis 3 is already homed "
+        "by workers[0]"])
+
+    def testTooManyMotors(self):
+        self.assertErrors("""[
+  {"plc": 10, "name": "M1", "motors": [
+    {"axis": [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17]}]}
+]
+""", [
+    "homing.json:2: [0].motors: 17 motors, but only 16 may be defined in 1 "
+        "PLCs, add more extra_plcs"])
+
+    def testMake(self):
+        # problems that only motorhome finds are reported with the entry
+        text = """[
+  {"plc": 10, "name": "M1", "resume": 4000, "speed_vars": 3990,
+   "motors": [{"axis": 1}]}
+]
+"""
+        self.assertErrors(text, [
+            "homing.json:2: [0]: Can't make PLC10 M1: Speed P variables "
+                "3990..4005 overlap resume P variables 4000..4001"])
+        self.assertEqual(len(load("homing.json", text, make=False)), 1)
+
+    def testRequire(self):
+        text = '[{"plc": 10, "name": "M1", "motors": [{"axis": 1}]}]'
+        self.assertRaises(ManifestError, load, "homing.json", text,
+            require=["controller"])
+        try:
+            load("homing.json", text, require=["controller"])
+        except ManifestError, e:
+            self.assertEqual(e.errors, [("homing.json", 1,
+                "[0]: 'controller' is required")])
+
+def suite():
+    return unittest.TestSuite([unittest.makeSuite(test, "test") for test in
+        (ReadTest, LoadTest)])
+
+if __name__ == "__main__":
+    result = unittest.TextTestRunner(verbosity=1).run(suite())
+    sys.exit(not result.wasSuccessful())
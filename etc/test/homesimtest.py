@@ -0,0 +1,125 @@
+#!/bin/env dls-python
+# Golden output regression suite for homesim.py
+#
+# Each single PLC configuration made by motorhometest.py is simulated by
+# homesim against a machine laid out for the htype of each motor, and the
+# final status, time taken, the state sequence and the home position of
+# each axis is compared with a stored .txt file in the homesim directory next
+# to this script. This catches changes to the homing sequence generated by
+# motorhome as well as to the simulator. SplitPLC and Supervisor cases are
+# not simulated.
+#
+# Every axis starts at 20000 counts with a -ve hdir. The home flag is active
+# between 0 and 5000, limits and hard stops are at +/-50000. Note that
+# HSW_HSTOP with a +ve jdist times out: the pre-home move jogs onto the hard
+# stop then tries to carry on past it, so needs a -ve prehome jdist override.
+#
+# Run the tests:
+#   dls-python homesimtest.py
+# Store the current output as the golden files after a deliberate change:
+#   dls-python homesimtest.py --update
+import os, sys, unittest, difflib
+from optparse import OptionParser
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, "..", "..", "pmacUtilApp", "src"))
+from motorhome import *
+from homesim import simulate
+import motorhometest
+
+golden_dir = os.path.join(here, "homesim")
+
+# Machine.setup_axis() arguments for each htype
+layouts = {
+    HOME: dict(flag=(0, 5000)),
+    LIMIT: dict(lim=(-50000, 50000), flag_select=2),
+    HSW: dict(flag=(0, 5000), lim=(-50000, 50000)),
+    HSW_HLIM: dict(flag=(0, 5000), lim=(-50000, 50000)),
+    HSW_DIR: dict(flag=(None, 5000), lim=(-50000, 50000)),
+    RLIM: dict(lim=(-50000, 50000), flag_select=2, capture=10,
+        home_speed=20),
+    NOTHING: dict(),
+    HSW_HSTOP: dict(flag=(0, 5000), stops=(-50000, 50000))}
+
+## Return a list of (name, function that makes a PLC) for the cases that make
+# a single PLC
+def cases():
+    return [(name, make) for name, make in motorhometest.cases()
+        if isinstance(make(), PLC)]
+
+## Simulate a PLC and return a report of the result
+def report(make):
+    plc = make()
+    # lay out each axis for the htype it is first homed with
+    layout, htypes = {}, {}
+    for g, group in sorted(plc.groups.items()):
+        for m, htype, post in group.actions:
+            if m.ax not in layout:
+                layout[m.ax] = dict(layouts[htype], pos=20000)
+                htypes[m.ax] = htype
+    result = simulate(plc, layout)
+    out = ["status %s, state %s, %s in %.1f ms" % (result.status,
+        result.state, result.finished and "finished" or "stuck", result.time)]
+    for t, group, state in result.phases():
+        out.append("%10.1f ms  group %-2d %s" % (t, group, state))
+    for ax in sorted(layout):
+        out.append("axis %-2d %-9s home %-9s position %s" % (ax,
+            htypes_str[htypes[ax]], result.homes[ax], result.positions[ax]))
+    return "\n".join(out) + "\n"
+
+## A test case that simulates one PLC and compares it with its golden file
+class GoldenTest(unittest.TestCase):
+    def __init__(self, name, make):
+        unittest.TestCase.__init__(self)
+        self.name = name
+        self.make = make
+
+    def id(self):
+        return "homesimtest." + self.name
+
+    def shortDescription(self):
+        return self.name
+
+    def runTest(self):
+        golden = os.path.join(golden_dir, self.name + ".txt")
+        self.failUnless(os.path.exists(golden),
+            "%s doesn't exist, run with --update to make it" % golden)
+        expected = open(golden).read()
+        text = report(self.make)
+        if text != expected:
+            diff = difflib.unified_diff(expected.splitlines(True),
+                text.splitlines(True), golden, "simulated")
+            self.fail("Output differs from %s:\n%s" % (golden,
+                "".join(list(diff)[:40])))
+
+## Make a suite with a GoldenTest for each case
+def suite():
+    s = unittest.TestSuite()
+    for name, make in cases():
+        s.addTest(GoldenTest(name, make))
+    return s
+
+## Write the golden files from the current homesim, removing old ones
+def update():
+    if not os.path.isdir(golden_dir):
+        os.makedirs(golden_dir)
+    names = []
+    for name, make in cases():
+        open(os.path.join(golden_dir, name + ".txt"), "w").write(report(make))
+        names.append(name + ".txt")
+    for f in os.listdir(golden_dir):
+        if f.endswith(".txt") and f not in names:
+            os.remove(os.path.join(golden_dir, f))
+    print "Wrote %d golden files to %s" % (len(names), golden_dir)
+
+if __name__ == "__main__":
+    parser = OptionParser("usage: %prog [options]\n"
+        "Compare simulated homing with the golden files")
+    parser.add_option("-u", "--update", action="store_true", default=False,
+        help="Write the golden files instead of testing")
+    options, args = parser.parse_args()
+    if options.update:
+        update()
+        sys.exit(0)
+    result = unittest.TextTestRunner(verbosity=1).run(suite())
+    sys.exit(not result.wasSuccessful())
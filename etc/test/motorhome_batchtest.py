@@ -0,0 +1,97 @@
+#!/bin/env dls-python
+# Regression suite for motorhome_batch.py
+#
+# The PLCs of a small manifest are written into a temporary directory, once
+# to make them and again to check that the cache leaves them untouched, and
+# with one controller directory missing to check that the PLC that can't be
+# written is reported as an error after the others are written, both with
+# and without a pool of processes.
+#
+# Run the tests:
+#   dls-python motorhome_batchtest.py
+import os, sys, shutil, tempfile, unittest
+from cStringIO import StringIO
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, "..", "..", "pmacUtilApp", "src"))
+from motorhome_batch import *
+from homemanifest import load
+
+manifest = """[
+  {"controller": "BL01", "plc": 10, "name": "S1", "ctype": "GEOBRICK",
+   "motors": [{"axis": 1, "htype": "HSW"}, {"axis": 2, "htype": "LIMIT"}]},
+  {"controller": "BL01", "plc": 11, "name": "S2",
+   "motors": [{"axis": 3, "htype": "HOME", "group": 2}]},
+  {"controller": "BL02", "plc": 10, "name": "S1",
+   "motors": [{"axis": 1, "htype": "RLIM"}]}
+]
+"""
+
+class WriteAllTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = os.path.join(self.root, "cache")
+        self.entries = load("homing.json", manifest)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    # Make the PLCs directory of some controllers
+    def controllers(self, *names):
+        for name in names:
+            os.makedirs(os.path.join(self.root, name, "PLCs"))
+
+    # Return the filenames written relative to root
+    def relative(self, filenames):
+        return [f[len(self.root) + 1:] for f in filenames]
+
+    # Run write_all, returning (exit code or None, filenames, stderr)
+    def write_all(self, processes):
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            try:
+                written = write_all(self.entries, self.root, self.cache,
+                    processes)
+                return None, self.relative(written), sys.stderr.getvalue()
+            except SystemExit, e:
+                return e.code, None, sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+
+    def testWrite(self):
+        self.controllers("BL01", "BL02")
+        for processes in (1, 2):
+            expected = ["BL01/PLCs/PLC10_S1_HM.pmc",
+                "BL01/PLCs/PLC11_S2_HM.pmc", "BL02/PLCs/PLC10_S1_HM.pmc"]
+            self.assertEqual(self.write_all(processes), (None, expected, ""))
+            text = open(os.path.join(self.root, expected[0])).read()
+            self.assertEqual(text, make_plc(self.entries[0]).render())
+            # nothing changed, so nothing is written again
+            self.assertEqual(self.write_all(processes), (None, [], ""))
+            shutil.rmtree(self.cache)
+            for f in expected:
+                os.remove(os.path.join(self.root, f))
+
+    def testErrors(self):
+        # BL02 has no PLCs directory
+        self.controllers("BL01")
+        missing = os.path.join(self.root, "BL02", "PLCs",
+            "PLC10_S1_HM.pmc")
+        for processes in (1, 2):
+            self.assertEqual(self.write_all(processes), (1, None,
+                "***Error: %s: No such file or directory\n" % missing))
+            # the others are still written
+            for name in ("PLC10_S1_HM.pmc", "PLC11_S2_HM.pmc"):
+                f = os.path.join(self.root, "BL01", "PLCs", name)
+                self.failUnless(os.path.exists(f))
+                os.remove(f)
+            shutil.rmtree(self.cache)
+
+def suite():
+    return unittest.TestSuite([unittest.makeSuite(test, "test") for test in
+        (WriteAllTest,)])
+
+if __name__ == "__main__":
+    result = unittest.TextTestRunner(verbosity=1).run(suite())
+    sys.exit(not result.wasSuccessful())
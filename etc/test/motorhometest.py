@@ -0,0 +1,298 @@
+#!/bin/env dls-python
+# Golden output regression and benchmark suite for motorhome.py
+#
+# A matrix of PLC configurations is rendered and each one is compared byte for
+# byte with a stored .pmc file in the motorhome directory next to this script:
+# every htype on PMAC and GEOBRICK, 1 to 16 motors, multiple groups with
+# checks and pre/post code, jdist_overrides, every post mode and the other
+# PLC and motor options, resume mode, two speed search, 32 motors split
+# between PLCs by SplitPLC, and a Supervisor homing several PLCs in parallel.
+# Options that would make the PLC overwrite its own P variables are checked
+# to be rejected.
+# Any change to the generated text fails the suite, so the generator can be
+# refactored for speed safely.
+#
+# Run the tests:
+#   dls-python motorhometest.py
+# Time generation throughput as well:
+#   dls-python motorhometest.py --bench
+# Store the current output as the golden files after a deliberate change:
+#   dls-python motorhometest.py --update
+import os, sys, time, unittest, difflib
+from optparse import OptionParser
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, "..", "..", "pmacUtilApp", "src"))
+from motorhome import *
+
+golden_dir = os.path.join(here, "motorhome")
+
+htypes = [("HOME", HOME), ("LIMIT", LIMIT), ("HSW", HSW),
+    ("HSW_HLIM", HSW_HLIM), ("HSW_DIR", HSW_DIR), ("RLIM", RLIM),
+    ("NOTHING", NOTHING), ("HSW_HSTOP", HSW_HSTOP)]
+ctypes = [("PMAC", PMAC), ("GEOBRICK", GEOBRICK)]
+posts = [("none", None), ("i", "i"), ("l", "l"), ("h", "h"), ("H", "H"),
+    ("L", "L"), ("z", "z100"), ("r", "r-250"), ("pos", 2000), ("neg", -2000)]
+overrides = [("search", (None, 1000, None)), ("all", (10, -20, 30)),
+    ("prehome", (-500, None, None))]
+
+# Return a function that makes a PLC from a list of (axis, add_motor kwargs)
+# and a dict of {group: configure_group kwargs}, or a SplitPLC if given a
+# list of plc numbers
+def plc(motors, groups={}, plcs=None, **kwargs):
+    def make():
+        if plcs:
+            p = SplitPLC(plcs, **kwargs)
+        else:
+            p = PLC(11, **kwargs)
+        for axis, args in motors:
+            p.add_motor(axis, **args)
+        for group, args in sorted(groups.items()):
+            p.configure_group(group, **args)
+        return p
+    return make
+
+# Return a function that makes a Supervisor from a list of functions that
+# make its workers
+def supervisor(workers, ctype):
+    def make():
+        s = Supervisor(20, ctype=ctype)
+        for make_worker in workers:
+            s.add_plc(make_worker())
+        return s
+    return make
+
+## Return a list of (name, function that makes a PLC) for the whole matrix
+def cases():
+    out = []
+    for cname, ctype in ctypes:
+        # every htype on its own
+        for hname, htype in htypes:
+            out.append(("htype_%s_%s" % (hname, cname), plc(
+                [(1, dict(htype=htype, jdist=500))], ctype=ctype)))
+        # every post mode
+        for pname, post in posts:
+            out.append(("post_%s_%s" % (pname, cname), plc(
+                [(2, dict(htype=HSW, jdist=-1000, post=post))], ctype=ctype)))
+        # 1 to 16 motors, cycling through the htypes, in one group
+        for n in range(1, 17):
+            out.append(("motors_%02d_%s" % (n, cname), plc([(axis, dict(
+                htype=htypes[(axis - 1) % len(htypes)][1], jdist=axis * 100))
+                for axis in range(1, n + 1)], ctype=ctype)))
+        # 16 motors in 4 groups with different posts
+        out.append(("groups_16_%s" % cname, plc([(axis, dict(
+            group=2 + (axis - 1) % 4, htype=htypes[(axis - 1) / 2][1],
+            jdist=-axis * 10, post=posts[(axis + 1) % len(posts)][1]))
+            for axis in range(1, 17)], ctype=ctype, post="i")))
+        # groups with checks and pre/post code
+        out.append(("groups_configured_%s" % cname, plc([
+            (1, dict(group=2, htype=LIMIT, jdist=200)),
+            (2, dict(group=2, htype=HSW, jdist=300, post="i")),
+            (3, dict(group=3, htype=HSW_HLIM, jdist=400, post="l")),
+            (4, dict(group=3, htype=HSW_DIR, jdist=700)),
+            (5, dict(group=5, htype=RLIM, post=150)),
+            (6, dict(group=10, htype=HSW_HSTOP, jdist=600))], {
+            2: dict(checks=[("m131&m232", "0", 5)], pre="P100=1",
+                post="P100=0"),
+            3: dict(checks=[("m331", "0", 5), ("m431", "0", 6)]),
+            5: dict(pre="CMD\"#5J/\"")}, ctype=ctype, timeout=120000)))
+        # jdist_overrides on every htype
+        for oname, override in overrides:
+            out.append(("overrides_%s_%s" % (oname, cname), plc([(axis + 1, dict(
+                htype=htype, jdist=100, jdist_overrides=override))
+                for axis, (hname, htype) in enumerate(htypes)
+                if htype != NOTHING], ctype=ctype)))
+        # PLC defaults, encoder axes, macrostation override, no debug,
+        # NOTHING used to do a post move on an axis homed earlier
+        out.append(("options_%s" % cname, plc([
+            (1, dict(group=2, enc_axes=[17])),
+            (2, dict(group=2, htype=HSW_DIR, ms=4, post="z0")),
+            (9, dict(group=3, enc_axes=[25, 26])),
+            (1, dict(group=3, htype=NOTHING, post="h"))],
+            ctype=ctype, htype=HSW, jdist=-1000, post="i", timeout=30000,
+            allow_debug=False)))
+        # 32 motors split between 3 PLCs, balanced by predicted time
+        out.append(("split_32_%s" % cname, plc([(axis, dict(
+            group=2 + (axis - 1) / 8, htype=htypes[axis % 6 + 1][1],
+            post=posts[axis % 3][1])) for axis in range(1, 33)],
+            {2: dict(checks=[("m131", "0", 5)], pre="P4000=1",
+            post="P4000=0")}, plcs=[11, 12, 13],
+            times=dict((axis, axis * 1000) for axis in range(1, 33)),
+            ctype=ctype, htype=HSW, allow_debug=cname == "PMAC")))
+        # resume mode, skipping groups and motors already homed
+        out.append(("resume_%s" % cname, plc([
+            (1, dict(group=2, post="i", enc_axes=[17])),
+            (2, dict(group=2, htype=LIMIT, post="z0")),
+            (3, dict(group=3, htype=HSW_HSTOP)),
+            (1, dict(group=3, htype=NOTHING, post="h"))],
+            ctype=ctype, htype=HSW, resume=4000)))
+        # two speed search, with a default speed and per motor speeds
+        out.append(("search_speed_%s" % cname, plc([
+            (1, dict(htype=LIMIT)), (2, dict(htype=HSW, search_speed=100)),
+            (3, dict(htype=HSW_HLIM, post="i")), (4, dict(htype=RLIM)),
+            (5, dict(htype=HOME))], ctype=ctype, search_speed=50.5,
+            speed_vars=4100)))
+        # a supervisor homing a PLC with groups, a PLC with only group 1 and
+        # a SplitPLC in parallel
+        out.append(("supervisor_%s" % cname, supervisor([
+            plc([(1, dict(group=2, htype=LIMIT)), (2, dict(group=3))],
+                {3: dict(pre="P100=1")}, ctype=ctype, htype=HSW),
+            plc([(5, dict(htype=RLIM, post="i"))], ctype=ctype),
+            plc([(axis, dict(group=2 + axis % 2, htype=HSW_DIR))
+                for axis in range(9, 29)], plcs=[12, 13], ctype=ctype)],
+            ctype)))
+    return out
+
+## A test case that renders one PLC and compares it with its golden file
+class GoldenTest(unittest.TestCase):
+    def __init__(self, name, make):
+        unittest.TestCase.__init__(self)
+        self.name = name
+        self.make = make
+
+    def id(self):
+        return "motorhometest." + self.name
+
+    def shortDescription(self):
+        return self.name
+
+    def runTest(self):
+        golden = os.path.join(golden_dir, self.name + ".pmc")
+        self.failUnless(os.path.exists(golden),
+            "%s doesn't exist, run with --update to make it" % golden)
+        expected = open(golden).read()
+        text = self.make().render()
+        if text != expected:
+            diff = difflib.unified_diff(expected.splitlines(True),
+                text.splitlines(True), golden, "rendered")
+            self.fail("Output differs from %s:\n%s" % (golden,
+                "".join(list(diff)[:40])))
+
+## Tests that PLC options which would clash are rejected
+class OptionTest(unittest.TestCase):
+    def testResumeInBlock(self):
+        # P1000..1099 belong to PLC10, P1001 is its HomingStatus
+        for resume in (999, 1000, 1001, 1098, 1099):
+            self.assertRaises(AssertionError, PLC, 10, resume=resume)
+        for resume in (998, 1100):
+            self.assertEqual(PLC(10, resume=resume).resume, resume)
+
+    def testSpeedVarsRange(self):
+        for speed_vars in (-1, 8177):
+            self.assertRaises(AssertionError, PLC, 10, speed_vars=speed_vars)
+        self.assertEqual(PLC(10, speed_vars=8176).speed_vars, 8176)
+
+    def testSpeedVarsInBlock(self):
+        for speed_vars in (985, 1000, 1050, 1099):
+            self.assertRaises(AssertionError, PLC, 10, speed_vars=speed_vars)
+        for speed_vars in (984, 1100):
+            self.assertEqual(PLC(10, speed_vars=speed_vars).speed_vars,
+                speed_vars)
+
+    def testSpeedVarsOverlapResume(self):
+        for resume in (3999, 4000, 4015):
+            self.assertRaises(AssertionError, PLC, 10, resume=resume,
+                speed_vars=4000)
+        for resume in (3998, 4016):
+            p = PLC(10, resume=resume, speed_vars=4000)
+            self.assertEqual((p.resume, p.speed_vars), (resume, 4000))
+
+## Tests of the checks and options of a Supervisor
+class SupervisorTest(unittest.TestCase):
+    def worker(self, plc, axis):
+        p = PLC(plc)
+        p.add_motor(axis)
+        return p
+
+    def testWorkerLimit(self):
+        # the started flags of the workers are P2004..2019, P2020 counts them
+        s = Supervisor(20)
+        for i in range(16):
+            s.add_plc(self.worker(21 + i, i + 1))
+        self.assertRaises(AssertionError, s.add_plc, self.worker(10, 17))
+
+    def testAllowDebug(self):
+        for allow_debug in (True, False):
+            s = Supervisor(20, allow_debug=allow_debug)
+            s.add_plc(self.worker(21, 1))
+            text = s.render().split("DISABLE PLC20")[0]
+            self.assertEqual("DebugHoming)" in text, allow_debug)
+
+    def testSplitOnce(self):
+        class CountingSplitPLC(SplitPLC):
+            splits = 0
+            def split(self):
+                CountingSplitPLC.splits += 1
+                return SplitPLC.split(self)
+        s = Supervisor(20)
+        for i in range(3):
+            p = CountingSplitPLC([21 + 2 * i, 22 + 2 * i])
+            for axis in range(1, 21):
+                p.add_motor(axis + 20 * i)
+            s.add_plc(p)
+        s.render()
+        s.render()
+        self.assertEqual(CountingSplitPLC.splits, 3)
+
+## Make a suite with a GoldenTest for each case, and the option tests
+def suite():
+    s = unittest.TestSuite()
+    for name, make in cases():
+        s.addTest(GoldenTest(name, make))
+    for test in (OptionTest, SupervisorTest):
+        s.addTest(unittest.makeSuite(test, "test"))
+    return s
+
+## Write the golden files from the current motorhome, removing old ones
+def update():
+    if not os.path.isdir(golden_dir):
+        os.makedirs(golden_dir)
+    names = []
+    for name, make in cases():
+        make().write(os.path.join(golden_dir, name + ".pmc"))
+        names.append(name + ".pmc")
+    for f in os.listdir(golden_dir):
+        if f.endswith(".pmc") and f not in names:
+            os.remove(os.path.join(golden_dir, f))
+    print "Wrote %d golden files to %s" % (len(names), golden_dir)
+
+## Time making and rendering the whole matrix
+def bench(seconds=2.0):
+    all_cases = cases()
+    # warm up, then repeat the matrix until enough time has passed
+    for name, make in all_cases:
+        make().render()
+    plcs = chars = 0
+    start = time.time()
+    timings = dict((name, 0.0) for name, make in all_cases)
+    while time.time() - start < seconds:
+        for name, make in all_cases:
+            t = time.time()
+            chars += len(make().render())
+            timings[name] += time.time() - t
+            plcs += 1
+    elapsed = time.time() - start
+    print "Rendered %d PLCs (%.1f MB) in %.2f s: %.1f PLCs/s, %.2f MB/s" % (
+        plcs, chars / 1e6, elapsed, plcs / elapsed, chars / 1e6 / elapsed)
+    print "Slowest cases (ms per PLC):"
+    rounds = plcs / len(all_cases)
+    for name, t in sorted(timings.items(), key=lambda x: -x[1])[:5]:
+        print "  %-28s %8.2f" % (name, t * 1000 / rounds)
+
+if __name__ == "__main__":
+    parser = OptionParser("usage: %prog [options]\n"
+        "Compare motorhome output with the golden files")
+    parser.add_option("-u", "--update", action="store_true", default=False,
+        help="Write the golden files instead of testing")
+    parser.add_option("-b", "--bench", action="store_true", default=False,
+        help="Time generation throughput after the tests")
+    parser.add_option("-t", "--time", type="float", default=2.0,
+        help="Seconds to run the benchmark for, default %default")
+    options, args = parser.parse_args()
+    if options.update:
+        update()
+        sys.exit(0)
+    result = unittest.TextTestRunner(verbosity=1).run(suite())
+    if options.bench:
+        bench(options.time)
+    sys.exit(not result.wasSuccessful())
@@ -0,0 +1,87 @@
+#!/bin/env dls-python
+# Golden output regression suite for plcsize.py
+#
+# Each golden homing PLC made by motorhometest.py is analysed and its report,
+# with the breakdown of statements, words and scan cost for each group and
+# homing state, is compared with a stored .txt file in the plcsize directory
+# next to this script. This catches lines being charged to the wrong group
+# or state as well as changes to the estimates.
+#
+# Run the tests:
+#   dls-python plcsizetest.py
+# Store the current output as the golden files after a deliberate change:
+#   dls-python plcsizetest.py --update
+import os, sys, unittest, difflib
+from optparse import OptionParser
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, "..", "..", "pmacUtilApp", "src"))
+from plcsize import analyse
+
+pmc_dir = os.path.join(here, "motorhome")
+golden_dir = os.path.join(here, "plcsize")
+
+## Return a sorted list of the names of the homing PLCs to analyse
+def cases():
+    return sorted([f[:-4] for f in os.listdir(pmc_dir) if f.endswith(".pmc")])
+
+## Return the reports of all the PLCs in a golden homing PLC file
+def report(name):
+    text = open(os.path.join(pmc_dir, name + ".pmc")).read()
+    return "\n".join([str(r) for r in analyse(text, name + ".pmc")]) + "\n"
+
+## A test case that analyses one PLC and compares it with its golden file
+class GoldenTest(unittest.TestCase):
+    def __init__(self, name):
+        unittest.TestCase.__init__(self)
+        self.name = name
+
+    def id(self):
+        return "plcsizetest." + self.name
+
+    def shortDescription(self):
+        return self.name
+
+    def runTest(self):
+        golden = os.path.join(golden_dir, self.name + ".txt")
+        self.failUnless(os.path.exists(golden),
+            "%s doesn't exist, run with --update to make it" % golden)
+        expected = open(golden).read()
+        text = report(self.name)
+        if text != expected:
+            diff = difflib.unified_diff(expected.splitlines(True),
+                text.splitlines(True), golden, "analysed")
+            self.fail("Output differs from %s:\n%s" % (golden,
+                "".join(list(diff)[:40])))
+
+## Make a suite with a GoldenTest for each case
+def suite():
+    s = unittest.TestSuite()
+    for name in cases():
+        s.addTest(GoldenTest(name))
+    return s
+
+## Write the golden files from the current plcsize, removing old ones
+def update():
+    if not os.path.isdir(golden_dir):
+        os.makedirs(golden_dir)
+    names = []
+    for name in cases():
+        open(os.path.join(golden_dir, name + ".txt"), "w").write(report(name))
+        names.append(name + ".txt")
+    for f in os.listdir(golden_dir):
+        if f.endswith(".txt") and f not in names:
+            os.remove(os.path.join(golden_dir, f))
+    print "Wrote %d golden files to %s" % (len(names), golden_dir)
+
+if __name__ == "__main__":
+    parser = OptionParser("usage: %prog [options]\n"
+        "Compare plcsize reports with the golden files")
+    parser.add_option("-u", "--update", action="store_true", default=False,
+        help="Write the golden files instead of testing")
+    options, args = parser.parse_args()
+    if options.update:
+        update()
+        sys.exit(0)
+    result = unittest.TextTestRunner(verbosity=1).run(suite())
+    sys.exit(not result.wasSuccessful())
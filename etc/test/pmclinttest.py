@@ -0,0 +1,79 @@
+#!/bin/env dls-python
+# Regression suite for pmclint.py
+#
+# The made up controller download in the pmc directory next to this script
+# has a conflict of each kind injected into it, and the findings of the
+# linter are checked exactly. The P variable conflicts are found by
+# pmcparse.write_conflicts(), which is shared with pmcmap.py, so that is
+# checked here too.
+#
+# Run the tests:
+#   dls-python pmclinttest.py
+import os, sys, unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, "..", "..", "pmacUtilApp", "src"))
+from pmclint import *
+from pmcparse import write_conflicts
+
+pmc_dir = os.path.join(here, "pmc")
+
+## Return the findings of a list of files in the pmc directory, without the
+# directory
+def findings(names, **kwargs):
+    out = lint([os.path.join(pmc_dir, name) for name in names], **kwargs)
+    return [str(f).replace(pmc_dir + os.sep, "") for f in out]
+
+class WriteConflictsTest(unittest.TestCase):
+    def testWrites(self):
+        writes = {10: ["PLC2", "PLC1"], 11: ["PLC1", "PLC2", "PROG3"],
+            12: ["PLC1"], 20: ["PLC1", "PLC2"]}
+        self.assertEqual(write_conflicts(writes), [
+            ("PLC1", "PLC2", [10, 11, 20], False),
+            ("PLC1", "PROG3", [11], False),
+            ("PLC2", "PROG3", [11], False)])
+        self.assertEqual(write_conflicts(writes, shared=[11, 20]), [
+            ("PLC1", "PLC2", [10], False)])
+
+    def testHoming(self):
+        # PLC11 may write its own block, the handshake is shared
+        writes = {1101: ["PLC11", "PLC12"], 1120: ["PLC12"],
+            1150: ["PLC11", "PROG5"], 1210: ["PLC12"]}
+        self.assertEqual(write_conflicts(writes, [11], [1101]), [
+            ("PLC11", "PROG5", [1150], False),
+            ("PLC12", "PLC11", [1120], True),
+            ("PROG5", "PLC11", [1150], True)])
+
+class LintTest(unittest.TestCase):
+    def testConflicts(self):
+        self.assertEqual(findings(["Master.pmc"]), [
+            "PLC12_START.pmc:7: pvars: PLC12 writes P1120, in the block of "
+                "homing PLC11 at PLC11_HM.pmc:3",
+            "PLC13_14.pmc:3: pvars: PLC13 writes P4001, also written by "
+                "PLC14 at PLC13_14.pmc:10",
+            "PLC13_14.pmc:16: pvars: PROG5 writes P1150, in the block of "
+                "homing PLC11 at PLC11_HM.pmc:3"])
+
+    def testDisable(self):
+        self.assertEqual(findings(["Master.pmc"], checks=["blocks", "lines",
+            "mvars", "include"]), [])
+
+    def testSeparateControllers(self):
+        # each file given is a separate download, so only the conflict
+        # inside PLC13_14.pmc is found
+        self.assertEqual(findings(["PLC11_HM.pmc", "PLC12_START.pmc",
+            "PLC13_14.pmc"]), [
+            "PLC13_14.pmc:3: pvars: PLC13 writes P4001, also written by "
+                "PLC14 at PLC13_14.pmc:10"])
+
+    def testNoFollow(self):
+        # without the includes the Master.pmc is fine on its own
+        self.assertEqual(findings(["Master.pmc"], follow=False), [])
+
+def suite():
+    return unittest.TestSuite([unittest.makeSuite(test, "test") for test in
+        (WriteConflictsTest, LintTest)])
+
+if __name__ == "__main__":
+    result = unittest.TextTestRunner(verbosity=1).run(suite())
+    sys.exit(not result.wasSuccessful())
@@ -0,0 +1,80 @@
+#!/bin/env dls-python
+# Regression suite for pmcmap.py
+#
+# The made up controller download in the pmc directory next to this script
+# has a conflict of each kind injected into it, and the conflicts and uses
+# that the map finds are checked exactly, with and without the cache.
+#
+# Run the tests:
+#   dls-python pmcmaptest.py
+import os, sys, shutil, tempfile, unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, "..", "..", "pmacUtilApp", "src"))
+from pmcmap import *
+
+pmc_dir = os.path.join(here, "pmc")
+master = os.path.join(pmc_dir, "Master.pmc")
+
+## The conflicts in Master.pmc
+expected = [
+    "PLC12_START.pmc:7: PLC12 writes P1120 in the block of homing PLC11 at "
+        "PLC11_HM.pmc:3",
+    "PLC12_START.pmc:9: PLC12 writes I130, also written by PLC13 at "
+        "PLC13_14.pmc:4",
+    "PLC13_14.pmc:3: PLC13 writes P4001, also written by PLC14 at "
+        "PLC13_14.pmc:10",
+    "PLC13_14.pmc:16: PROG5 writes P1150 in the block of homing PLC11 at "
+        "PLC11_HM.pmc:3",
+    "PLC13_14.pmc:20: M100 redefined as Y:$78000,0,1, was X:$78000,0,1 at "
+        "PLC13_14.pmc:1"]
+
+## Return the conflicts of a map, without the directory
+def conflicts(m):
+    return [str(c).replace(pmc_dir + os.sep, "") for c in m.conflicts()]
+
+class MapTest(unittest.TestCase):
+    def testConflicts(self):
+        m = build_map(master)
+        self.assertEqual(len(m.files), 5)
+        self.assertEqual(conflicts(m), expected)
+
+    def testHandshake(self):
+        # PLC11 and PLC12 both write the handshake, which isn't a conflict
+        m = build_map(master)
+        self.assertEqual(m.handshake, set([1100, 1101, 1102, 1103]))
+        self.assertEqual(sorted([u.owner for u in m.find("P", 1101)
+            if u.access == "write"]), ["PLC11", "PLC12"])
+
+    def testFind(self):
+        m = build_map(master)
+        self.assertEqual([(u.name(), u.owner, u.access) for u in
+            m.find("P", 1120)], [("P1100..1199", "PLC11", "claim"),
+            ("P1120", "PLC12", "write"), ("P1120", None, "write")])
+
+    def testOwners(self):
+        owners = build_map(master).owners()
+        self.assertEqual(owners["PLC11"]["claim"], {"P": [(1100, 1199)]})
+        self.assertEqual(owners["PLC13"]["write"], {"I": [(130, 130)],
+            "P": [(4000, 4001)]})
+        self.assertEqual(owners[None]["write"], {"I": [(130, 130)],
+            "P": [(1120, 1120), (4000, 4000)]})
+
+    def testCache(self):
+        cache = tempfile.mkdtemp()
+        try:
+            m = build_map(master, cache)
+            self.assertEqual(m.parsed, 5)
+            m = build_map(master, cache)
+            self.assertEqual(m.parsed, 0)
+            self.assertEqual(conflicts(m), expected)
+        finally:
+            shutil.rmtree(cache)
+
+def suite():
+    return unittest.TestSuite([unittest.makeSuite(test, "test") for test in
+        (MapTest,)])
+
+if __name__ == "__main__":
+    result = unittest.TextTestRunner(verbosity=1).run(suite())
+    sys.exit(not result.wasSuccessful())
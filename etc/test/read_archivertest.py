@@ -0,0 +1,523 @@
+#!/bin/env dls-python
+# Regression suite for read_archiver.py
+#
+# An archiver data server is stood in for by a SimpleXMLRPCServer in this
+# process that serves archiver.values() from a made up pv with 4 samples a
+# second, several in each second, some missing, and bits that change every
+# few samples. It can fail requests with a 503 to test the retries, and can
+# hide the samples after a time to test --follow.
+#
+# The tests check paging to the nanosecond, merging chunks and removing
+# duplicates, concurrent fetches, the transitions of several masks, the
+# cache covering part of a query, carrying the state of the masks across
+# chunks, TransitionIndex.window_join(), retries, resuming from a checkpoint,
+# FollowState, and that paging, chunks, the cache and --follow together give
+# the same transitions as a single unpaged fetch. main() is run for every
+# --format, with and without --window; hdf5 is skipped if h5py is missing.
+#
+# Run the tests:
+#   dls-python read_archivertest.py
+import os, sys, time, shutil, tempfile, threading, unittest, zlib
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+from SocketServer import ThreadingMixIn
+from xmlrpclib import ProtocolError
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, "..", "..", "pmacUtilApp", "src"))
+import numpy
+from read_archiver import *
+
+## Start of the samples used by the tests, not on a chunk boundary
+start = 1300000017
+## Masks checked by the tests, overlapping so they change together
+masks = [("a", 0x1), ("b", 0x2), ("ab", 0x3), ("c", 0x4), ("d", 0x8)]
+pvname = "TEST-MO-STEP-01:AXIS1:status3"
+other_pvname = "TEST-MO-STEP-01:AXIS2:status3"
+
+# Nanoseconds between the samples
+_tick = 250000000
+
+## Return True if there is a sample at quarter second t
+def present(t):
+    return t % 11 != 5
+
+## Return the value of a pv at quarter second t, which changes every 3
+# samples at most
+def value(name, t):
+    return (((t / 3) * 2654435761 + zlib.crc32(name)) >> 13) & 0xF
+
+## Return the (secs, nano, value, severity) of the samples of a pv from the
+# one at or before secs, nano to the one at or before end, like the archiver
+def samples(name, secs, nano, end, count=None):
+    t = secs * 4 + nano / _tick
+    while not present(t):
+        t -= 1
+    out = []
+    while t <= end * 4 and (count is None or len(out) < count):
+        if present(t):
+            out.append((t / 4, (t % 4) * _tick, value(name, t), t % 3 == 0))
+        t += 1
+    return out
+
+# Fail requests with a 503 when the server says so
+class _Handler(SimpleXMLRPCRequestHandler):
+    def do_POST(self):
+        if self.server.fail():
+            self.send_error(503)
+            return
+        SimpleXMLRPCRequestHandler.do_POST(self)
+
+    def log_message(self, *args):
+        pass
+
+## A stand-in for the archiver data server, running in a thread
+class StandIn(ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+    def __init__(self):
+        SimpleXMLRPCServer.__init__(self, ("127.0.0.1", 0), _Handler,
+            logRequests=False)
+        self.register_function(self.values, "archiver.values")
+        self.url = "http://127.0.0.1:%d/" % self.server_address[1]
+        self.lock = threading.Lock()
+        ## Number of requests made
+        self.requests = 0
+        ## Number of the next requests to fail
+        self.fail_next = 0
+        ## Fail all requests after this many, or None
+        self.fail_after = None
+        ## Time of the last sample that has been archived, or None for all
+        self.horizon = None
+        thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+
+    ## Return True if this request should fail
+    def fail(self):
+        self.lock.acquire()
+        try:
+            self.requests += 1
+            if self.fail_next:
+                self.fail_next -= 1
+                return True
+            return self.fail_after is not None and \
+                self.requests > self.fail_after
+        finally:
+            self.lock.release()
+
+    ## archiver.values(), giving the raw samples of one pv
+    def values(self, key, names, secs, nano, end, end_nano, count, how):
+        if self.horizon is not None:
+            secs, nano = min((secs, nano), (self.horizon, 0))
+            end = min(end, self.horizon)
+        return [dict(name=name, meta={}, type=1, count=1, values=[
+            dict(secs=s, nano=n, value=[v], sevr=int(sevr), stat=0)
+            for s, n, v, sevr in samples(name, secs, nano, end, count)])
+            for name in names]
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+## Return the transitions of some masks in a list of samples, one sample and
+# mask at a time, in the form given by iter_transitions()
+def reference(name, samples, masks):
+    out = []
+    last = {}
+    for count, (secs, nano, v, sevr) in enumerate(samples):
+        for mask_name, mask in masks:
+            state = v & mask == mask
+            if last.get(mask_name) != state:
+                out.append((secs, nano, name, mask_name, state, sevr,
+                    count + 1))
+                last[mask_name] = state
+    return out
+
+## Base class that starts a stand-in server and makes a cache directory
+class StandInTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandIn()
+        self.directory = tempfile.mkdtemp()
+        self.archivers = []
+
+    def tearDown(self):
+        for archiver in self.archivers:
+            archiver.close()
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    ## Return an Archiver for the server that doesn't wait between retries
+    def archiver(self, **kwargs):
+        kwargs.setdefault("backoff", 0)
+        archiver = Archiver(self.server.url, **kwargs)
+        self.archivers.append(archiver)
+        return archiver
+
+    ## Return a Cache in the cache directory
+    def cache(self):
+        return Cache(self.directory, self.server.url)
+
+    ## Return the samples of a pv from a single unpaged fetch
+    def unpaged(self, name, t1, t2):
+        return self.archiver(page=10 ** 6, chunk=10 ** 9,
+            connections=1).fetch_many([(name, t1, t2)])[name]
+
+    ## Check two lists of records or samples are the same. This only shows
+    # the first difference, as a diff of the whole lists takes too long
+    def assertRecords(self, got, expected):
+        for i, (g, e) in enumerate(zip(got, expected)):
+            if g != e:
+                self.fail("Item %d is %r, expected %r" % (i, g, e))
+        self.assertEqual(len(got), len(expected), "Got %d items, expected "
+            "%d" % (len(got), len(expected)))
+
+    def assertSamples(self, got, expected):
+        self.assertRecords(to_array(got).T.tolist(),
+            to_array(expected).T.tolist())
+
+class FetchTest(StandInTest):
+    def testStandIn(self):
+        got = self.unpaged(pvname, start, start + 60)
+        self.assertSamples(got, samples(pvname, start, 0, start + 60))
+        # the sample before the start gives the value at the start
+        self.failUnless(got[0, 0] <= start)
+
+    def testPaging(self):
+        # 4 samples a second, so pages start part way through a second
+        for page in (2, 3, 7, 100):
+            archiver = self.archiver(page=page, connections=1)
+            got = archiver.fetch(pvname, start, start + 120)
+            self.assertSamples(got, self.unpaged(pvname, start, start + 120))
+            self.failUnless(archiver.calls >= len(got) / page)
+
+    def testChunks(self):
+        expected = self.unpaged(pvname, start, start + 600)
+        for chunk in (1, 37, 60, 599):
+            archiver = self.archiver(page=50, chunk=chunk, connections=1)
+            got = archiver.fetch_many([(pvname, start, start + 600)])
+            self.assertSamples(got[pvname], expected)
+
+    def testDuplicates(self):
+        # overlapping queries of the same pv are fetched once and merged
+        archiver = self.archiver(page=50, chunk=60, connections=1)
+        got = archiver.fetch_many([(pvname, start, start + 300),
+            (pvname, start + 100, start + 400), (pvname, start + 50,
+            start + 60)])
+        self.assertSamples(got[pvname], self.unpaged(pvname, start,
+            start + 400))
+        self.assertSamples(merge_samples([got[pvname], got[pvname][:, ::2]]),
+            got[pvname])
+
+    def testConcurrent(self):
+        queries = [(pvname, start, start + 600),
+            (other_pvname, start + 30, start + 500)]
+        serial = self.archiver(page=40, chunk=45, connections=1)
+        concurrent = self.archiver(page=40, chunk=45, connections=6)
+        expected = serial.fetch_many(queries)
+        got = concurrent.fetch_many(queries)
+        self.assertEqual(sorted(got), sorted(expected))
+        for name, t1, t2 in queries:
+            self.assertSamples(got[name], expected[name])
+            self.assertSamples(got[name], self.unpaged(name, t1, t2))
+
+    def testIterSamples(self):
+        archiver = self.archiver(page=30, chunk=41, connections=3)
+        got = merge_samples(list(archiver.iter_samples(pvname, start,
+            start + 500)))
+        self.assertSamples(got, select(self.unpaged(pvname, start,
+            start + 500), start, start + 500))
+
+class CacheTest(StandInTest):
+    def testPartial(self):
+        expected = self.unpaged(pvname, start - 100, start + 600)
+        full = self.archiver(page=20, chunk=3600, connections=1)
+        full.fetch_many([(pvname, start - 100, start + 600)])
+        # cache the middle, then fetch either side of it
+        self.archiver(page=20, chunk=3600, connections=1,
+            cache=self.cache()).fetch_many([(pvname, start, start + 300)])
+        chunk = (start - 100) - (start - 100) % 3600
+        self.assertEqual(self.cache().coverage(pvname), {chunk:
+            (start, start + 300)})
+        archiver = self.archiver(page=20, chunk=3600, connections=1,
+            cache=self.cache())
+        got = archiver.fetch_many([(pvname, start - 100, start + 600)])
+        self.assertSamples(got[pvname], expected)
+        self.failUnless(archiver.calls < full.calls)
+        self.assertEqual(self.cache().coverage(pvname), {chunk:
+            (start - 100, start + 600)})
+        # and all from the cache the next time
+        archiver = self.archiver(page=20, chunk=3600, connections=1,
+            cache=self.cache())
+        got = archiver.fetch_many([(pvname, start - 50, start + 500)])
+        self.assertSamples(got[pvname], expected)
+        self.assertEqual(archiver.calls, 0)
+
+    def testPartialChunks(self):
+        expected = self.unpaged(pvname, start, start + 600)
+        self.archiver(page=20, chunk=120, connections=4,
+            cache=self.cache()).fetch_many([(pvname, start + 90,
+            start + 310)])
+        got = self.archiver(page=20, chunk=120, connections=4,
+            cache=self.cache()).fetch_many([(pvname, start, start + 600)])
+        self.assertSamples(got[pvname], expected)
+
+    def testLoadReplaced(self):
+        cache = self.cache()
+        cache.store(pvname, 0, to_array(samples(pvname, 10, 0, 20)), 10, 20)
+        cache.store(pvname, 0, to_array(samples(pvname, 5, 0, 30)), 5, 30)
+        self.assertEqual(cache.coverage(pvname), {0: (5, 30)})
+        # a reader that saw the old file gets the one that replaced it
+        self.assertSamples(cache.load(pvname, 0, (10, 20)), samples(pvname,
+            5, 0, 30))
+
+class TransitionsTest(StandInTest):
+    def testMasks(self):
+        got = self.unpaged(pvname, start, start + 600)
+        expected = reference(pvname, to_array(got).T.tolist(), masks)
+        self.assertRecords(mask_transitions(got, masks), [(count, secs, name,
+            value, sevr) for secs, nano, pv, name, value, sevr, count in
+            expected])
+        for name, mask in masks:
+            self.assertRecords(transitions(got, mask), [(count, secs, value,
+                sevr) for secs, nano, pv, n, value, sevr, count in expected
+                if n == name])
+
+    def testChunks(self):
+        # the state of the masks is carried from one chunk to the next
+        expected = reference(pvname, select(self.unpaged(pvname, start,
+            start + 600), start, start + 600).T.tolist(), masks)
+        for chunk, page in ((37, 13), (60, 1000), (600, 7)):
+            archiver = self.archiver(page=page, chunk=chunk, connections=4)
+            self.assertRecords(list(iter_transitions(archiver, pvname, masks,
+                start, start + 600)), expected)
+
+    def testWindowJoin(self):
+        archiver = self.archiver(page=100, chunk=60)
+        records = list(merge(*[iter_transitions(archiver, name, masks,
+            start, start + 300) for name in (pvname, other_pvname)]))
+        index = TransitionIndex(records)
+        kept = [r for r in records if r[6] > 1]
+        self.assertEqual(len(index), len(kept))
+        triggers = index.onsets(["c", "d"])
+        self.failUnless(triggers)
+        for dt in (0, 0.25, 1.6):
+            expected = []
+            for i in triggers:
+                trigger = index.records[i]
+                t = trigger[0] + trigger[1] * 1e-9
+                related = []
+                for r in kept:
+                    offset = r[0] + r[1] * 1e-9 - t
+                    if abs(offset) <= dt and r is not trigger:
+                        related.append((offset, r))
+                related.sort(key=lambda (offset, r): offset)
+                expected.append((trigger, related))
+            got = index.window_join(triggers, dt)
+            self.assertRecords([(trigger, [r for o, r in related])
+                for trigger, related in got], [(trigger, [r for o, r in
+                related]) for trigger, related in expected])
+            for (trigger, related), (t, e) in zip(got, expected):
+                self.assertEqual([round(o, 6) for o, r in related],
+                    [round(o, 6) for o, r in e])
+
+class RetryTest(StandInTest):
+    def testRetry(self):
+        self.server.fail_next = 3
+        archiver = self.archiver(page=50, connections=1, retries=3)
+        got = archiver.fetch(pvname, start, start + 60)
+        self.assertSamples(got, self.unpaged(pvname, start, start + 60))
+        self.assertEqual(archiver.retried, 3)
+
+    def testGiveUp(self):
+        self.server.fail_next = 2
+        archiver = self.archiver(page=50, connections=1, retries=1)
+        self.assertRaises(ProtocolError, archiver.fetch, pvname, start,
+            start + 60)
+
+    def testCheckpoint(self):
+        expected = self.unpaged(pvname, start, start + 600)
+        full = self.archiver(page=20, chunk=3600, connections=1)
+        full.fetch_many([(pvname, start, start + 600)])
+        # the fetch dies part way through, after storing what it had
+        self.server.requests = 0
+        self.server.fail_after = 40
+        archiver = self.archiver(page=20, chunk=3600, connections=1,
+            cache=self.cache(), retries=0, checkpoint=0)
+        self.assertRaises(ProtocolError, archiver.fetch_many, [(pvname,
+            start, start + 600)])
+        covered = self.cache().coverage(pvname).values()
+        self.assertEqual(len(covered), 1)
+        self.failUnless(start < covered[0][1] < start + 600)
+        # and the next one carries on from there
+        self.server.fail_after = None
+        archiver = self.archiver(page=20, chunk=3600, connections=1,
+            cache=self.cache())
+        got = archiver.fetch_many([(pvname, start, start + 600)])
+        self.assertSamples(got[pvname], expected)
+        self.failUnless(archiver.calls < full.calls - 30)
+
+class FollowTest(StandInTest):
+    def testState(self):
+        filename = os.path.join(self.directory, "state.json")
+        state = FollowState(filename)
+        self.assertEqual(state.last, {})
+        state.last[pvname] = (start, _tick, 5)
+        state.save()
+        self.assertEqual(FollowState(filename).last, {pvname:
+            (start, _tick, 5)})
+        self.failIf([f for f in os.listdir(self.directory) if f !=
+            "state.json"])
+
+    def testFollow(self):
+        queries = [(pvname, masks[:3], start, start + 300),
+            (pvname, masks[3:], start + 20, start + 200),
+            (other_pvname, masks, start, start + 250)]
+        state = FollowState(os.path.join(self.directory, "state.json"))
+        got = []
+        archiver = self.archiver(page=50, chunk=60)
+        # the archiver has stored the samples up to horizon, which follows
+        # on from when the queries start
+        for horizon in range(start + 20, start + 350, 17):
+            self.server.horizon = horizon
+            got += follow_transitions(archiver, queries, state)
+        # nothing new
+        self.assertEqual(follow_transitions(archiver, queries, state), [])
+        expected = []
+        for name, m, t1, t2 in queries:
+            expected += [r[:6] for r in reference(name, select(
+                self.unpaged(name, t1, t2), t1, t2).T.tolist(), m)]
+        # the counts start again at each poll
+        self.assertRecords(sorted([r[:6] for r in got]), sorted(expected))
+
+    def testLaterStart(self):
+        # a query that starts after the last sample read of its pv by another
+        # query starts at its own start
+        queries = [(pvname, masks, start, start + 60)]
+        state = FollowState(os.path.join(self.directory, "state.json"))
+        state.last[pvname] = (start - 100, 0, 0)
+        got = follow_transitions(self.archiver(), queries, state)
+        self.assertRecords(got, sorted(reference(pvname, select(self.unpaged(
+            pvname, start, start + 60), start, start + 60).T.tolist(),
+            masks)))
+
+class ConsistencyTest(StandInTest):
+    ## Paged, chunked, cached and followed transitions are the same as the
+    # ones from a single unpaged fetch
+    def testAll(self):
+        queries = [(pvname, masks, start, start + 600),
+            (other_pvname, masks[1:4], start + 45, start + 500)]
+        expected = []
+        for name, m, t1, t2 in queries:
+            expected += [r[:6] for r in reference(name, select(
+                self.unpaged(name, t1, t2), t1, t2).T.tolist(), m)]
+        expected.sort()
+        # cache part of what has been archived by the first poll
+        self.archiver(page=9, chunk=53, connections=3,
+            cache=self.cache()).fetch_many([(pvname, start + 200,
+            start + 320)])
+        state = FollowState(os.path.join(self.directory, "state.json"))
+        cache = self.cache()
+        archiver = self.archiver(page=9, chunk=53, connections=3,
+            cache=cache)
+        got = []
+        for horizon in range(start + 330, start + 650, 37):
+            # the cache doesn't mark times that aren't archived yet
+            self.server.horizon = horizon
+            cache.settle = time.time() - horizon
+            got += follow_transitions(archiver, queries, state)
+            state.save()
+            state = FollowState(state.filename)
+        self.assertRecords(sorted([r[:6] for r in got]), expected)
+        # and the cached samples give the same again
+        archiver = self.archiver(page=9, chunk=53, connections=3,
+            cache=self.cache())
+        got = merge(*[iter_transitions(archiver, name, m, t1, t2)
+            for name, m, t1, t2 in queries])
+        self.assertRecords(sorted([r[:6] for r in got]), expected)
+        self.assertEqual(archiver.calls, 0)
+
+class MainTest(StandInTest):
+    ## Run main() with some arguments, and return the name of the output
+    def main(self, format, *args):
+        output = os.path.join(self.directory, "out." + format)
+        t1 = start - start % 60 + 60
+        argv = sys.argv
+        sys.argv = ["read_archiver.py", "-u", self.server.url, "-n", "-p",
+            "30", "-c", "0.02", "-F", format, "-o", output] + list(args) + [
+            pvname, "following_error,in_position", time.strftime(
+            time_format, time.localtime(t1)), time.strftime(time_format,
+            time.localtime(t1 + 300)), other_pvname, "all", time.strftime(
+            time_format, time.localtime(t1 + 60)), time.strftime(time_format,
+            time.localtime(t1 + 240))]
+        try:
+            main()
+        finally:
+            sys.argv = argv
+        return output
+
+    ## Return the records main() should find
+    def records(self):
+        t1 = start - start % 60 + 60
+        archiver = self.archiver()
+        return list(merge(iter_transitions(archiver, pvname, parse_masks(
+            "following_error,in_position", pvname), t1, t1 + 300),
+            iter_transitions(archiver, other_pvname, parse_masks("all",
+            other_pvname), t1 + 60, t1 + 240)))
+
+    ## Write records with a writer class, and return the name of the file
+    def write(self, writer, records, window=None):
+        output = os.path.join(self.directory, "expected")
+        writer = writer(open(output, writer.binary and "wb" or "w"), True,
+            window=window is not None)
+        if window is None:
+            for record in records:
+                writer.write(record)
+        else:
+            index = TransitionIndex(records)
+            for n, (trigger, related) in enumerate(index.window_join(
+                    index.onsets(["following_error"]), window)):
+                writer.write_window(n + 1, trigger, related)
+        writer.close()
+        writer.f.close()
+        return output
+
+    def testFormats(self):
+        records = self.records()
+        self.failUnless(len(records) > 100)
+        for format, writer in sorted(writers.items()):
+            if writer is Hdf5Writer and h5py is None:
+                continue
+            output = self.main(format)
+            expected = self.write(writer, records)
+            if writer is Hdf5Writer:
+                got = h5py.File(output, "r")["transitions"][:]
+                self.assertEqual(got.tolist(), h5py.File(expected, "r")[
+                    "transitions"][:].tolist())
+            else:
+                self.assertEqual(open(output, "rb").read(),
+                    open(expected, "rb").read())
+        got = numpy.load(self.main("npy"))
+        self.assertEqual(got.tolist(), numpy.array([tuple(r) for r in
+            records], record_dtype).tolist())
+        # window isn't taken as the number of records to buffer
+        f = open(os.path.join(self.directory, "block.npy"), "wb")
+        self.assertEqual(NpyWriter(f, True, window=False).block, 10000)
+        f.close()
+
+    def testWindow(self):
+        records = self.records()
+        for format, writer in sorted(writers.items()):
+            if not writer.binary:
+                output = self.main(format, "-w", "1.5")
+                self.assertEqual(open(output).read(), open(self.write(writer,
+                    records, 1.5)).read())
+
+## Make a suite of all the tests
+def suite():
+    return unittest.TestSuite([unittest.makeSuite(test, "test") for test in
+        (FetchTest, CacheTest, TransitionsTest, RetryTest, FollowTest,
+        ConsistencyTest, MainTest)])
+
+if __name__ == "__main__":
+    result = unittest.TextTestRunner(verbosity=1).run(suite())
+    sys.exit(not result.wasSuccessful())
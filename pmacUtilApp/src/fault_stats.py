@@ -0,0 +1,308 @@
+#!/usr/bin/env dls-python
+## \namespace fault_stats
+# fault_stats.py makes fault statistics for many axes from the status bits
+# in the archiver, using \ref read_archiver to fetch them. It is intended to
+# find the axes that go into following error or hit limits most often
+# across all the beamlines.
+#
+# It takes a list of $(pmac):AXIS<N>:status1, $(pmac):AXIS<N>:status3 and
+# $(pmac):PLCDISBITS00 pvs and a date range. For each named mask of each pv
+# (or the ones given with --masks) it counts:
+# - events, the number of times the bits were set
+# - the time spent with the bits set and clear
+# - a histogram of how long the bits stayed set each time
+#
+# The pvs are shared out between a pool of processes, one per CPU core by
+# default, and each one streams the samples of its pvs a chunk at a time
+# (see read_archiver.Archiver.iter_samples()), so memory use doesn't grow
+# with the date range. The processes share the read_archiver cache. Times
+# when the bits were already set at the start, or still set at the end, only
+# count the part inside the range.
+#
+# Example invocation:
+# \verbatim
+#   dls-python fault_stats.py -f axes.txt -m following_error,neg_limit,pos_limit 2015-01-01@00:00 2015-04-01@00:00
+# \endverbatim
+# prints a table of the axes in axes.txt, with the ones that had the most
+# following errors and limit hits first.
+
+import os, sys, time, csv, json, socket
+import multiprocessing
+from optparse import OptionParser
+import numpy
+import read_archiver
+from xmlrpclib import Error
+from read_archiver import Archiver, Cache, parse_masks, parse_time, \
+    mask_states
+
+## Default upper edges in seconds of the duration histogram bins
+bin_edges = [1, 10, 60, 600, 3600, 86400]
+
+## Return the axis of a pv, e.g. BL02I-MO-STEP-05:AXIS1 for
+# BL02I-MO-STEP-05:AXIS1:status3, or the controller for a PLCDISBITS pv
+def axis_name(pvname):
+    return pvname.rsplit(":", 1)[0]
+
+## Turn some seconds into a short string like 1s, 10m or 2d
+def duration(secs):
+    for unit, size in (("d", 86400), ("h", 3600), ("m", 60)):
+        if secs >= size and secs % size == 0:
+            return "%d%s" % (secs / size, unit)
+    return "%gs" % secs
+
+## Return the labels of the histogram bins for some edges
+def bin_labels(edges):
+    return ["<" + duration(e) for e in edges] + [">=" + duration(edges[-1])]
+
+## Statistics of the masks of one pv, built up from its samples a chunk at
+# a time with add()
+class PvStats:
+    ## \param masks List of (name, mask)
+    # \param start, end Times to count between
+    # \param edges Upper edges of the duration histogram bins, in seconds
+    def __init__(self, pvname, masks, start, end, edges=bin_edges):
+        self.pvname = pvname
+        self.masks = masks
+        self.start = start
+        self.end = end
+        self.edges = numpy.array(edges, dtype=float)
+        ## Number of samples
+        self.samples = 0
+        ## Number of times each mask was set
+        self.events = numpy.zeros(len(masks), dtype=int)
+        ## Seconds each mask spent clear and set
+        self.time = numpy.zeros((len(masks), 2))
+        ## Number of times each mask was set for each bin of durations
+        self.hist = numpy.zeros((len(masks), len(edges) + 1), dtype=int)
+        # state of each mask, and the time it changed to it
+        self.state = None
+        self.since = None
+
+    # Add some durations in seconds that the masks in states were in
+    def __add_durations(self, j, durations, states):
+        self.time[j, 1] += durations[states].sum()
+        self.time[j, 0] += durations[~states].sum()
+        self.hist[j] += numpy.bincount(numpy.searchsorted(self.edges,
+            durations[states], side="right"), minlength=len(self.hist[j]))
+
+    ## Add the next samples in time order, see read_archiver.to_array()
+    def add(self, samples):
+        if not samples.shape[1]:
+            return
+        self.samples += samples.shape[1]
+        # the sample before start gives the state at start
+        times = numpy.maximum(samples[0] + samples[1] * 1e-9, self.start)
+        states = mask_states(samples[2], self.masks)
+        if self.state is None:
+            self.state = states[0].copy()
+            self.since = numpy.repeat(times[0], len(self.masks))
+        for j in range(len(self.masks)):
+            s = numpy.concatenate(([self.state[j]], states[:, j]))
+            changed = numpy.nonzero(s[1:] != s[:-1])[0]
+            if not len(changed):
+                continue
+            # s[changed] is the state before each change
+            before = s[changed]
+            self.events[j] += (~before).sum()
+            edges = numpy.concatenate(([self.since[j]], times[changed]))
+            self.__add_durations(j, edges[1:] - edges[:-1], before)
+            self.since[j] = times[changed[-1]]
+            self.state[j] = s[-1]
+
+    ## Count the time from the last change of each mask to the end of the
+    # range, or now if that is sooner
+    def finish(self):
+        if self.state is None:
+            return
+        end = min(self.end, time.time())
+        for j in range(len(self.masks)):
+            durations = numpy.array([max(end - self.since[j], 0)])
+            self.__add_durations(j, durations, self.state[j:j + 1])
+        self.state = None
+
+    ## Return a list of (name, events, secs clear, secs set, histogram)
+    def rows(self):
+        return [(name, int(self.events[j]), float(self.time[j, 0]),
+            float(self.time[j, 1]), [int(n) for n in self.hist[j]])
+            for j, (name, mask) in enumerate(self.masks)]
+
+# The Archiver of a worker process
+_archiver = None
+
+# Make the Archiver of a worker process
+def _init_worker(url, key, page, chunk, connections, cache):
+    global _archiver
+    if cache is not None:
+        cache = Cache(cache, url, key)
+    _archiver = Archiver(url, key, page, chunk, connections, cache)
+
+# Worker for the process pool, return (pvname, rows or None, error or None)
+# for a (pvname, masks, start, end, edges)
+def _pv_stats(args):
+    pvname, masks, start, end, edges = args
+    stats = PvStats(pvname, masks, start, end, edges)
+    try:
+        for samples in _archiver.iter_samples(pvname, start, end):
+            stats.add(samples)
+    except (Error, socket.error), e:
+        return pvname, None, str(e)
+    stats.finish()
+    if not stats.samples:
+        return pvname, None, "no data available"
+    return pvname, stats.rows(), None
+
+## Make the statistics of some pvs in parallel
+# \param queries List of (pvname, masks, start, end)
+# \param processes Number of worker processes
+# \param archiver_args Tuple of (url, key, page, chunk, connections, cache
+# directory or None) to make the Archiver of each process with
+# \return Generator of (pvname, rows or None, error or None) in the order
+# they finish, where rows is given by PvStats.rows()
+def fleet_stats(queries, processes, archiver_args, edges=bin_edges):
+    jobs = [(pvname, masks, start, end, edges)
+        for pvname, masks, start, end in queries]
+    pool = multiprocessing.Pool(min(processes, len(jobs)), _init_worker,
+        archiver_args)
+    try:
+        for result in pool.imap_unordered(_pv_stats, jobs):
+            yield result
+    finally:
+        pool.terminate()
+
+# Return the masks of a pv from a comma separated list, skipping the ones
+# that it doesn't have, so one list can be used for all the pvs
+def _pv_masks(text, pvname):
+    out = []
+    for item in text.split(","):
+        try:
+            out += parse_masks(item, pvname)
+        except ValueError:
+            pass
+    return out
+
+usage = """%prog [options] <start_time> <end_time> [<pvname> ...]
+Make fault statistics from the status bits of many axes in DLS archiver
+
+Where:
+   <start_time> and <end_time> are times in the format "%Y-%m-%d@%H:%M"
+   <pvname> is a $(pmac):AXIS<N>:status1, $(pmac):AXIS<N>:status3 or
+            $(pmac):PLCDISBITS00 pv. More can be given with --file
+
+For each axis and mask the output gives the number of times the bits were
+set, the time they were set for, and a histogram of how long they stayed
+set each time."""
+
+def main():
+    parser = OptionParser(usage)
+    parser.add_option("-f", "--file", action="append", default=[],
+        help="Read pvnames from FILE, one per line")
+    parser.add_option("-m", "--masks", default="all",
+        help="Comma separated list of masks to count, as in read_archiver.py. "
+        "Pvs without a named mask skip it. Default %default")
+    parser.add_option("-b", "--bins", default=",".join(
+        [str(e) for e in bin_edges]), help="Comma separated upper edges of "
+        "the duration histogram bins in seconds, default %default")
+    parser.add_option("-s", "--sort", type="choice",
+        choices=["events", "time", "axis"], default="events",
+        help="Sort the rows by events, time or axis, default %default")
+    parser.add_option("-a", "--all", action="store_true", default=False,
+        help="Print masks that were never set as well")
+    parser.add_option("-F", "--format", type="choice",
+        choices=["text", "csv", "json"], default="text",
+        help="Output format, text, csv or json, default %default")
+    parser.add_option("-j", "--processes", type="int",
+        default=multiprocessing.cpu_count(), help="Number of processes, "
+        "default %default")
+    parser.add_option("-u", "--url", default=read_archiver.Archiver_URL,
+        help="URL of the archiver data server")
+    parser.add_option("-k", "--key", type="int",
+        default=read_archiver.Archiver_key,
+        help="Archive key, default %default for all archives")
+    parser.add_option("-p", "--page", type="int",
+        default=read_archiver.page_size,
+        help="Samples to request in each call, default %default")
+    parser.add_option("-c", "--chunk", type="float", metavar="HOURS",
+        default=read_archiver.chunk_secs / 3600.0, help="Split time ranges "
+        "into chunks of this many hours, default %default")
+    parser.add_option("--connections", type="int",
+        default=read_archiver.connections, help="Number of concurrent "
+        "connections for each process, default %default")
+    parser.add_option("-C", "--cache", default=os.environ.get(
+        "READ_ARCHIVER_CACHE", os.path.expanduser("~/.read_archiver_cache")),
+        help="Directory to cache samples in, defaults to "
+        "$READ_ARCHIVER_CACHE or ~/.read_archiver_cache")
+    parser.add_option("-n", "--no-cache", action="store_true", default=False,
+        help="Fetch everything from the archiver, don't use the cache")
+    options, args = parser.parse_args()
+    if len(args) < 2:
+        parser.error("Incorrect number of arguments")
+    if options.chunk <= 0 or options.processes <= 0:
+        parser.error("Chunk length and processes must be positive")
+    try:
+        start, end = parse_time(args[0]), parse_time(args[1])
+        edges = sorted([float(e) for e in options.bins.split(",")])
+    except ValueError, e:
+        parser.error(str(e))
+    pvnames = args[2:]
+    for filename in options.file:
+        pvnames += [query[0] for query in read_archiver.read_queries(filename)]
+    if not pvnames:
+        parser.error("No pvnames given")
+    queries = []
+    for pvname in pvnames:
+        masks = _pv_masks(options.masks, pvname)
+        if masks:
+            queries.append((pvname, masks, start, end))
+        else:
+            sys.stderr.write("***Warning: %s has none of the masks %s\n" % (
+                pvname, options.masks))
+    if not queries:
+        sys.exit(1)
+    cache = None
+    if not options.no_cache:
+        cache = options.cache
+    # gather the rows of all the pvs
+    rows = []
+    failed = False
+    for pvname, pv_rows, error in fleet_stats(queries, options.processes,
+            (options.url, options.key, options.page,
+            int(options.chunk * 3600), options.connections, cache), edges):
+        if error:
+            sys.stderr.write("***Error: %s: %s\n" % (pvname, error))
+            failed = True
+            continue
+        for name, events, off, on, hist in pv_rows:
+            if events or on or options.all:
+                rows.append((axis_name(pvname), name, events, off, on,
+                    hist, pvname))
+    if options.sort == "events":
+        rows.sort(key=lambda r: (-r[2], -r[4], r[0], r[1]))
+    elif options.sort == "time":
+        rows.sort(key=lambda r: (-r[4], -r[2], r[0], r[1]))
+    else:
+        rows.sort()
+    labels = bin_labels([int(e) == e and int(e) or e for e in edges])
+    if options.format == "csv":
+        writer = csv.writer(sys.stdout)
+        writer.writerow(["axis", "mask", "events", "secs_clear", "secs_set",
+            "pv"] + labels)
+        for axis, name, events, off, on, hist, pvname in rows:
+            writer.writerow([axis, name, events, "%.3f" % off, "%.3f" % on,
+                pvname] + hist)
+    elif options.format == "json":
+        print json.dumps(dict(bins=labels, rows=[dict(axis=axis, mask=name,
+            events=events, secs_clear=off, secs_set=on, pv=pvname,
+            histogram=hist)
+            for axis, name, events, off, on, hist, pvname in rows]),
+            indent=1, sort_keys=True)
+    else:
+        print "%-32s %-24s %7s %10s %6s " % ("axis", "mask", "events",
+            "secs set", "% set") + " ".join(["%6s" % l for l in labels])
+        for axis, name, events, off, on, hist, pvname in rows:
+            print "%-32s %-24s %7d %10.0f %6.2f " % (axis, name, events,
+                on, 100 * on / max(off + on, 1e-9)) + \
+                " ".join(["%6d" % n for n in hist])
+    sys.exit(failed)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+#!/usr/bin/env dls-python
+## \namespace homegroups
+# This contains an optimiser that chooses the homing groups of the motors in
+# a \ref motorhome PLC.
+#
+# The groups of a PLC are homed one after the other, and the motors in a
+# group move together, so the time taken is the sum over the groups of the
+# slowest motor in each group. The optimiser finds the groups that give the
+# shortest total time, given:
+# - an estimate of the time taken to home each motor
+# - collisions: pairs of motors that must not move at the same time, so must
+# be in different groups
+# - dependencies: pairs of motors where the first must be homed before the
+# second, so must be in an earlier group
+# - the limits of motorhome: at most 16 motors in a PLC, groups 2..10 if
+# there is more than one group
+#
+# Example:
+# \verbatim
+# from homegroups import optimise
+# groups, total = optimise({1: 5000, 2: 3000, 3: 4000, 4: 1000},
+#     collisions=[(1, 2)], dependencies=[(3, 4)])
+# for axis, group in sorted(groups.items()):
+#     plc.add_motor(axis, group=group, htype=HSW)
+# \endverbatim
+# The times can be estimated with \ref hometime using estimate_times(). For
+# a \ref motorhome_batch manifest with a "model" for each motor and optional
+# "collisions" and "dependencies" lists in each entry,
+# \verbatim
+#   dls-python homegroups.py iocs/pmc_builder/homing.json
+# \endverbatim
+# prints the suggested groups for each PLC. Where an axis has more than one
+# motor entry, e.g. a NOTHING entry that moves it after it is homed, only the
+# entry that homes it is optimised and the others keep their groups.
+
+import sys
+from optparse import OptionParser
+
+## Maximum number of motors in a PLC
+max_motors = 16
+## Group numbers that can be used when there is more than one group
+group_numbers = range(2, 11)
+
+## Choose homing groups for some motors to minimise the total homing time
+# \param times Dict of axis number -> estimated time to home that axis
+# \param collisions List of (axis, axis) pairs that mustn't move together
+# \param dependencies List of (first, second) pairs where first must be
+# homed before second
+# \param overhead Extra time taken by each group
+# \param max_nodes Maximum number of partial solutions to try before giving
+# up and returning the best found so far
+# \return (groups, total) where groups is a dict of axis number -> group
+# number for motorhome.PLC.add_motor() and total is the predicted time
+def optimise(times, collisions=(), dependencies=(), overhead=0,
+        max_nodes=1000000):
+    axes = sorted(times, key=lambda ax: (-times[ax], ax))
+    assert len(axes) <= max_motors, \
+        "Only %d motors may be defined in a single PLC" % max_motors
+    for a, b in list(collisions) + list(dependencies):
+        assert a in times and b in times, \
+            "Constraint (%s, %s) refers to an axis with no time" % (a, b)
+    clash = dict((ax, set()) for ax in axes)
+    for a, b in collisions:
+        clash[a].add(b)
+        clash[b].add(a)
+    # a dependency also stops two motors being in the same group
+    for a, b in dependencies:
+        clash[a].add(b)
+        clash[b].add(a)
+    best = [None, None]
+    nodes = [0]
+    # Put each axis, slowest first, into an existing group or a new one.
+    # The first axis in a group is the slowest, so sets the group time
+    def search(i, assign, groups, cost):
+        nodes[0] += 1
+        if best[1] is not None and (cost >= best[1] or
+                nodes[0] > max_nodes):
+            return
+        if i == len(axes):
+            best[0], best[1] = dict(assign), cost
+            return
+        ax = axes[i]
+        for g, members in enumerate(groups):
+            if clash[ax] & members:
+                continue
+            assign[ax] = g
+            members.add(ax)
+            if _ordered(assign, dependencies):
+                search(i + 1, assign, groups, cost)
+            members.remove(ax)
+            del assign[ax]
+        if len(groups) < len(group_numbers):
+            assign[ax] = len(groups)
+            groups.append(set([ax]))
+            if _ordered(assign, dependencies):
+                search(i + 1, assign, groups, cost + times[ax] + overhead)
+            groups.pop()
+            del assign[ax]
+    search(0, {}, [], 0)
+    assert best[0] is not None, \
+        "Can't fit the motors into %d groups" % len(group_numbers)
+    order = _ordered(best[0], dependencies)
+    if len(order) == 1:
+        numbers = [1]
+    else:
+        numbers = group_numbers
+    groups = dict((ax, numbers[order.index(g)]) for ax, g in best[0].items())
+    return groups, best[1]
+
+# Return the groups in an order where each dependency is homed before the
+# motor that depends on it, or None if there is a loop
+def _ordered(assign, dependencies):
+    groups = set(assign.values())
+    after = dict((g, set()) for g in groups)
+    for a, b in dependencies:
+        if a in assign and b in assign:
+            after[assign[a]].add(assign[b])
+    order = []
+    while after:
+        ready = sorted([g for g in after if not [h for h in after
+            if g in after[h]]])
+        if not ready:
+            return None
+        order.append(ready[0])
+        del after[ready[0]]
+    return order
+
+## Return the total homing time of some groups
+# \param times Dict of axis number -> estimated time to home that axis
+# \param groups Dict of axis number -> group number
+# \param overhead Extra time taken by each group
+def total_time(times, groups, overhead=0):
+    slowest = {}
+    for ax, g in groups.items():
+        slowest[g] = max(slowest.get(g, 0), times[ax])
+    return sum(slowest.values()) + overhead * len(slowest)
+
+## Estimate the time to home each motor on its own with \ref hometime
+# \param motors Dict of axis number -> dict of arguments for
+# motorhome.PLC.add_motor()
+# \param models Dict of axis number -> dict of arguments for
+# homesim.Machine.setup_axis()
+# \param plc_args Dict of arguments for motorhome.PLC()
+# \param kwargs Other arguments for hometime.predict()
+# \return Dict of axis number -> time in ms. Raises ValueError if an axis
+# doesn't finish homing with status Done, as its time would be meaningless
+def estimate_times(motors, models, plc_args={}, **kwargs):
+    import motorhome, hometime
+    times = {}
+    for ax, args in motors.items():
+        plc = motorhome.PLC(1, **plc_args)
+        args = dict(args)
+        args.pop("group", None)
+        plc.add_motor(ax, **args)
+        prediction = hometime.predict(plc, {ax: models[ax]}, **kwargs)
+        if prediction.status != "Done":
+            raise ValueError("Homing axis %d finished with status %s after "
+                "%.1f s" % (ax, prediction.status, prediction.total / 1000.0))
+        times[ax] = prediction.total
+    return times
+
+def main():
+    import motorhome_batch, hometime
+    parser = OptionParser("usage: %prog [options] <manifest>\n"
+        "Suggest homing groups for the PLCs in a motorhome_batch manifest. "
+        "Each motor needs a \"model\" dict of arguments for "
+        "homesim.Machine.setup_axis(), and each entry can have "
+        "\"collisions\" and \"dependencies\" lists of [axis, axis] pairs")
+    parser.add_option("-s", "--starts", default="0,0.5,1",
+        help="Comma separated list of start positions to estimate the "
+        "times from as a fraction of the travel, default %default")
+    parser.add_option("-o", "--overhead", type="float", default=0,
+        help="Extra time in ms for each group")
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("Incorrect number of arguments")
+    starts = [float(x) for x in options.starts.split(",")]
+    entries = motorhome_batch.load_manifest(args[0])
+    for entry in sum([motorhome_batch.plc_entries(e) for e in entries], []):
+        name = "%s PLC%d %s" % (entry["controller"], entry["plc"],
+            entry.get("name", "worker"))
+        if [m for m in entry["motors"] if "model" not in m]:
+            sys.stderr.write("***Error: not all motors of %s have a model\n"
+                % name)
+            sys.exit(1)
+        # an axis may have more than one motor entry, e.g. a NOTHING entry to
+        # move it after it is homed. Optimise the entry that homes it, the
+        # others keep their groups
+        homing = {}
+        for i, m in enumerate(entry["motors"]):
+            if m.get("htype", entry.get("htype", "HOME")) != "NOTHING":
+                homing.setdefault(m["axis"], i)
+        for i, m in enumerate(entry["motors"]):
+            homing.setdefault(m["axis"], i)
+        # home each motor on its own in group 1
+        times = {}
+        for ax, i in homing.items():
+            m = entry["motors"][i]
+            single = dict(entry, motors=[dict(m, group=1)], groups={},
+                extra_plcs=[])
+            prediction = hometime.predict(motorhome_batch.make_plc(single),
+                {ax: m["model"]}, starts)
+            if prediction.status != "Done":
+                sys.stderr.write("***Error: homing axis %d of %s finished "
+                    "with status %s, check its model\n" % (ax, name,
+                    prediction.status))
+                sys.exit(1)
+            times[ax] = prediction.total
+        groups, total = optimise(times, entry.get("collisions", []),
+            entry.get("dependencies", []), options.overhead)
+        kept = [(i, m) for i, m in enumerate(entry["motors"])
+            if homing[m["axis"]] != i]
+        # group 1 homes all the others, so can't be used with kept groups
+        if kept and groups.values() == [1] * len(groups):
+            groups = dict((ax, 2) for ax in groups)
+        current = dict((ax, entry["motors"][i].get("group", 1))
+            for ax, i in homing.items())
+        print "%s: %.1f s, currently %.1f s" % (name, total / 1000.0,
+            total_time(times, current, options.overhead) / 1000.0)
+        for ax in sorted(groups):
+            print "  axis %d: group %d (%.1f s)" % (ax, groups[ax],
+                times[ax] / 1000.0)
+        for i, m in kept:
+            print "  axis %d: group %d (motors[%d], kept)" % (m["axis"],
+                m.get("group", 1), i)
+
+if __name__ == "__main__":
+    main()
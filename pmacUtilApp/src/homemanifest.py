@@ -0,0 +1,578 @@
+#!/usr/bin/env dls-python
+## \namespace homemanifest
+# This contains a loader for declarative homing manifests, which describe the
+# homing PLCs of a controller or a whole beamline as data instead of python.
+#
+# A manifest is a JSON or YAML file (chosen by its extension, YAML needs
+# PyYAML) containing a list of entries, one per PLC, as described in
+# \ref motorhome_batch. It may instead be a dict with a "plcs" list of entries
+# and a "defaults" dict of values that each entry takes unless it gives its
+# own. A motor may give a list of axes to add several motors with the same
+# settings. An entry may give a list of "workers" instead of "motors" to make
+# a \ref motorhome::Supervisor "Supervisor" PLC that homes them in parallel,
+# each worker being an entry without a controller or name. E.g.
+# \verbatim
+# defaults:
+#   ctype: GEOBRICK
+#   post: i
+# plcs:
+#   - {plc: 10, name: M1, motors: [{axis: [1, 2, 3], htype: HSW_DIR}]}
+#   - plc: 11
+#     name: M2
+#     motors:
+#       - {axis: [4, 5, 6], htype: HSW_DIR}
+#       - {axis: 7, htype: HSW, jdist: -2800, group: 3,
+#          jdist_overrides: [null, 1000, null], post: r100}
+#   - plc: 12
+#     name: ALL
+#     workers:
+#       - {plc: 13, motors: [{axis: [9, 10], htype: LIMIT}]}
+#       - {plc: 14, motors: [{axis: [11, 12], htype: HSW}]}
+# \endverbatim
+# The whole manifest is checked against a schema before any PLC is made, then
+# every PLC is made, and all the problems found are reported at once with the
+# file and line they come from, e.g.
+# \verbatim
+# homing.yaml:12: motors[1].htype: 'HSW_DIRR' is not one of HOME, LIMIT, ...
+# \endverbatim
+#
+# A generate_homing_plcs.py script can use a manifest instead of an if/elif
+# ladder of PLC names:
+# \verbatim
+# from motorhome import write_plcs
+# from homemanifest import plc_maker
+# write_plcs(plc_maker("configure/homing.json"))
+# \endverbatim
+# To check a manifest by hand:
+# \verbatim
+#   dls-python homemanifest.py iocs/pmc_builder/configure/homing.json
+# \endverbatim
+
+import os, re, sys, bisect
+from json.decoder import scanstring
+from optparse import OptionParser
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+## Names of the htypes that can be used in a manifest
+htype_names = ["HOME", "LIMIT", "HSW", "HSW_HLIM", "HSW_DIR", "RLIM",
+    "NOTHING", "HSW_HSTOP"]
+## Names of the ctypes that can be used in a manifest
+ctype_names = ["PMAC", "GEOBRICK", "BRICK"]
+
+## Exception raised when a manifest can't be read or is invalid
+class ManifestError(Exception):
+    ## \param errors List of (filename, line, message) tuples
+    def __init__(self, errors):
+        Exception.__init__(self, errors)
+        self.errors = errors
+
+    def __str__(self):
+        return "\n".join(["%s:%d: %s" % e for e in self.errors])
+
+_number_re = re.compile(r'-?(?:0|[1-9]\d*)(\.\d+)?([eE][-+]?\d+)?')
+_ws_re = re.compile(r'\s*')
+_literals = {"true": True, "false": False, "null": None}
+
+# A JSON parser that records the line of each value it reads
+class _JsonReader:
+    def __init__(self, text, filename):
+        self.text = text
+        self.filename = filename
+        self.lines = {}
+        self.newlines = [m.start() for m in re.finditer("\n", text)]
+
+    def line(self, pos):
+        return bisect.bisect_left(self.newlines, pos) + 1
+
+    def error(self, pos, message):
+        raise ManifestError([(self.filename, self.line(pos), message)])
+
+    def read(self):
+        value, pos = self.value(self.skip(0), ())
+        pos = self.skip(pos)
+        if pos < len(self.text):
+            self.error(pos, "Extra data after the end of the manifest")
+        return value
+
+    def skip(self, pos):
+        return _ws_re.match(self.text, pos).end()
+
+    def value(self, pos, path):
+        self.lines[path] = self.line(pos)
+        c = self.text[pos:pos + 1]
+        if c == "{":
+            return self.container(pos, path, "}", {})
+        elif c == "[":
+            return self.container(pos, path, "]", [])
+        elif c == '"':
+            try:
+                value, pos = scanstring(self.text, pos + 1)
+            except ValueError, e:
+                self.error(pos, str(e).split(":")[0])
+            return value, pos
+        for word, value in _literals.items():
+            if self.text.startswith(word, pos):
+                return value, pos + len(word)
+        match = _number_re.match(self.text, pos)
+        if match and match.end() > pos:
+            if match.group(1) or match.group(2):
+                return float(match.group(0)), match.end()
+            return int(match.group(0)), match.end()
+        self.error(pos, "Expecting a value")
+
+    def container(self, pos, path, close, out):
+        pos = self.skip(pos + 1)
+        if self.text[pos:pos + 1] == close:
+            return out, pos + 1
+        while True:
+            if close == "}":
+                if self.text[pos:pos + 1] != '"':
+                    self.error(pos, "Expecting a property name in quotes")
+                key, pos = self.value(pos, path + (None,))
+                del self.lines[path + (None,)]
+                pos = self.skip(pos)
+                if self.text[pos:pos + 1] != ":":
+                    self.error(pos, "Expecting ':' after %r" % str(key))
+                if key in out:
+                    self.error(pos, "Duplicate key %r" % str(key))
+                out[key], pos = self.value(self.skip(pos + 1), path + (key,))
+            else:
+                value, pos = self.value(pos, path + (len(out),))
+                out.append(value)
+            pos = self.skip(pos)
+            if self.text[pos:pos + 1] == close:
+                return out, pos + 1
+            if self.text[pos:pos + 1] != ",":
+                self.error(pos, "Expecting ',' or '%s'" % close)
+            pos = self.skip(pos + 1)
+
+# Turn a YAML node tree into values, recording the line of each value
+def _yaml_values(loader, node, path, lines):
+    lines[path] = node.start_mark.line + 1
+    if isinstance(node, yaml.MappingNode):
+        out = {}
+        for key_node, value_node in node.value:
+            key = loader.construct_object(key_node)
+            out[key] = _yaml_values(loader, value_node, path + (key,), lines)
+        return out
+    elif isinstance(node, yaml.SequenceNode):
+        return [_yaml_values(loader, n, path + (i,), lines)
+            for i, n in enumerate(node.value)]
+    return loader.construct_object(node)
+
+# json gives us unicode strings, but motorhome expects str
+def _str(value):
+    if isinstance(value, unicode):
+        return str(value)
+    elif isinstance(value, list):
+        return [_str(v) for v in value]
+    elif isinstance(value, dict):
+        return dict((_str(k), _str(v)) for k, v in value.items())
+    return value
+
+## Read a JSON or YAML file, keeping the line that each value came from
+# \param filename Path of the file, files ending .yaml or .yml are YAML
+# \param text Contents of the file, read from filename if not given
+# \return (data, lines) where lines is a dict of path -> line number, and a
+# path is the tuple of dict keys and list indexes that lead to a value
+def read(filename, text=None):
+    if text is None:
+        try:
+            text = open(filename).read()
+        except IOError, e:
+            raise ManifestError([(filename, 0, e.strerror)])
+    if os.path.splitext(filename)[1].lower() not in (".yaml", ".yml"):
+        reader = _JsonReader(text, filename)
+        return _str(reader.read()), reader.lines
+    if yaml is None:
+        raise ManifestError([(filename, 0,
+            "PyYAML is needed to read YAML manifests")])
+    lines = {}
+    try:
+        loader = yaml.SafeLoader(text)
+        node = loader.get_single_node()
+        if node is None:
+            return None, lines
+        return _str(_yaml_values(loader, node, (), lines)), lines
+    except yaml.MarkedYAMLError, e:
+        raise ManifestError([(filename, e.problem_mark.line + 1, e.problem)])
+
+# Value checkers for the schema. Each takes (value, path, errors) and adds
+# any (path, message) problems to errors
+def _integer(lo=None, hi=None):
+    def check(value, path, errors):
+        if type(value) not in (int, long):
+            errors.append((path, "%r should be an integer" % (value,)))
+        elif (lo is not None and value < lo) or (hi is not None and value > hi):
+            if hi is None:
+                errors.append((path, "%d should be at least %d" % (value, lo)))
+            else:
+                errors.append((path, "%d is not in range %d..%d" % (
+                    value, lo, hi)))
+    return check
+
+def _number(value, path, errors):
+    if type(value) not in (int, long, float):
+        errors.append((path, "%r should be a number" % (value,)))
+
+def _string(value, path, errors):
+    if not isinstance(value, str):
+        errors.append((path, "%r should be a string" % (value,)))
+
+def _boolean(value, path, errors):
+    if type(value) is not bool:
+        errors.append((path, "%r should be true or false" % (value,)))
+
+def _name(value, path, errors):
+    if not isinstance(value, str) or not re.match(r"^[\w.-]+$", value):
+        errors.append((path, "%r should be a name made of letters, numbers, "
+            "'_', '-' and '.'" % (value,)))
+
+def _enum(names):
+    def check(value, path, errors):
+        if value not in names:
+            errors.append((path, "%r is not one of %s" % (
+                value, ", ".join(names))))
+    return check
+
+def _post(value, path, errors):
+    if value is None or type(value) in (int, long):
+        return
+    if not isinstance(value, str) or not re.match(
+            r"^(0|[ihlHL]|[zr]-?\d+)$", value):
+        errors.append((path, "%r is not a valid post home move, should be "
+            "null, a position, 'z<pos>', 'r<dist>', 'i', 'h', 'l', 'H' or "
+            "'L'" % (value,)))
+
+def _optional(check):
+    def optional(value, path, errors):
+        if value is not None:
+            check(value, path, errors)
+    return optional
+
+def _list(check, length=None):
+    def checklist(value, path, errors):
+        if not isinstance(value, list):
+            errors.append((path, "%r should be a list" % (value,)))
+        elif length is not None and len(value) != length:
+            errors.append((path, "should be a list of %d items" % length))
+        else:
+            for i, v in enumerate(value):
+                check(v, path + (i,), errors)
+    return checklist
+
+# Each alternative is (types, check), the check of the first alternative
+# that the type of the value is one of is used. If there is none, the
+# problems of all of them are reported
+def _either(*alternatives):
+    def check(value, path, errors):
+        for types, c in alternatives:
+            if type(value) in types:
+                c(value, path, errors)
+                return
+        e = []
+        for types, c in alternatives:
+            c(value, path, e)
+        errors.append((path, ", or ".join([message for p, message in e])))
+    return check
+
+def _dict(schema, required=()):
+    def check(value, path, errors):
+        if not isinstance(value, dict):
+            errors.append((path, "should be a dict"))
+            return
+        for key in required:
+            if key not in value:
+                errors.append((path, "%r is required" % key))
+        for key, v in sorted(value.items()):
+            if key not in schema:
+                errors.append((path + (key,), "Unknown key %r, should be one "
+                    "of %s" % (key, ", ".join(sorted(schema)))))
+            else:
+                schema[key](v, path + (key,), errors)
+    return check
+
+def _model(value, path, errors):
+    if not isinstance(value, dict):
+        errors.append((path, "should be a dict"))
+
+_axis = _integer(1, 32)
+_pair = _list(_axis, 2)
+
+## Schema of a homing group in the "groups" dict of an entry, see
+# motorhome.PLC.configure_group()
+group_schema = {
+    "checks": _list(_list(_either(((str,), _string),
+        ((int, long), _integer())), 3)),
+    "pre": _string, "post": _string, "comment": _string}
+
+## Schema of a motor, see motorhome.PLC.add_motor(). "model" is used by
+# \ref hometime
+motor_schema = {
+    "axis": _either(((int, long), _axis), ((list,), _list(_axis))),
+    "group": _integer(1, 10),
+    "htype": _enum(htype_names), "jdist": _number,
+    "jdist_overrides": _list(_optional(_number), 3), "post": _post,
+    "enc_axes": _list(_axis), "ms": _integer(0), "search_speed": _number,
+    "model": _model,
+    "time": _number, "comment": _string}
+
+## Schema of an entry, see motorhome.PLC(). "collisions" and "dependencies"
+# are used by \ref homegroups
+entry_schema = {
+    "controller": _name, "plc": _integer(0, 31), "name": _name,
+    "timeout": _integer(0), "htype": _enum(htype_names), "jdist": _number,
+    "post": _post, "ctype": _enum(ctype_names), "allow_debug": _boolean,
+    "resume": _integer(0, 8190), "search_speed": _number,
+    "speed_vars": _integer(0, 8176), "motors": _list(_dict(motor_schema, ["axis"])),
+    "groups": _dict({}), "collisions": _list(_pair),
+    "dependencies": _list(_pair), "extra_plcs": _list(_integer(0, 31)),
+    "comment": _string}
+
+# group numbers are strings in JSON, so check the groups dict here
+def _groups(value, path, errors):
+    if not isinstance(value, dict):
+        errors.append((path, "should be a dict"))
+        return
+    for key, v in sorted(value.items()):
+        if not re.match(r"^\d+$", str(key)) or not 1 <= int(key) <= 10:
+            errors.append((path + (key,), "Group %r is not in range 1..10"
+                % (key,)))
+        _dict(group_schema)(v, path + (key,), errors)
+entry_schema["groups"] = _groups
+
+## Schema of a worker PLC of a supervisor entry, see motorhome.Supervisor.
+# It takes the PLC arguments of the supervisor entry unless it gives its own
+worker_schema = dict((k, v) for k, v in entry_schema.items()
+    if k not in ("controller", "name"))
+entry_schema["workers"] = _list(_dict(worker_schema, ["plc", "motors"]))
+
+# Return the line of path, or the closest value that contains it
+def _line(lines, path):
+    while path not in lines and path:
+        path = path[:-1]
+    return lines.get(path, 0)
+
+# Format a path like motors[1].htype
+def _format(path):
+    out = ""
+    for p in path:
+        if isinstance(p, int):
+            out += "[%d]" % p
+        elif out:
+            out += ".%s" % p
+        else:
+            out = str(p)
+    return out
+
+# Check the entries for things the schema can't express
+def _semantics(entries, paths, lines, errors):
+    import motorhome_batch
+    # check the workers of a supervisor like the other entries, and that
+    # they don't home the same axes
+    for entry, path in zip(list(entries), list(paths)):
+        if "workers" not in entry:
+            continue
+        if "motors" in entry:
+            errors.append((path + ("motors",), "A supervisor entry can't "
+                "have motors as well as workers"))
+        homed = {}
+        for i, worker in enumerate(motorhome_batch.plc_entries(entry)):
+            entries.append(worker)
+            paths.append(path + ("workers", i))
+            for j, motor in enumerate(worker["motors"]):
+                axes = motor["axis"]
+                if not isinstance(axes, list):
+                    axes = [axes]
+                for axis in axes:
+                    if axis in homed and homed[axis] != i:
+                        errors.append((path + ("workers", i, "motors", j,
+                            "axis"), "Axis %d is already homed by "
+                            "workers[%d]" % (axis, homed[axis])))
+                    homed.setdefault(axis, i)
+    seen = {}
+    for entry, path in zip(entries, paths):
+        names = [(("plc",), "plc", entry["plc"])]
+        if "name" in entry:
+            names.append((("name",), "name", entry["name"]))
+        names += [(("extra_plcs", i), "plc", n)
+            for i, n in enumerate(entry.get("extra_plcs", []))]
+        for key, kind, value in names:
+            other = (entry.get("controller"), kind, value)
+            if other in seen:
+                errors.append((path + key, "%s %s is also used by the "
+                    "entry on line %d" % (kind, value, seen[other])))
+            else:
+                seen[other] = _line(lines, path)
+        groups = {}
+        homed = {}
+        for i, motor in enumerate(entry.get("motors", [])):
+            axes = motor["axis"]
+            if not isinstance(axes, list):
+                axes = [axes]
+            group = motor.get("group", 1)
+            groups.setdefault(group, path + ("motors", i))
+            htype = motor.get("htype", entry.get("htype", "HOME"))
+            for axis in axes:
+                if htype != "NOTHING" and axis in homed:
+                    errors.append((path + ("motors", i, "axis"), "Axis %d is "
+                        "already homed by motors[%d]" % (axis, homed[axis])))
+                homed.setdefault(axis, i)
+        if 1 in groups and len(groups) > 1:
+            errors.append((groups[1], "Group 1 homes all the other groups, "
+                "so can't be used with groups %s" % ", ".join(
+                    [str(g) for g in sorted(groups) if g != 1])))
+        axes = set(homed)
+        nplcs = 1 + len(entry.get("extra_plcs", []))
+        if len(axes) > 16 * nplcs:
+            errors.append((path + ("motors",), "%d motors, but only %d may "
+                "be defined in %d PLCs, add more extra_plcs" % (len(axes),
+                16 * nplcs, nplcs)))
+        for group in entry.get("groups", {}):
+            if re.match(r"^\d+$", str(group)) and int(group) not in groups:
+                errors.append((path + ("groups", group), "No motors are in "
+                    "group %s" % group))
+        for key in ("collisions", "dependencies"):
+            for i, pair in enumerate(entry.get(key, [])):
+                for axis in pair:
+                    if axis not in axes:
+                        errors.append((path + (key, i), "Axis %d has no "
+                            "motor in this PLC" % axis))
+
+## Load and check a manifest
+# \param filename Path of the manifest
+# \param text Contents of the manifest, read from filename if not given
+# \param make If True, also make a motorhome.PLC for each entry to find any
+# problems that motorhome reports
+# \param require List of keys that each entry must have as well as plc, name
+# and motors, e.g. ["controller"]
+# \return List of entries, with the defaults applied and one motor per axis,
+# ready for motorhome_batch.make_plc()
+def load(filename, text=None, make=True, require=()):
+    data, lines = read(filename, text)
+    errors = []
+    defaults = {}
+    if isinstance(data, dict):
+        _dict({"defaults": _dict(entry_schema), "plcs": _list(_model),
+            "comment": _string}, ["plcs"])(data, (), errors)
+        prefix = ("plcs",)
+        if isinstance(data.get("defaults"), dict):
+            defaults = data["defaults"]
+            for key in ("plc", "name", "motors", "groups"):
+                if key in defaults:
+                    errors.append((("defaults", key), "%r can't have a "
+                        "default" % key))
+        data = data.get("plcs", [])
+    else:
+        prefix = ()
+        _list(_model)(data, (), errors)
+    if not isinstance(data, list):
+        data = []
+    entries = []
+    paths = []
+    for i, entry in enumerate(data):
+        path = prefix + (i,)
+        if not isinstance(entry, dict):
+            continue
+        for key, value in defaults.items():
+            if key not in entry:
+                entry[key] = value
+                lines[path + (key,)] = _line(lines, ("defaults", key))
+        e = []
+        if "workers" in entry:
+            required = ["plc", "name", "workers"]
+        else:
+            required = ["plc", "name", "motors"]
+        _dict(entry_schema, required + list(require))(entry, path, e)
+        if not e:
+            entries.append(entry)
+            paths.append(path)
+        errors += e
+    _semantics(list(entries), list(paths), lines, errors)
+    # one motor per axis
+    for entry in entries:
+        for e in [entry] + entry.get("workers", []):
+            motors = []
+            for motor in e.get("motors", []):
+                if isinstance(motor["axis"], list):
+                    motors += [dict(motor, axis=axis) for axis in motor["axis"]]
+                else:
+                    motors.append(motor)
+            if "motors" in e:
+                e["motors"] = motors
+    if make and not errors:
+        import motorhome_batch
+        for entry, path in zip(entries, paths):
+            try:
+                motorhome_batch.make_plc(entry)
+            except (AssertionError, ValueError, TypeError), e:
+                errors.append((path, "Can't make PLC%d %s: %s" % (
+                    entry["plc"], entry["name"], e)))
+    if errors:
+        out = []
+        for path, message in errors:
+            # paths in the plcs list are given from the list, e.g. [0].plc
+            name = _format(path)
+            if len(path) > len(prefix) and path[:len(prefix)] == prefix:
+                name = _format(path[len(prefix):])
+            out.append((filename, _line(lines, path), ("%s: %s" % (name,
+                message)).lstrip(": ")))
+        errors = out
+        errors.sort(key=lambda e: e[1])
+        raise ManifestError(errors)
+    return entries
+
+## Return a function for motorhome.write_plcs() that makes the PLCs in a
+# manifest
+# \param filename Path of the manifest
+# \param controller Only use entries for this controller, or entries that
+# don't give a controller. Defaults to the name of the current directory,
+# which is the controller directory when run from configure/PMC_RULES
+# \return Function that takes (num, name) and returns a motorhome.PLC, or
+# None if there is no entry for it
+def plc_maker(filename, controller=None):
+    import motorhome_batch
+    if controller is None:
+        controller = os.path.basename(os.getcwd())
+    try:
+        entries = load(filename)
+    except ManifestError, e:
+        sys.stderr.write("***Error: %s\n" % str(e).replace("\n",
+            "\n***Error: "))
+        sys.exit(1)
+    entries = dict(((e["plc"], e["name"]), e) for e in entries
+        if e.get("controller", controller) == controller)
+    def make_plc(num, name):
+        if (num, name) in entries:
+            return motorhome_batch.make_plc(entries[(num, name)])
+    return make_plc
+
+def main():
+    parser = OptionParser("usage: %prog <manifest> ...\n"
+        "Check some homing manifests, printing any errors with their lines")
+    options, args = parser.parse_args()
+    if not args:
+        parser.error("No manifests given")
+    failed = False
+    for filename in args:
+        try:
+            entries = load(filename)
+        except ManifestError, e:
+            for error in e.errors:
+                sys.stderr.write("***Error: %s:%d: %s\n" % error)
+            failed = True
+        else:
+            import motorhome_batch
+            plcs = sum([motorhome_batch.plc_entries(e) for e in entries], [])
+            print "%s: %d PLCs, %d motors" % (filename, len(entries) + len(
+                plcs) - len([e for e in entries if "motors" in e]),
+                sum([len(e["motors"]) for e in plcs]))
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
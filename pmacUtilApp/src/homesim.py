@@ -0,0 +1,980 @@
+#!/usr/bin/env dls-python
+## \namespace homesim
+# This contains an offline simulator for the homing PLCs generated by
+# \ref motorhome, so that they can be checked without a controller or a
+# dls-pmac-sim.
+#
+# It interprets the subset of PMAC PLC syntax that
+# \ref motorhome::PLC::writeFile "PLC.writeFile()" emits: IF, WHILE, ELSE,
+# AND, OR, P, M, I and macrostation variable assignments, timers and the
+# \c \#nJ, \c \#nHM and \c \#nHMZ online commands. These are run against a
+# vectorised kinematic model of a number of axes, each with optional limit
+# switches, hard stops, a home flag and index marks. Axes move at constant
+# velocity and time is skipped forward to the next event while the PLC is
+# waiting for motion, so a simulated homing takes milliseconds to run.
+#
+# Positions are given in counts, times in ms. The model is deliberately
+# simple. If an axis is given an accel, starting, stopping or reversing a
+# move adds the time that a linear ramp loses against moving at full speed,
+# speed / (2 * accel), with the axis held still for that time, so positions
+# and trigger points are not affected. Without an accel, changes of speed
+# are instant. Soft limits and the in-position band are not modelled,
+# capture triggers are level sensitive, and a motor that runs into a hard
+# stop gets a fatal following error.
+#
+# Example:
+# \verbatim
+# from motorhome import PLC, HSW
+# from homesim import simulate
+# plc = PLC(11, timeout=100000)
+# plc.add_motor(1, htype=HSW, jdist=1000)
+# result = simulate(plc, {1: dict(pos=20000, lim=(-50000, 50000),
+#     flag=(0, 5000), home_speed=-20)})
+# print result.status, result.time, result.homes
+# \endverbatim
+
+import re, math, __future__
+import numpy
+
+from pmcparse import Parser
+
+## Error raised when a PLC can't be simulated
+class SimulationError(Exception):
+    pass
+
+# Reasons for an axis to stop or change its move
+_TARGET, _TRIGGER, _LIMIT, _HARDSTOP = range(4)
+
+## Vectorised kinematic model of a number of axes. Each array is indexed by
+# axis number, so element 0 is unused.
+class Axes:
+    ## \param n Number of axes to model
+    def __init__(self, n=32):
+        size = n + 1
+        ## Number of axes
+        self.n = n
+        ## Current time in ms
+        self.time = 0.0
+        # geometry, in physical counts
+        ## Position of the low and high limit switches. The low limit is
+        ## active at or below lim_lo, the high limit at or above lim_hi
+        self.lim_lo = numpy.repeat(-numpy.inf, size)
+        self.lim_hi = numpy.repeat(numpy.inf, size)
+        ## Position of the low and high hard stops
+        self.stop_lo = numpy.repeat(-numpy.inf, size)
+        self.stop_hi = numpy.repeat(numpy.inf, size)
+        ## The home flag is active between flag_lo and flag_hi inclusive
+        self.flag_lo = numpy.repeat(numpy.nan, size)
+        self.flag_hi = numpy.repeat(numpy.nan, size)
+        ## Position of an index mark, repeated every index_period if that is
+        ## not 0
+        self.index = numpy.repeat(numpy.nan, size)
+        self.index_period = numpy.zeros(size)
+        ## Acceleration in counts/ms^2, inf to change speed instantly
+        self.accel = numpy.repeat(numpy.inf, size)
+        # state
+        ## Physical position of each axis
+        self.pos = numpy.zeros(size)
+        ## Physical position of motor position 0
+        self.origin = numpy.zeros(size)
+        ## Jog register (Mxx72) in counts
+        self.jog = numpy.zeros(size)
+        ## Status bits: moving, stopped on limit (Mxx30), fatal following
+        ## error (Mxx42) and home complete (Mxx45)
+        self.moving = numpy.zeros(size, bool)
+        self.on_limit = numpy.zeros(size, bool)
+        self.ffe = numpy.zeros(size, bool)
+        self.homed = numpy.zeros(size, bool)
+        # current move: speed, final target, where the next event happens and
+        # what it is, and the trigger settings if armed
+        self.speed = numpy.zeros(size)
+        self.target = numpy.zeros(size)
+        self.stop = numpy.zeros(size)
+        self.event = numpy.zeros(size, int)
+        self.direction = numpy.zeros(size)
+        self.homing = numpy.zeros(size, bool)
+        self.moves = [None] * size
+        # acceleration is modelled by holding an axis still while it speeds
+        # up, slows down or reverses. hold is the time this finishes and
+        # settling is True if the axis is slowing down at the end of a move
+        self.hold = numpy.zeros(size)
+        self.settling = numpy.zeros(size, bool)
+
+    ## Set the geometry of an axis
+    # \param ax Axis number
+    # \param pos Starting physical position
+    # \param lim Tuple of (low, high) limit switch positions, None for no
+    # switch
+    # \param stops Tuple of (low, high) hard stop positions, None for none
+    # \param flag Tuple of (low, high) positions the home flag is active
+    # between. Use None for a directional home switch, e.g. (0, None)
+    # \param index Position of an index mark
+    # \param index_period Distance between index marks, 0 for a single mark
+    # \param accel Acceleration in counts/ms^2, None for instant changes of
+    # speed. This adds the time taken to speed up and slow down to each move,
+    # but positions during a move are still worked out at constant velocity
+    def setup(self, ax, pos=0, lim=(None, None), stops=(None, None),
+            flag=None, index=None, index_period=0, accel=None):
+        def value(v, default):
+            if v is None:
+                return default
+            return v
+        self.pos[ax] = pos
+        self.lim_lo[ax] = value(lim[0], -numpy.inf)
+        self.lim_hi[ax] = value(lim[1], numpy.inf)
+        self.stop_lo[ax] = value(stops[0], -numpy.inf)
+        self.stop_hi[ax] = value(stops[1], numpy.inf)
+        if flag is not None:
+            self.flag_lo[ax] = value(flag[0], -numpy.inf)
+            self.flag_hi[ax] = value(flag[1], numpy.inf)
+        self.index[ax] = value(index, numpy.nan)
+        self.index_period[ax] = index_period
+        self.accel[ax] = value(accel, numpy.inf)
+
+    ## Return the motor position of an axis in counts
+    def position(self, ax):
+        return self.pos[ax] - self.origin[ax]
+
+    ## Start a move
+    # \param ax Axis number
+    # \param target Physical target position, may be +-inf for a jog to limit
+    # \param speed Speed in counts/ms
+    # \param limits If False then the limit switches are ignored
+    # \param capture If not None then a tuple of (capture control, flag
+    # select, post trigger distance, trigger on hard stop). On the trigger
+    # the move is changed to finish at the trigger position plus the post
+    # trigger distance
+    # \param home If True then this is a home search move, capture must be
+    # given and its post trigger distance is the home offset
+    def move(self, ax, target, speed, limits=True, capture=None, home=False):
+        if speed <= 0:
+            raise SimulationError("Axis %d has zero speed" % ax)
+        self.on_limit[ax] = False
+        self.ffe[ax] = False
+        self.homing[ax] = home
+        if home:
+            self.homed[ax] = False
+        self.speed[ax] = speed
+        self.moves[ax] = (limits, capture)
+        self.settling[ax] = False
+        self.hold[ax] = self.time + self._ramp(ax)
+        self._plan(ax, target)
+
+    # Time that speeding up or slowing down adds to a move
+    def _ramp(self, ax):
+        return self.speed[ax] / (2 * self.accel[ax])
+
+    ## Stop an axis where it is
+    def halt(self, ax):
+        self.moving[ax] = False
+        self.settling[ax] = False
+        self.homing[ax] = False
+        self.ffe[ax] = False
+
+    ## Set the current position of an axis to be motor position 0
+    def zero(self, ax):
+        self.origin[ax] = self.pos[ax]
+        self.homed[ax] = True
+
+    ## Return the time in ms until the next axis stops or triggers, or inf
+    def time_to_event(self):
+        moving = self.moving
+        if not moving.any():
+            return numpy.inf
+        wait = numpy.maximum(self.hold[moving] - self.time, 0)
+        return (wait + numpy.abs(self.stop[moving] - self.pos[moving]) /
+            self.speed[moving]).min()
+
+    ## Advance time by dt ms, handling any events on the way
+    def advance(self, dt):
+        end = self.time + dt
+        while self.moving.any():
+            moving = self.moving
+            wait = numpy.maximum(self.hold - self.time, 0)
+            remain = numpy.repeat(numpy.inf, self.n + 1)
+            remain[moving] = wait[moving] + \
+                numpy.abs(self.stop - self.pos)[moving] / self.speed[moving]
+            step = min(remain.min(), end - self.time)
+            run = numpy.maximum(step - wait, 0)
+            direction = numpy.sign(self.stop - self.pos)
+            self.pos[moving] += (direction * self.speed * run)[moving]
+            self.time += step
+            arrived = numpy.nonzero(moving & (remain <= step))[0]
+            if len(arrived) == 0:
+                break
+            for ax in arrived:
+                self.pos[ax] = self.stop[ax]
+                self._event(ax)
+        self.time = end
+
+    # Work out where the next event is for a move from the current position
+    # to target
+    def _plan(self, ax, target):
+        limits, capture = self.moves[ax]
+        pos = self.pos[ax]
+        self.target[ax] = target
+        self.moving[ax] = True
+        d = numpy.sign(target - pos)
+        self.direction[ax] = d
+        if d == 0:
+            self.stop[ax], self.event[ax] = pos, _TARGET
+            return
+        # events in order of priority for the same position
+        events = []
+        if limits:
+            if d > 0:
+                events.append((max(self.lim_hi[ax], pos), _LIMIT))
+            else:
+                events.append((min(self.lim_lo[ax], pos), _LIMIT))
+        if d > 0:
+            events.append((max(self.stop_hi[ax], pos), _HARDSTOP))
+        else:
+            events.append((min(self.stop_lo[ax], pos), _HARDSTOP))
+        if capture is not None:
+            barrier = min([x for x, e in events] + [target],
+                key=lambda x: d * (x - pos))
+            trigger = self._trigger(ax, pos, barrier, d, capture)
+            if trigger is not None:
+                events.append((trigger, _TRIGGER))
+        events.append((target, _TARGET))
+        x, event = min(events, key=lambda e: (d * (e[0] - pos), e[1]))
+        self.stop[ax], self.event[ax] = x, event
+
+    # Return the first position between start and end where the capture
+    # condition is true, or None
+    def _trigger(self, ax, start, end, d, capture):
+        control, select = int(capture[0]), int(capture[1])
+        use_index, use_flag = control & 1, control & 2
+        if not use_index and not use_flag:
+            # software trigger, happens straight away
+            return start
+        if select == 1:
+            lo, hi = self.lim_hi[ax], numpy.inf
+        elif select == 2:
+            lo, hi = -numpy.inf, self.lim_lo[ax]
+        else:
+            lo, hi = self.flag_lo[ax], self.flag_hi[ax]
+        def flag_ok(x):
+            return (lo <= x <= hi) != bool(control & 8)
+        eps = 1e-6 * d
+        if use_index and not control & 4:
+            # first index mark with the flag in the right state
+            for mark in self._marks(ax, start, end, d):
+                if not use_flag or flag_ok(mark):
+                    return mark
+            return None
+        # level of the flag, index low is true almost everywhere. A motor
+        # stopped on an edge is treated as being on both sides of it
+        if not use_flag or flag_ok(start) or flag_ok(start + eps):
+            return start
+        for edge in sorted([e for e in (lo, hi) if numpy.isfinite(e) and
+                d * (e - start) > 0 and d * (e - end) <= 0],
+                key=lambda e: d * (e - start)):
+            if flag_ok(edge + eps):
+                return edge
+        return None
+
+    # Generate the index mark positions from start to end in direction d
+    def _marks(self, ax, start, end, d, limit=10000):
+        index, period = self.index[ax], self.index_period[ax]
+        if numpy.isnan(index):
+            return
+        if period <= 0:
+            if d * (index - start) >= 0 and d * (index - end) <= 0:
+                yield index
+            return
+        if d > 0:
+            k = math.ceil((start - index) / period)
+        else:
+            k = math.floor((start - index) / period)
+        for i in range(limit):
+            mark = index + k * period
+            if d * (mark - end) > 0:
+                return
+            yield mark
+            k += d
+
+    # Handle an axis reaching the end of its current leg
+    def _event(self, ax):
+        event = self.event[ax]
+        limits, capture = self.moves[ax]
+        ramp = self._ramp(ax)
+        if event == _HARDSTOP and capture is not None and capture[3]:
+            # in position trigger on following error, stops dead
+            self.hold[ax] = self.time + ramp
+            event = _TRIGGER
+        elif event == _TRIGGER:
+            # slowing down, going past the trigger and coming back to it
+            # takes 4 ramps longer than stopping dead and starting again
+            self.hold[ax] = self.time + 4 * ramp
+        if event == _TRIGGER:
+            # carry on to the post trigger position without a trigger
+            self.moves[ax] = (limits, None)
+            target = self.pos[ax] + capture[2]
+            if self.homing[ax]:
+                self.origin[ax] = target
+            direction = self.direction[ax]
+            self._plan(ax, target)
+            if self.direction[ax] == direction:
+                # no need to stop
+                self.hold[ax] = self.time
+            return
+        if event != _HARDSTOP and ramp > 0 and not self.settling[ax]:
+            # slow down before stopping
+            self.settling[ax] = True
+            self.hold[ax] = self.time + ramp
+            return
+        self.settling[ax] = False
+        self.moving[ax] = False
+        if event == _TARGET:
+            if self.homing[ax]:
+                self.homed[ax] = True
+        elif event == _LIMIT:
+            self.on_limit[ax] = True
+        elif event == _HARDSTOP:
+            self.ffe[ax] = True
+        self.homing[ax] = False
+
+# M variables that are mapped onto the axis model
+_mvars = {30: "on_limit", 42: "ffe", 45: "homed"}
+# Return True if I variable n is a Turbo PMAC countdown timer, these are
+# i5111, i5112, i5211 .. i6612
+def _is_timer(n):
+    return 5111 <= n <= 6612 and n % 100 in (11, 12)
+
+# online commands
+_motor_re = re.compile(r'#(\d+)')
+_command_re = re.compile(
+    r'J([+\-/])|J([=^])(\*|-?[\d.]+)(?:\^(-?[\d.]+))?|(HMZ)|(HM)|(K)', re.I)
+
+## A controller: a store of P, Q, I, M and macrostation variables, with the
+# motor M and I variables and online commands mapped onto an Axes model
+class Machine:
+    ## \param axes Axes object
+    # \param ms Dict of axis number -> macrostation number. Axes that aren't
+    # in it use the Geobrick i7mn2 and i7mn3 variables for their capture
+    # settings
+    # \param i10 Servo interrupt time, used for the timers
+    def __init__(self, axes, ms=None, i10=3713707):
+        self.axes = axes
+        self.ms = dict(ms or {})
+        ## Dicts of variable number -> value
+        self.vars = {"P": {}, "Q": {}, "I": {10: i10}, "M": {}}
+        ## Dict of (macrostation, variable number) -> value
+        self.msvars = {}
+        ## Dict of timer number -> time in ms it expires
+        self.timers = {}
+        ## Dict of variable -> name for variables that should be traced
+        self.watch = {}
+        ## List of (time, name, value) for changes to watched variables
+        self.trace = []
+
+    ## Set the geometry of an axis, see Axes.setup(), and its I variables
+    # \param ax Axis number
+    # \param jog_speed Jog speed (ixx22) in counts/ms
+    # \param home_speed Home speed (ixx23) in counts/ms, the sign gives hdir
+    # \param home_offset Home offset (ixx26) in counts
+    # \param capture Capture control (msyy,i912 or i7mn2)
+    # \param flag_select Capture flag select (msyy,i913 or i7mn3), 0 for the
+    # home flag, 1 for the high limit, 2 for the low limit
+    # \param geometry Other arguments for Axes.setup()
+    def setup_axis(self, ax, jog_speed=20, home_speed=-20, home_offset=0,
+            capture=2, flag_select=0, **geometry):
+        self.axes.setup(ax, **geometry)
+        i = self.vars["I"]
+        i[ax * 100 + 22] = jog_speed
+        i[ax * 100 + 23] = home_speed
+        i[ax * 100 + 26] = home_offset * 16
+        i[ax * 100 + 8] = 96
+        self.set_capture(ax, capture, flag_select)
+
+    ## Set the capture control and flag select of an axis
+    def set_capture(self, ax, capture, flag_select):
+        if ax in self.ms:
+            self.msvars[(self.ms[ax], 912)] = capture
+            self.msvars[(self.ms[ax], 913)] = flag_select
+        else:
+            self.vars["I"][self._capture_var(ax)] = capture
+            self.vars["I"][self._capture_var(ax) + 1] = flag_select
+
+    # Geobrick capture control variable of an axis
+    def _capture_var(self, ax):
+        return 7002 + ((ax - 1) / 4) * 100 + ((ax - 1) % 4 + 1) * 10
+
+    ## Return the (capture control, flag select) of an axis
+    def capture(self, ax):
+        if ax in self.ms:
+            return (self.msvars.get((self.ms[ax], 912), 0),
+                self.msvars.get((self.ms[ax], 913), 0))
+        var = self._capture_var(ax)
+        return self.vars["I"].get(var, 0), self.vars["I"].get(var + 1, 0)
+
+    ## Return the value of a variable
+    # \param letter One of "P", "Q", "I" or "M"
+    # \param n Variable number
+    def get(self, letter, n):
+        axes = self.axes
+        if letter == "M":
+            ax, num = divmod(n, 100)
+            if 0 < ax <= axes.n:
+                if num in _mvars:
+                    return int(getattr(axes, _mvars[num])[ax])
+                elif num == 40:
+                    return int(not axes.moving[ax] and not axes.ffe[ax])
+                elif num == 31:
+                    return int(axes.pos[ax] >= axes.lim_hi[ax])
+                elif num == 32:
+                    return int(axes.pos[ax] <= axes.lim_lo[ax])
+                elif num == 62:
+                    return axes.position(ax) * self.get("I", ax * 100 + 8) * 32
+                elif num == 72:
+                    return axes.jog[ax]
+        elif letter == "I" and n in self.timers:
+            return (self.timers[n] - axes.time) * 8388608.0 / \
+                self.vars["I"][10]
+        return self.vars[letter].get(n, 0)
+
+    ## Set the value of a variable
+    def set(self, letter, n, value):
+        if (letter, n) in self.watch:
+            self.trace.append((self.axes.time, self.watch[(letter, n)],
+                value))
+        if letter == "M":
+            ax, num = divmod(n, 100)
+            if 0 < ax <= self.axes.n:
+                if num == 45:
+                    self.axes.homed[ax] = bool(value)
+                    return
+                elif num == 72:
+                    self.axes.jog[ax] = value
+                    return
+        elif letter == "I" and _is_timer(n):
+            self.timers[n] = self.axes.time + \
+                value * self.vars["I"][10] / 8388608.0
+            return
+        self.vars[letter][n] = value
+
+    ## Read a macrostation variable
+    def ms_read(self, ms, n):
+        return self.msvars.get((ms, n), 0)
+
+    ## Write a macrostation variable
+    def ms_write(self, ms, n, value):
+        self.msvars[(ms, n)] = value
+
+    ## Return the time in ms until the next timer expires or axis event, or
+    # inf if nothing will happen
+    def time_to_event(self):
+        now = self.axes.time
+        times = [t - now for t in self.timers.values() if t > now]
+        return min(times + [self.axes.time_to_event()])
+
+    ## Run an online command string like "#1J^*^1000 #2hm"
+    def command(self, text):
+        ax = None
+        pos = 0
+        text = text.strip()
+        while pos < len(text):
+            if text[pos].isspace():
+                pos += 1
+                continue
+            match = _motor_re.match(text, pos)
+            if match:
+                ax = int(match.group(1))
+                pos = match.end()
+                continue
+            match = _command_re.match(text, pos)
+            if not match or ax is None:
+                raise SimulationError("Can't simulate command %r" % text)
+            self._motor_command(ax, *match.groups())
+            pos = match.end()
+
+    # Run a single command on a motor
+    def _motor_command(self, ax, jog, jtype, value, post, hmz, hm, kill):
+        axes = self.axes
+        i = lambda n: self.get("I", ax * 100 + n)
+        limits = not int(i(24)) & 0x20000
+        speed = abs(i(22))
+        if jog == "/":
+            axes.halt(ax)
+        elif jog:
+            axes.move(ax, float(jog + "1") * numpy.inf, speed, limits)
+        elif jtype:
+            if value == "*":
+                value = axes.jog[ax]
+            else:
+                value = float(value)
+            if jtype == "=":
+                target = axes.origin[ax] + value
+            else:
+                target = axes.pos[ax] + value
+            capture = None
+            if post is not None:
+                capture = self.capture(ax) + (float(post), int(i(97)) & 1)
+            axes.move(ax, target, speed, limits, capture)
+        elif hmz:
+            axes.zero(ax)
+        elif hm:
+            capture = self.capture(ax) + (i(26) / 16.0, False)
+            axes.move(ax, numpy.sign(i(23)) * numpy.inf, abs(i(23)), limits,
+                capture, home=True)
+        elif kill:
+            axes.halt(ax)
+
+# Functions allowed in expressions, PMAC trig functions work in degrees
+_functions = {
+    "ABS": "abs", "INT": "_int", "SQRT": "math.sqrt", "EXP": "math.exp",
+    "LN": "math.log", "SIN": "_sin", "COS": "_cos", "TAN": "_tan",
+    "ASIN": "_asin", "ACOS": "_acos", "ATAN": "_atan"}
+_namespace = {
+    "math": math, "_int": lambda x: float(math.floor(x)),
+    "_sin": lambda x: math.sin(math.radians(x)),
+    "_cos": lambda x: math.cos(math.radians(x)),
+    "_tan": lambda x: math.tan(math.radians(x)),
+    "_asin": lambda x: math.degrees(math.asin(x)),
+    "_acos": lambda x: math.degrees(math.acos(x)),
+    "_atan": lambda x: math.degrees(math.atan(x))}
+_expr_token_re = re.compile(r'\s*(?:(\$[0-9A-Fa-f]+)|(\d+\.?\d*|\.\d+)|'
+    r'([A-Za-z_]\w*)|(!=|<>|<=|>=|!<|!>|[-+*/%&|^=<>(),]))')
+_comparisons = {"=": "==", "!=": "!=", "<>": "!=", "<": "<", ">": ">",
+    "<=": "<=", ">=": ">=", "!<": ">=", "!>": "<="}
+_var_name_re = re.compile(r'([PMIQpmiq])(\d*)$')
+
+# Translate a PMAC expression into python source, using v(letter, n) to read
+# variables
+class _Translator:
+    def __init__(self, text):
+        self.text = text
+        self.tokens = []
+        pos = 0
+        text = text.rstrip()
+        while pos < len(text):
+            match = _expr_token_re.match(text, pos)
+            if not match:
+                self.error()
+            hexnum, num, word, op = match.groups()
+            if hexnum:
+                self.tokens.append(("num", str(int(hexnum[1:], 16))))
+            elif num:
+                self.tokens.append(("num", num))
+            elif word:
+                self.tokens.append(("word", word))
+            else:
+                self.tokens.append(("op", op))
+            pos = match.end()
+        self.tokens.append(("end", None))
+        self.pos = 0
+
+    def error(self):
+        raise SimulationError("Can't simulate expression %r" % self.text)
+
+    def peek(self):
+        return self.tokens[self.pos]
+
+    def take(self, value=None):
+        token = self.tokens[self.pos]
+        if value is not None and token[1] != value:
+            self.error()
+        self.pos += 1
+        return token
+
+    def translate(self, condition=False):
+        if condition:
+            out = self.logic()
+        else:
+            out = self.sum()
+        if self.peek()[0] != "end":
+            self.error()
+        return out
+
+    def logic(self):
+        terms = [self.conjunction()]
+        while self.peek()[1] and self.peek()[1].lower() == "or":
+            self.take()
+            terms.append(self.conjunction())
+        return " or ".join(terms)
+
+    def conjunction(self):
+        terms = [self.comparison()]
+        while self.peek()[1] and self.peek()[1].lower() == "and":
+            self.take()
+            terms.append(self.comparison())
+        return "(%s)" % " and ".join(terms)
+
+    def comparison(self):
+        if self.peek()[1] == "(":
+            # might be a bracketed condition rather than an expression
+            start = self.pos
+            self.take()
+            out = self.logic()
+            if self.peek()[1] == ")":
+                self.take()
+                following = self.peek()[1]
+                if following is None or following == ")" or \
+                        following.lower() in ("and", "or"):
+                    return "(%s)" % out
+            self.pos = start
+        left = self.sum()
+        op = self.peek()[1]
+        if op not in _comparisons:
+            return left
+        self.take()
+        return "(%s %s %s)" % (left, _comparisons[op], self.sum())
+
+    def sum(self):
+        out = self.term()
+        while self.peek()[1] in ("+", "-", "|", "^"):
+            op = self.take()[1]
+            right = self.term()
+            if op in "|^":
+                out = "(int(%s) %s int(%s))" % (out, op, right)
+            else:
+                out = "(%s %s %s)" % (out, op, right)
+        return out
+
+    def term(self):
+        out = self.unary()
+        while self.peek()[1] in ("*", "/", "%", "&"):
+            op = self.take()[1]
+            right = self.unary()
+            if op == "&":
+                out = "(int(%s) & int(%s))" % (out, right)
+            else:
+                out = "(%s %s %s)" % (out, op, right)
+        return out
+
+    def unary(self):
+        if self.peek()[1] in ("-", "+"):
+            return "(%s%s)" % (self.take()[1], self.unary())
+        return self.atom()
+
+    def atom(self):
+        kind, value = self.take()
+        if kind == "num":
+            return "%s.0" % value.rstrip(".") if "." not in value else value
+        if kind == "op" and value == "(":
+            out = self.sum()
+            self.take(")")
+            return "(%s)" % out
+        if kind == "word":
+            match = _var_name_re.match(value)
+            if match and match.group(2):
+                return "v(%r, %d)" % (match.group(1).upper(),
+                    int(match.group(2)))
+            if match and self.peek()[1] == "(":
+                self.take()
+                index = self.sum()
+                self.take(")")
+                return "v(%r, int(%s))" % (match.group(1).upper(), index)
+            if value.upper() in _functions and self.peek()[1] == "(":
+                self.take()
+                arg = self.sum()
+                self.take(")")
+                return "%s(%s)" % (_functions[value.upper()], arg)
+        self.error()
+
+# Compile a PMAC expression to a function of v(letter, n). The generated
+# PLCs repeat a lot of conditions, so remember the ones we've done
+_compiled = {}
+def _compile(text, condition=False):
+    if (text, condition) not in _compiled:
+        source = _Translator(text).translate(condition)
+        code = compile("lambda v: " + source, text, "eval",
+            __future__.division.compiler_flag)
+        _compiled[(text, condition)] = eval(code, _namespace)
+    return _compiled[(text, condition)]
+
+_target_re = re.compile(r'([PMIQpmiq])(?:(\d+)|\((.*)\))$')
+_msvar_re = re.compile(r'MS([RW])(\d+),[iI](\d+),([PMIQpmiq])(\d+)$', re.I)
+
+## A PLC program compiled from the text of a pmc file
+class Program:
+    ## \param text Contents of the pmc file
+    # \param filename Filename for error messages
+    def __init__(self, text, filename="<string>"):
+        parser = Parser()
+        statements = parser.parse(text, filename)
+        ## Dict of \#define values
+        self.defines = parser.defines
+        ## List of statements run when the file is downloaded
+        self.online = []
+        ## List of ops in the PLC, and the PLC number
+        self.ops = []
+        self.plc = None
+        inside = False
+        blocks = []
+        i = 0
+        while i < len(statements):
+            s = statements[i]
+            i += 1
+            if s.kind in ("define", "include"):
+                continue
+            if s.kind == "open":
+                inside = True
+                self.plc = s.cond.upper().replace(" CLEAR", "").strip()
+                continue
+            if s.kind == "close":
+                inside = False
+                continue
+            if not inside:
+                self.online.append(self._op(s))
+                continue
+            if s.kind in ("if", "while"):
+                # gather the and/or lines that continue the condition
+                cond = ["(%s)" % s.cond]
+                while i < len(statements) and \
+                        statements[i].kind in ("and", "or"):
+                    cond.append("%s (%s)" % (statements[i].kind,
+                        statements[i].cond))
+                    i += 1
+                try:
+                    fn = _compile(" ".join(cond), condition=True)
+                except SimulationError, e:
+                    raise SimulationError("%s:%d: %s" % (s.filename, s.line,
+                        e))
+                op = [s.kind, fn, None, s]
+                self.ops.append(op)
+                if s.inline:
+                    self.ops.append(self._op(s.inline))
+                    if s.kind == "while":
+                        self.ops.append(["endwhile", len(self.ops) - 2, None, s])
+                    op[2] = len(self.ops)
+                else:
+                    blocks.append(op)
+            elif s.kind == "else":
+                if not blocks or blocks[-1][0] != "if":
+                    raise SimulationError("%s:%d: else without if" % (
+                        s.filename, s.line))
+                op = ["else", None, None, s]
+                self.ops.append(op)
+                blocks[-1][2] = len(self.ops)
+                if s.inline:
+                    self.ops.append(self._op(s.inline))
+                    op[2] = len(self.ops)
+                    blocks.pop()
+                else:
+                    blocks[-1] = op
+            elif s.kind in ("endif", "endwhile"):
+                if not blocks or \
+                        blocks[-1][0] not in (s.kind[3:], "else") or \
+                        (s.kind == "endwhile" and blocks[-1][0] == "else"):
+                    raise SimulationError("%s:%d: unmatched %s" % (
+                        s.filename, s.line, s.kind))
+                op = blocks.pop()
+                if s.kind == "endwhile":
+                    self.ops.append(["endwhile", self.ops.index(op), None, s])
+                op[2] = len(self.ops)
+            else:
+                self.ops.append(self._op(s))
+        if blocks:
+            s = blocks[-1][3]
+            raise SimulationError("%s:%d: %s is not closed" % (s.filename,
+                s.line, s.kind))
+
+    # Make an op for a simple statement
+    def _op(self, s):
+        if s.kind == "assign":
+            match = _target_re.match(s.target)
+            if match:
+                letter, num, index = match.groups()
+                letter = letter.upper()
+                try:
+                    expr = _compile(s.expr)
+                    if index is not None:
+                        index = _compile(index)
+                except SimulationError, e:
+                    raise SimulationError("%s:%d: %s" % (s.filename, s.line,
+                        e))
+                if index is None:
+                    return ["assign", (letter, int(num)), expr, s]
+                return ["assign", (letter, index), expr, s]
+        elif s.kind == "cmd":
+            return ["cmd", s.cond, None, s]
+        elif s.kind == "disable":
+            if s.cond.upper().replace(" ", "") == self.plc:
+                return ["disable", None, None, s]
+        elif s.kind == "other":
+            match = _msvar_re.match(s.text)
+            if match:
+                rw, ms, n, letter, num = match.groups()
+                return ["ms" + rw.lower(), (int(ms), int(n)),
+                    (letter.upper(), int(num)), s]
+        raise SimulationError("%s:%d: Can't simulate %r" % (s.filename,
+            s.line, s.text))
+
+## Results of a simulation
+class Result:
+    def __init__(self):
+        ## Final HomingStatus and HomingState names, e.g. "Done" and "Done"
+        self.status = None
+        self.state = None
+        ## Time in ms from enabling the PLC until it finished
+        self.time = 0
+        ## True if the PLC finished, False if it got stuck or ran out of time
+        self.finished = False
+        ## List of (time, name, value) for each change of HomingGroup,
+        ## HomingState and HomingStatus
+        self.trace = []
+        ## Dict of axis number -> final motor position
+        self.positions = {}
+        ## Dict of axis number -> physical position of motor position 0 if
+        ## the axis was homed, or None
+        self.homes = {}
+
+    ## Return a list of (time, group, state) for each state that was entered
+    def phases(self):
+        out = []
+        group = 0
+        for t, name, value in self.trace:
+            if name == "HomingGroup":
+                group = value
+            elif name == "HomingState":
+                out.append((t, group, value))
+        return out
+
+## Run a homing Program on a Machine
+# \param program Program object
+# \param machine Machine object, with its axes set up
+# \param group Homing group to run, 1 for all groups
+# \param debug If True then run in debug mode, continuing after each pause
+# \param scan Time in ms between background PLC scans
+# \param max_time Maximum time in ms to simulate
+# \return Result object
+def run(program, machine, group=1, debug=False, scan=1.0, max_time=3.6e6):
+    names = {}
+    for prefix in ("Status", "State"):
+        names[prefix] = dict((float(v), k[len(prefix):]) for k, v in
+            program.defines.items() if k.startswith(prefix) and
+            re.match(r'-?\d+$', v))
+    pvars = {}
+    for name in ("HomingGroup", "HomingState", "HomingStatus"):
+        match = _target_re.match(program.defines.get(name, ""))
+        if match is None or match.group(2) is None:
+            raise SimulationError("%s is not defined in the PLC" % name)
+        pvars[name] = ("P", int(match.group(2)))
+        machine.watch[pvars[name]] = name
+    v = machine.get
+    for op in program.online:
+        _exec(op, machine, v)
+    del machine.trace[:]
+    machine.set("P", pvars["HomingGroup"][1], group)
+    if debug:
+        machine.set("P", pvars["HomingStatus"][1],
+            float(program.defines["StatusDebugHoming"]))
+    start = machine.axes.time
+    paused = float(program.defines.get("StatusPaused", -1))
+    ops = program.ops
+    pc = 0
+    result = Result()
+    while pc < len(ops):
+        kind, a, b, s = op = ops[pc]
+        try:
+            if kind in ("if", "while"):
+                if a(v):
+                    pc += 1
+                else:
+                    pc = b
+            elif kind == "else":
+                pc = b
+            elif kind == "endwhile":
+                # end of this scan, wait for the next one
+                if machine.axes.time - start >= max_time:
+                    break
+                dt = scan
+                if a == pc - 1:
+                    # empty loop, nothing changes until the next event
+                    if debug and v(*pvars["HomingStatus"]) == paused:
+                        # press continue
+                        machine.set("P", pvars["HomingStatus"][1],
+                            float(program.defines["StatusDebugHoming"]))
+                    else:
+                        dt = machine.time_to_event()
+                        if dt == numpy.inf:
+                            break
+                        dt = max(scan, math.ceil(dt / scan - 1e-9) * scan)
+                machine.axes.advance(dt)
+                pc = a
+            elif kind == "disable":
+                result.finished = True
+                break
+            else:
+                _exec(op, machine, v)
+                pc += 1
+        except (ZeroDivisionError, ValueError, OverflowError), e:
+            raise SimulationError("%s:%d: %s" % (s.filename, s.line, e))
+    else:
+        result.finished = True
+    result.time = machine.axes.time - start
+    result.status = names["Status"].get(v(*pvars["HomingStatus"]))
+    result.state = names["State"].get(v(*pvars["HomingState"]))
+    for t, name, value in machine.trace:
+        if name == "HomingStatus":
+            value = names["Status"].get(value, value)
+        elif name == "HomingState":
+            value = names["State"].get(value, value)
+        else:
+            value = int(value)
+        result.trace.append((t - start, name, value))
+    axes = machine.axes
+    for ax in range(1, axes.n + 1):
+        result.positions[ax] = axes.position(ax)
+        if axes.homed[ax]:
+            result.homes[ax] = axes.origin[ax]
+        else:
+            result.homes[ax] = None
+    return result
+
+# Run a simple op
+def _exec(op, machine, v):
+    kind, a, b, s = op
+    if kind == "assign":
+        letter, n = a
+        if not isinstance(n, int):
+            n = int(n(v))
+        machine.set(letter, n, b(v))
+    elif kind == "cmd":
+        machine.command(a)
+    elif kind == "msr":
+        machine.set(b[0], b[1], machine.ms_read(*a))
+    elif kind == "msw":
+        machine.ms_write(a[0], a[1], v(*b))
+    else:
+        raise SimulationError("%s:%d: Can't simulate %r outside a PLC" % (
+            s.filename, s.line, s.text))
+
+## Simulate homing with a motorhome.PLC object
+# \param plc motorhome.PLC object
+# \param layout Dict of axis number -> dict of arguments for
+# Machine.setup_axis()
+# \param kwargs Other arguments for run()
+# \return Result object
+def simulate(plc, layout, **kwargs):
+    program = Program(plc.render(), "PLC%d" % plc.plc)
+    ms = dict((m.ax, m.ms) for m in plc.motors if hasattr(m, "ms"))
+    machine = Machine(Axes(max([32] + layout.keys())), ms)
+    for ax, args in layout.items():
+        machine.setup_axis(ax, **args)
+    return run(program, machine, **kwargs)
+
+if __name__ == "__main__":
+    import motorhome
+    # Check each htype homes on the expected edge. The home flag is active
+    # between 0 and 5000, hdir is -ve
+    layouts = {
+        motorhome.HOME: dict(flag=(0, 5000)),
+        motorhome.LIMIT: dict(lim=(-50000, 50000), flag_select=2),
+        motorhome.HSW: dict(flag=(0, 5000), lim=(-50000, 50000)),
+        motorhome.HSW_HLIM: dict(flag=(0, 5000), lim=(-50000, 50000)),
+        motorhome.HSW_DIR: dict(flag=(None, 5000), lim=(-50000, 50000)),
+        motorhome.RLIM: dict(lim=(-50000, 50000), flag_select=2,
+            capture=10, home_speed=20),
+        motorhome.NOTHING: dict(),
+        motorhome.HSW_HSTOP: dict(flag=(0, 5000), stops=(-50000, 50000))}
+    for htype, layout in sorted(layouts.items()):
+        for pos in (-20000, 2000, 20000):
+            plc = motorhome.PLC(11, timeout=100000)
+            plc.add_motor(1, htype=htype, jdist=0)
+            result = simulate(plc, {1: dict(layout, pos=pos)})
+            print "%-10s start %6d: %-8s in %8.1f ms, home %s" % (
+                motorhome.htypes_str[htype], pos, result.status, result.time,
+                result.homes[1])
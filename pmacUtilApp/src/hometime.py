@@ -0,0 +1,180 @@
+#!/usr/bin/env dls-python
+## \namespace hometime
+# This contains functions to predict how long the homing PLCs made by
+# \ref motorhome will take, e.g. to plan homing a whole beamline after a
+# shutdown.
+#
+# The PLC is run in the \ref homesim simulator against a model of each axis
+# with its velocity, acceleration, travel and flag positions. This gives the
+# duration of each phase (PreHomeMove, FastSearch, FastRetrace, Homing and
+# PostHomeMove) for each group. Groups are homed one after the other, and
+# the motors in a group move together, so the time for a group is set by its
+# slowest motor.
+#
+# Example:
+# \verbatim
+# from motorhome import PLC, HSW, LIMIT
+# from hometime import predict
+# plc = PLC(11, timeout=100000)
+# plc.add_motor(1, group=2, htype=HSW)
+# plc.add_motor(2, group=3, htype=LIMIT)
+# print predict(plc, {
+#     1: dict(jog_speed=20, accel=0.1, lim=(-50000, 50000), flag=(0, 5000)),
+#     2: dict(jog_speed=10, accel=0.1, lim=(-20000, 20000), flag_select=2)},
+#     starts=[0, 0.5, 1])
+# \endverbatim
+# Times are in ms. The model is approximate, see \ref homesim for what is
+# left out. The per axis settings can also be given as a "model" dict for
+# each motor in a \ref motorhome_batch manifest, then
+# \verbatim
+#   dls-python hometime.py iocs/pmc_builder/homing.json
+# \endverbatim
+# prints a prediction for each PLC in the manifest.
+
+import sys
+from optparse import OptionParser
+
+from homesim import simulate
+
+## Names of the homing phases, in the order they happen
+phases = ["PreHomeMove", "FastSearch", "FastRetrace", "Homing",
+    "PostHomeMove"]
+
+## Predicted homing time of a PLC
+class Prediction:
+    def __init__(self, name="PLC"):
+        ## Name to print
+        self.name = name
+        ## List of group numbers in the order they are homed
+        self.groups = []
+        ## Dict of group -> dict of phase name -> duration in ms
+        self.phases = {}
+        ## Dict of group -> duration in ms, including the time between phases
+        self.durations = {}
+        ## Total duration in ms
+        self.total = 0
+        ## Final HomingStatus of the simulation, should be "Done"
+        self.status = None
+
+    ## Make a Prediction from a homesim.Result
+    def add_result(self, result):
+        self.status = result.status
+        self.total = result.time
+        trace = result.phases() + [(result.time, None, None)]
+        for (t, group, state), (end, next_group, x) in zip(trace, trace[1:]):
+            if state not in phases:
+                continue
+            if group not in self.phases:
+                self.groups.append(group)
+                self.phases[group] = {}
+                self.durations[group] = 0
+            self.phases[group][state] = \
+                self.phases[group].get(state, 0) + end - t
+            self.durations[group] += end - t
+
+    ## Combine with another Prediction, keeping the longest time for each
+    # phase, group and total
+    def worst(self, other):
+        for group in other.groups:
+            if group not in self.phases:
+                self.groups.append(group)
+                self.phases[group] = {}
+                self.durations[group] = 0
+            for state, t in other.phases[group].items():
+                self.phases[group][state] = max(t,
+                    self.phases[group].get(state, 0))
+            self.durations[group] = max(self.durations[group],
+                other.durations[group])
+        self.total = max(self.total, other.total)
+        if self.status in (None, "Done"):
+            self.status = other.status
+
+    def __str__(self):
+        lines = ["%s: %.1f s, status %s" % (self.name, self.total / 1000.0,
+            self.status)]
+        lines.append("  %-6s" % "group" + "".join(["%13s" % p for p in
+            phases]) + "%13s" % "total")
+        for group in self.groups:
+            line = "  %-6d" % group
+            for p in phases:
+                if p in self.phases[group]:
+                    line += "%13.1f" % (self.phases[group][p] / 1000.0)
+                else:
+                    line += "%13s" % "-"
+            lines.append(line + "%13.1f" % (self.durations[group] / 1000.0))
+        return "\n".join(lines)
+
+## Predict how long a PLC will take to home
+# \param plc motorhome.PLC object
+# \param axes Dict of axis number -> dict of arguments for
+# homesim.Machine.setup_axis(). The important ones are jog_speed, home_speed
+# (in counts/ms), accel (in counts/ms^2), lim (the travel), flag and pos
+# \param starts If given, a list of start positions as a fraction of the
+# travel of each axis, 0 for the low limit and 1 for the high limit. All the
+# axes start at the same fraction, and the longest time for each phase is
+# returned
+# \param kwargs Other arguments for homesim.run()
+# \return Prediction object
+def predict(plc, axes, starts=None, **kwargs):
+    prediction = Prediction("PLC%d" % plc.plc)
+    if starts is None:
+        prediction.add_result(simulate(plc, axes, **kwargs))
+        return prediction
+    for start in starts:
+        layout = {}
+        for ax, args in axes.items():
+            lo, hi = _travel(ax, args)
+            layout[ax] = dict(args, pos=lo + (hi - lo) * start)
+        p = Prediction()
+        p.add_result(simulate(plc, layout, **kwargs))
+        prediction.worst(p)
+    return prediction
+
+# Return the (low, high) travel of an axis from its limits or hard stops
+def _travel(ax, args):
+    travel = []
+    for i in range(2):
+        for key in ("lim", "stops"):
+            if key in args and args[key][i] is not None:
+                travel.append(args[key][i])
+                break
+        else:
+            raise ValueError("Axis %d has no limit or hard stop to give its "
+                "travel" % ax)
+    return travel
+
+def main():
+    import motorhome_batch
+    parser = OptionParser("usage: %prog [options] <manifest>\n"
+        "Predict how long the homing PLCs in a motorhome_batch manifest will "
+        "take. Each motor needs a \"model\" dict of arguments for "
+        "homesim.Machine.setup_axis()")
+    parser.add_option("-s", "--starts", default=None,
+        help="Comma separated list of start positions to try as a fraction "
+        "of the travel, e.g. 0,0.5,1")
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("Incorrect number of arguments")
+    starts = None
+    if options.starts:
+        starts = [float(x) for x in options.starts.split(",")]
+    total = 0
+    for entry in motorhome_batch.load_manifest(args[0]):
+        # an axis can have more than one entry, e.g. a NOTHING post-move
+        motors = entry["motors"]
+        if [m for m in motors if "model" not in m]:
+            sys.stderr.write("***Error: not all motors of PLC%d in %s have "
+                "a model\n" % (entry["plc"], entry["controller"]))
+            sys.exit(1)
+        axes = {}
+        for m in motors:
+            axes.setdefault(m["axis"], m["model"])
+        prediction = predict(motorhome_batch.make_plc(entry), axes, starts)
+        prediction.name = "%s PLC%d %s" % (entry["controller"], entry["plc"],
+            entry["name"])
+        print prediction
+        total += prediction.total
+    print "Total: %.1f s" % (total / 1000.0)
+
+if __name__ == "__main__":
+    main()
@@ -12,7 +12,7 @@
 # - Jog until xx = the <tt>#\<axis\>J^\<jdist\></tt> command. This tells the 
 # pmac to jog until it sees the home flag, then move jdist counts
 
-import sys, re
+import sys, re, os, hashlib
 
 # Setup some Homing types
 ## Dumb home, shouldn't be needed (htype Enum passed to PLC.add_motor()).
@@ -142,12 +142,22 @@ BRICK = 1
 ## The distance in counts to move when doing large moves
 LARGEJ = 100000000
 
-## Helper function that parses the filename.
-# Expects sys.argv[1] to be of the form \c PLC<num>_<name>_HM.pmc
-# \return (num, name, filename)
-def parse_args():
+# Return the md5 of the source of this module
+def _generator_version():
+    source = os.path.splitext(__file__)[0] + ".py"
+    if not os.path.exists(source):
+        source = __file__
+    return hashlib.md5(open(source, "rb").read()).hexdigest()
+
+## Version of the code generator, a hash of motorhome.py itself. This is
+# part of PLC.signature() so cached PLCs are made again if motorhome changes
+generator_version = _generator_version()
+
+## Helper function that parses a homing plc filename.
+# Expects filename to be of the form \c PLC<num>_<name>_HM.pmc
+# \return (num, name)
+def parse_filename(filename):
     # find the plc number and name from the filename
-    filename = sys.argv[1]
     result = re.search(r"PLC(\d+)_(.*)_HM\.pmc", filename)
     if result is not None:
         num, name = result.groups()
@@ -155,25 +165,58 @@ def parse_args():
         sys.stderr.write(
             "***Error: Incorrectly formed homing plc filename: %s\n" % filename)
         sys.exit(1)
-    return int(num), name, filename     
+    return int(num), name
+
+## Helper function that parses the filename.
+# Expects sys.argv[1] to be of the form \c PLC<num>_<name>_HM.pmc
+# \return (num, name, filename)
+def parse_args():
+    filename = sys.argv[1]
+    num, name = parse_filename(filename)
+    return num, name, filename     
+
+## Helper function that makes and writes a number of homing plcs in a single
+# process, so that a whole controller (or beamline) can be generated without
+# restarting python for each plc.
+# \param make_plc Function that takes (num, name) and returns a configured PLC
+# object, or None if it doesn't know how to make a plc with that name
+# \param filenames List of filenames of the form \c PLC<num>_<name>_HM.pmc,
+# defaults to sys.argv[1:]
+# \param cache Directory to cache generated PLCs in, see PLC.write(). 
+# Defaults to the MOTORHOME_CACHE environment variable if set
+def write_plcs(make_plc, filenames=None, cache=None):
+    if cache is None:
+        cache = os.environ.get("MOTORHOME_CACHE")
+    if filenames is None:
+        filenames = sys.argv[1:]
+    for filename in filenames:
+        num, name = parse_filename(filename)
+        plc = make_plc(num, name)
+        if plc is None:
+            sys.stderr.write(
+                "***Error: Can't make homing PLC %d for %s\n" % (num, name))
+            sys.exit(1)
+        plc.write(filename, cache)
 
 ## Object that encapsulates everything we need to know about a motor
 class Motor:
     PHASE_PRE_HOME_MOVE = 0
     PHASE_FAST_SEARCH = 1
     PHASE_FAST_RETRACE = 2
-    instances = []
-    def __init__(self, ax, enc_axes, ctype, ms=None):
+    # instances is the list of motors owned by the PLC this motor belongs to
+    def __init__(self, ax, enc_axes, ctype, ms=None, instances=None):
+        if instances is None:
+            instances = []
         # Axis number
         self.ax = int(ax)
         # Each time we create a motor store its index
-        self.i = len(self.instances)
+        self.i = len(instances)
         self.isHomed = False
-        assert ax not in [m.ax for m in self.instances], \
+        assert ax not in [m.ax for m in instances], \
             "Motor object already exists for axis %d" % ax
         # Add this instance to list of motor instances
-        self.instances.append(self)
-        assert len(self.instances) < 16, \
+        instances.append(self)
+        assert len(instances) <= 16, \
             "Only 16 motors may be defined in a single PLC"     
         # Add encoder axes to be zeroed
         self.enc_axes = enc_axes
@@ -194,6 +237,8 @@ class Motor:
         self.jdist = None
         self.jdist_default = None
         self.jdist_overrides = None
+        # jog speed for the search, or None to use ixx22
+        self.search_speed = None
 
     ## Pick a predefined override for jdist from the self.jdist_override tuple.
     # \param phase_code The phase code specified as a number.
@@ -223,23 +268,90 @@ class Group:
         self.checks = checks
         # list of actions
         self.actions = []
+        # dict of htype -> [(action index, motor)], made by freeze()
+        self.index = None
 
     def addMotor(self, motor, htype, post):
         self.actions.append((motor, htype, post))        
+        # the index needs to be made again
+        self.index = None
+
+    ## Build the index of htype to motors, and the InPosition and following
+    # error expressions that are used for every move in this group. This is
+    # done before the group is written, so selecting motors doesn't need to
+    # scan the list of actions each time
+    def freeze(self):
+        if self.index is not None:
+            return
+        self.index = {}
+        for i, (motor, htype, post) in enumerate(self.actions):
+            self.index.setdefault(htype, []).append((i, motor))
+        self.__selections = {}
+        self.__expressions = {}
+        ## Expression that is non-zero when all motors are in position
+        self.InPosition = self.expression("m%d40", "&")
+        ## Expression that is non-zero when any motor has a following error
+        self.FFErr = self.expression("m%d42", "|")
+
+    ## Return a list of the motors in this group with an htype in htypes, or
+    # all motors if htypes is None. They are returned in the order they were
+    # added
+    def select(self, htypes=None):
+        self.freeze()
+        if htypes is None:
+            key = None
+        else:
+            key = frozenset(htypes)
+        if key not in self.__selections:
+            if key is None:
+                motors = [m for m, htype, post in self.actions]
+            else:
+                selected = []
+                for htype in key:
+                    selected += self.index.get(htype, [])
+                motors = [m for i, m in sorted(selected)]
+            self.__selections[key] = motors
+        return self.__selections[key]
+
+    ## Return fmt % axis for each motor in select(htypes), joined by sep
+    def expression(self, fmt, sep, htypes=None):
+        self.freeze()
+        if htypes is None:
+            key = (fmt, sep, None)
+        else:
+            key = (fmt, sep, frozenset(htypes))
+        if key not in self.__expressions:
+            self.__expressions[key] = sep.join(
+                [fmt % m.ax for m in self.select(htypes)])
+        return self.__expressions[key]
 
 ## Create an object that can create a homing PLC for some motors.
 # \param plc plc number (any free plc number on the PMAC)
 # \param timeout timout for any move in ms
 # \param ctype The controller type, will be PMAC (=0) or GEOBRICK (=1)
+# \param resume P variable number to enable resume mode, or None. In resume
+# mode the PLC keeps a record of the groups it has started and completed in
+# this P variable, and uses the next one to store the motors it can skip. If a
+# run fails or is aborted then the next run skips the groups that completed,
+# and in the group that was interrupted it only homes the motors that don't
+# have their home complete bit (m\<axis\>45) set. Skipped motors don't do
+# their post home move. The record is cleared when a run completes, or can be
+# cleared by hand to home everything again
+# \param speed_vars First of 16 P variables used to save the jog speeds
+# (ixx22) of motors with a search_speed, see add_motor()
 #
 # All other parameters setup defaults that can be overridden for a particular
 # motor in add_motor()
 class PLC:       
     def __init__(self, plc, timeout=600000, htype=HOME, jdist=0, post=None,
-            ctype=PMAC, allow_debug=True):
+            ctype=PMAC, allow_debug=True, resume=None, search_speed=None,
+            speed_vars=None):
         ## Dict of group objects created when a motor is added to a group,
         ## indexed by group number
         self.groups = {}
+        ## List of Motor objects added to this PLC, in the order they were
+        ## added (Motor.i is the index into this list)
+        self.motors = []
         ## plc number
         self.plc = int(plc)
         self.timeout = timeout
@@ -257,6 +369,37 @@ class PLC:
         self.__cmd2 = []
         self.__cmd3 = []  # Commands executed after movement
         self.allow_debug = allow_debug
+        ## P variable number for resume mode, or None
+        if resume is not None:
+            resume = int(resume)
+            assert 0 <= resume < 8191, "Resume P variable %d not in range " \
+                "0..8190" % resume
+            # resume and resume+1 must not be one of this PLC's own P vars
+            assert resume + 1 < self.plc * 100 or \
+                resume >= self.plc * 100 + 100, "Resume P variables " \
+                "%d..%d overlap P%d00..%d99 of PLC%d" % (resume, resume + 1,
+                self.plc, self.plc, self.plc)
+        self.resume = resume
+        ## Default search speed for any motor added, see add_motor()
+        self.search_speed = search_speed
+        ## First P variable of the saved jog speeds, or None
+        if speed_vars is not None:
+            speed_vars = int(speed_vars)
+            assert 0 <= speed_vars <= 8176, "First speed P variable %d not " \
+                "in range 0..8176" % speed_vars
+            # the 16 saved speeds must not be this PLC's own P vars or resume
+            assert speed_vars + 15 < self.plc * 100 or \
+                speed_vars >= self.plc * 100 + 100, "Speed P variables " \
+                "%d..%d overlap P%d00..%d99 of PLC%d" % (speed_vars,
+                speed_vars + 15, self.plc, self.plc, self.plc)
+            assert resume is None or resume + 1 < speed_vars or \
+                resume > speed_vars + 15, "Speed P variables %d..%d overlap " \
+                "resume P variables %d..%d" % (speed_vars, speed_vars + 15,
+                resume, resume + 1)
+        self.speed_vars = speed_vars
+        ## Dict of group -> list of the numbers of other PLCs that home part of
+        ## that group, started and waited for by this PLC. Set by SplitPLC
+        self.workers = {}
         ## The controller type, will be PMAC or GEOBRICK
         self.ctype = ctype
         if self.ctype == PMAC:
@@ -335,20 +478,27 @@ class PLC:
     # - "H": go to the hardware high limit
     # - "L": go to the hardware low limit
     # \param ms Override value for the macrostation associated with this axis 
+    # \param search_speed Jog speed in counts/ms for the prehome move and fast
+    # search, or None to use ixx22. This lets a long travel axis search
+    # quickly, then do the fast retrace off the trigger at its ixx22 speed
+    # before the home move. ixx22 is saved in the P variables given by
+    # speed_vars in PLC(), and restored for the fast retrace and at the end
     def add_motor(self, axis, group=1, htype=None, jdist=None, jdist_overrides=None, post=None,
-            enc_axes=[], ms = None):
+            enc_axes=[], ms = None, search_speed=None):
         # Override defaults
         if htype == None: htype = self.htype
         if jdist == None: jdist = self.jdist
         if post == None: post = self.post                
+        if search_speed == None: search_speed = self.search_speed
         # If we need to add a motor
         motor = None
-        for m in Motor.instances:
+        for m in self.motors:
             if m.ax == axis:
                 motor = m
         if motor == None:
             # this object contains info about a particular motor 
-            motor = Motor(ax=axis, enc_axes=enc_axes, ctype=self.ctype, ms=ms)
+            motor = Motor(ax=axis, enc_axes=enc_axes, ctype=self.ctype, ms=ms,
+                instances=self.motors)
         # If this is a homing operation, make sure motor isn't already homed in 
         # an earlier op
         if htype != NOTHING:
@@ -356,6 +506,14 @@ class PLC:
                 "Two homing operations requested for axis %d" % axis
             motor.isHomed = True
             motor.jdist = jdist
+            # HOME motors don't jog, so don't need a search speed
+            if htype != HOME:
+                motor.search_speed = search_speed
+            assert search_speed is None or search_speed > 0, \
+                "search_speed on axis %d should be positive" % axis
+            assert search_speed is None or self.speed_vars is not None, \
+                "speed_vars must be given to use a search_speed on axis %d" \
+                % axis
             # Check the override is a tuple
             if isinstance(jdist_overrides, tuple) or jdist_overrides is None:
                 motor.jdist_overrides = jdist_overrides
@@ -369,38 +527,48 @@ class PLC:
 
     # Select all motors in this group with a defined htype
     def __sel(self, htypes=None):
-        return [m for m, htype, post in self.group.actions
-            if htypes is None or htype in htypes]        
+        return self.group.select(htypes)
             
     def __set_jdist_hdir(self, htypes, reverse=False):
         # set jdist reg to be a large distance in hdir, or in -hdir if reverse
         if reverse:
-            self.__cmd1 += ["\t\tm%d72=%d*(-i%d23/ABS(i%d23))" % 
-                (m.ax,LARGEJ,m.ax,m.ax) for m in self.__sel(htypes)]
+            self.__cmd1 += [(m, "\t\tm%d72=%d*(-i%d23/ABS(i%d23))" % 
+                (m.ax,LARGEJ,m.ax,m.ax)) for m in self.__sel(htypes)]
         else:
-            self.__cmd1 += ["\t\tm%d72=%d*(i%d23/ABS(i%d23))" % 
-                (m.ax,LARGEJ,m.ax,m.ax) for m in self.__sel(htypes)]
+            self.__cmd1 += [(m, "\t\tm%d72=%d*(i%d23/ABS(i%d23))" % 
+                (m.ax,LARGEJ,m.ax,m.ax)) for m in self.__sel(htypes)]
+
+    def __set_search_speed(self, htypes, restore=False):
+        # set the jog speed of motors with a search speed, or restore it
+        for m in self.__sel(htypes):
+            if m.search_speed is None:
+                continue
+            if restore:
+                self.__cmd1.append((m, "i%d22=P%d" % (m.ax,
+                    self.speed_vars + m.i)))
+            else:
+                self.__cmd1.append((m, "i%d22=%s" % (m.ax, m.search_speed)))
 
     def __home(self, htypes):
         # home command
-        self.__cmd2 += ["#%dhm"%m.ax for m in self.__sel(htypes)]
+        self.__cmd2 += [(m, "#%dhm"%m.ax) for m in self.__sel(htypes)]
 
     def __set_motor_position_trigger_mode_for_homing(self, htypes):
         for m in self.__sel(htypes):
-            self.__cmd1.append("I%d97 = 3; in-position trigger on following error\n" % m.ax)
-            self.__cmd3.append("I%d97 = 0; in-position trigger on hardware capture\n" % m.ax)
+            self.__cmd1.append((m, "I%d97 = 3; in-position trigger on following error\n" % m.ax))
+            self.__cmd3.append((m, "I%d97 = 0; in-position trigger on hardware capture\n" % m.ax))
         self._check_following_error = False
 
     def __jog_until_trig(self, htypes, reverse=False):
         # jog until trigger, go dist past trigger
         self.__set_jdist_hdir(htypes,reverse)
-        self.__cmd2 += ["#%dJ^*^%d" % 
-            (m.ax,m.jdist) for m in self.__sel(htypes)]
+        self.__cmd2 += [(m, "#%dJ^*^%d" % 
+            (m.ax,m.jdist)) for m in self.__sel(htypes)]
 
     def __jog_inc(self, htypes, reverse=False):
         # jog incremental by jdist reg
         self.__set_jdist_hdir(htypes,reverse)
-        self.__cmd2 += ["#%dJ^*" % m.ax for m in self.__sel(htypes)]
+        self.__cmd2 += [(m, "#%dJ^*" % m.ax) for m in self.__sel(htypes)]
 
     def __set_hflags(self, htypes, inv=False):
         # set the hflags of all types of motors in htypes
@@ -411,61 +579,71 @@ class PLC:
                 val = "P%d%02d"%(self.plc,d.i+36)            
             if hasattr(d, "nx"):
                 # geobrick internal axis
-                self.__cmd1.append("i7%02d2=%s"%(d.nx,val))
+                self.__cmd1.append((d, "i7%02d2=%s"%(d.nx,val)))
             else:
                 # ms external axis                  
-                self.__cmd1.append("MSW%d,i912,%s"%(d.ms,val))
+                self.__cmd1.append((d, "MSW%d,i912,%s"%(d.ms,val)))
 
-    def __check_not_aborted(self, f, tabs=1):        
+    def __check_not_aborted(self, out, tabs=1):        
         for i in range(tabs):
-            f.write("\t")
+            out.append("\t")
         if self.allow_debug:
-            f.write('if (HomingStatus = StatusHoming or HomingStatus = StatusDebugHoming)\n')
+            out.append('if (HomingStatus = StatusHoming or HomingStatus = StatusDebugHoming)\n')
         else:
-            f.write('if (HomingStatus=StatusHoming)\n')    
+            out.append('if (HomingStatus=StatusHoming)\n')    
 
-    def __write_cmds(self, f, state, lim_htypes=None, ferr_htypes=None, lim_mtrs=None):
+    def __write_cmds(self, out, state, lim_htypes=None, ferr_htypes=None, lim_mtrs=None):
         # process self.__cmd1 and self.__cmd2 and write them out
-        has_pre = state == "PreHomeMove" and self.group.pre
-        has_post = state == "PostHomeMove" and self.group.post
+        workers = self.workers.get(self.group.group)
+        has_pre = state == "PreHomeMove" and (self.group.pre or workers)
+        # with workers, the post code is run when they have finished
+        has_post = state == "PostHomeMove" and self.group.post and \
+            not workers
         if self.__cmd1 or self.__cmd2 or has_pre or has_post:
             if self.allow_debug:
-                f.write('\t; Wait for user to tell us to continue if in debug\n')
-                f.write('\tif (HomingStatus = StatusDebugHoming)\n')
-                f.write('\t\tHomingStatus = StatusPaused\n')
-                f.write('\t\twhile (HomingStatus = StatusPaused)\n')
-                f.write('\t\tendw\n')
-                f.write('\tendif\n\n')            
-            f.write('\t;---- %s State ----\n'%state)
-            self.__check_not_aborted(f)
-            f.write('\t\tHomingState=State%s\n'%state)
-            f.write('\t\t; Execute the move commands\n')
-        if has_pre:
-            f.write('\t\t%s\n' % self.group.pre)
+                out.append('\t; Wait for user to tell us to continue if in debug\n')
+                out.append('\tif (HomingStatus = StatusDebugHoming)\n')
+                out.append('\t\tHomingStatus = StatusPaused\n')
+                out.append('\t\twhile (HomingStatus = StatusPaused)\n')
+                out.append('\t\tendw\n')
+                out.append('\tendif\n\n')            
+            out.append('\t;---- %s State ----\n'%state)
+            self.__check_not_aborted(out)
+            out.append('\t\tHomingState=State%s\n'%state)
+            out.append('\t\t; Execute the move commands\n')
+        if has_pre and self.group.pre:
+            out.append('\t\t%s\n' % self.group.pre)
+        if has_pre and workers:
+            out.append('\t\t; Start the other PLCs homing this group\n')
+            out.append('\t\t%s\n' % " ".join(["P%d02=%d P%d01=StatusHoming" %
+                (w, self.group.group, w) for w in workers]))
+            for w in workers:
+                out.append('\t\tENABLE PLC%d\n' % w)
 
         # Write first 2 command sets to file
-        self.__write_cmd_set_to_file(f, self.__cmd1, use_cmd=False)
-        self.__write_cmd_set_to_file(f, self.__cmd2, use_cmd=True)
+        self.__write_cmd_set_to_file(out, self.__cmd1, use_cmd=False)
+        self.__write_cmd_set_to_file(out, self.__cmd2, use_cmd=True)
         
         if self.__cmd1 or self.__cmd2:
             # setup a generic wait for move routine      
-            self.InPosition = "&".join(["m%d40"%m.ax for m in self.__sel()])
+            self.InPosition = self.group.InPosition
             # create a list of checks and results
             checks = []
             results = []
             # for the following error, always check, but ferr_htypes are the only ones that should fail
-            ffcheckstr = "|".join("m%d42" % m.ax for m in self.__sel()) 
+            ffcheckstr = self.group.FFErr
             if self._check_following_error and ffcheckstr:
                 checks.append((ffcheckstr, "0", "StatusFFErr", "Following error check"))                
-            ffresultstr = "|".join("m%d42" % m.ax for m in self.__sel(htypes=ferr_htypes)) 
+            ffresultstr = self.group.expression("m%d42", "|", ferr_htypes)
             if self._check_following_error and ffresultstr:
                 results.append((ffresultstr, "0", "StatusFFErr", "Following error check"))            
             # reset the following error check flag for future stages
             self._check_following_error = True
             # only check the limit switches of htypes
             if lim_mtrs == None:
-                lim_mtrs = self.__sel(lim_htypes)                        
-            lstr = "|".join("m%d30" % m.ax for m in lim_mtrs)                 
+                lstr = self.group.expression("m%d30", "|", lim_htypes)
+            else:
+                lstr = "|".join("m%d30" % m.ax for m in lim_mtrs)                 
             if lstr:
                 lchk = (lstr, "0", "StatusLimit", "Limit check")
                 checks.append(lchk)
@@ -483,102 +661,208 @@ class PLC:
                 self.results += "\t\tif (%s != %s) ; %s failed\n" % (exp, val, chktxt)
                 self.results += "\t\t\tHomingStatus = %s\n" % stat
                 self.results += "\t\tendif\n"
-            f.write(wait_for_move % self.__dict__)
+            out.append(wait_for_move % self.__dict__)
 
         # Write third command set to file
-        self.__write_cmd_set_to_file(f, self.__cmd3, use_cmd=False)
+        self.__write_cmd_set_to_file(out, self.__cmd3, use_cmd=False)
 
         if has_post:
-            self.__check_not_aborted(f, tabs = 2)
-            f.write('\t\t\t%s\n' % self.group.post)
-            f.write('\t\tendif\n')            
+            self.__check_not_aborted(out, tabs = 2)
+            out.append('\t\t\t%s\n' % self.group.post)
+            out.append('\t\tendif\n')            
         if self.__cmd1 or self.__cmd2 or self.__cmd3 or has_pre or has_post:    
             self.__cmd1 = []            
             self.__cmd2 = []
             self.__cmd3 = []
-            f.write('\tendif\n\n')
+            out.append('\tendif\n\n')
     
-    ## Write out a given list of command to a file
-    def __write_cmd_set_to_file(self, f, cmd_list, use_cmd=False):
-        out = [[]]
+    # Wait for the other PLCs homing this group to finish, then take the
+    # status of any that failed, or abort them if this PLC has failed
+    def __wait_for_workers(self, out, workers):
+        out.append('\t;---- Wait for the other PLCs homing this group ----\n')
+        self.__check_not_aborted(out)
+        out.append('\t\twhile (%s)\n' % " or ".join(
+            ["P%d01=StatusHoming" % w for w in workers]))
+        if self.allow_debug:
+            out.append('\t\tand (HomingStatus = StatusHoming or HomingStatus = StatusDebugHoming)\n')
+        else:
+            out.append('\t\tand (HomingStatus = StatusHoming)\n')
+        out.append('\t\tendw\n')
+        out.append('\tendif\n')
+        out.append('\t; Fail with the status of any PLC that failed\n')
+        for w in workers:
+            self.__check_not_aborted(out)
+            out.append('\tand (P%d01 != StatusDone)\n' % w)
+            out.append('\t\tHomingStatus = P%d01\n' % w)
+            out.append('\tendif\n')
+        out.append('\t; Abort the other PLCs if this one has failed\n')
+        if self.allow_debug:
+            out.append('\tif (HomingStatus != StatusHoming and HomingStatus != StatusDebugHoming)\n')
+        else:
+            out.append('\tif (HomingStatus != StatusHoming)\n')
+        for w in workers:
+            out.append('\t\tif (P%d01=StatusHoming)\n' % w)
+            out.append('\t\t\tP%d01=StatusAborted\n' % w)
+            out.append('\t\tendif\n')
+        out.append('\tendif\n')
+        if self.group.post:
+            self.__check_not_aborted(out)
+            out.append('\t\t%s\n' % self.group.post)
+            out.append('\tendif\n')
+        out.append('\n')
+
+    ## Write out a given list of (motor, command), packed into as few lines as
+    # possible. In resume mode the commands of motors that can be skipped are
+    # only run if the motor isn't in the skip mask
+    def __write_cmd_set_to_file(self, out, cmd_list, use_cmd=False):
+        if self.resume is None:
+            self.__pack(out, [t for m, t in cmd_list], use_cmd)
+            return
+        gated = self.group.select(htypes_without(NOTHING))
+        self.__pack(out, [t for m, t in cmd_list if m not in gated], use_cmd)
+        for g in gated:
+            cmds = [t.lstrip() for m, t in cmd_list if m is g]
+            if cmds:
+                out.append("\t\tif (P%d&%d=0)\n" % (self.resume + 1, 1 << g.i))
+                self.__pack(out, cmds, use_cmd, tabs="\t\t\t")
+                out.append("\t\tendif\n")
+
+    # Write out a list of commands packed into as few lines as possible
+    def __pack(self, out, cmd_list, use_cmd, tabs="\t\t"):
         max_line_len = 248 if use_cmd else 254
+        lines = []
+        line = []
+        # length of " ".join(line)
+        length = 0
         for t in cmd_list:
-            if len(" ".join(out[-1]+[t]))<max_line_len and len(out[-1])<32:
-                out[-1].append(t)
+            if line:
+                new_length = length + 1 + len(t)
+            else:
+                new_length = len(t)
+            if new_length < max_line_len and len(line) < 32:
+                line.append(t)
+                length = new_length
             else:
-                out += [[t]]
-        for l in [(" ".join(l)) for l in out]:
+                lines.append(line)
+                line = [t]
+                length = len(t)
+        lines.append(line)
+        for l in [(" ".join(l)) for l in lines]:
             if l and use_cmd:
-                f.write('\t\tcmd "%s"\n'%l)
+                out.append('%scmd "%s"\n'%(tabs,l))
             elif l:
-                f.write("\t\t"+l+"\n")
+                out.append(tabs+l+"\n")
+
+    ## Return a hash of everything that affects the generated PLC text,
+    # including the version of motorhome that generates it
+    def signature(self):
+        groups = []
+        for g, group in sorted(self.groups.items()):
+            actions = [(m.ax, m.i, m.enc_axes, getattr(m, "ms", None),
+                getattr(m, "nx", None), m.jdist, m.jdist_overrides,
+                m.search_speed, htype, post) for m, htype, post in group.actions]
+            groups.append((g, group.pre, group.post, group.checks, actions))
+        config = (generator_version, self.plc, self.timeout, self.ctype,
+            self.allow_debug, self.resume, self.speed_vars, self.comment,
+            sorted(self.workers.items()), groups)
+        return hashlib.md5(repr(config)).hexdigest()
 
-    ## Write the PLC text to a filename string f
-    def write(self,f):
-        # open the file and write the header
-        f = open(f,"w")
-        self.writeFile(f)
-        f.close()
+    ## Write the PLC text to a filename string f. The file is left untouched
+    # if it already contains the same text.
+    # \param cache Directory used to cache the text of generated PLCs, indexed
+    # by signature(). If the signature is found here then the PLC is not
+    # generated again. None means don't cache
+    # \return True if the file was written
+    def write(self, f, cache=None):
+        return _write(self, f, cache)
 
-    ## Write the PLC text to a file object f
+    ## Write the PLC text to a file object f, or any object with a write
+    # method
     def writeFile(self,f):  
+        for chunk in self.chunks():
+            f.write(chunk)
+
+    ## Return the PLC text as a string, without touching the disk
+    def render(self):
+        return "".join(self.chunks())
+
+    ## Generator that produces the PLC text in chunks: the header and
+    # configuring state, then one chunk for each group, then the done and
+    # tidy up states
+    def chunks(self):
+        out = []
         if len(self.groups) != 1:
             assert 1 not in self.groups, \
                 "Shouldn't add motors to group 1 if multiple groups are defined"
+        # build the comment locally so writing twice doesn't repeat it
+        comment = self.comment
         for g, group in sorted(self.groups.items()):
-            self.comment += "; Group %d:\n" % g
+            comment += "; Group %d:\n" % g
             for motor, htype, post in group.actions:
-                self.comment += ";  Axis %d: htype = %s, jdist = %s, post = %s" % (motor.ax, htypes_str[htype], motor.jdist, post)
+                comment += ";  Axis %d: htype = %s, jdist = %s, post = %s" % (motor.ax, htypes_str[htype], motor.jdist, post)
                 if motor.enc_axes:
-                    self.comment += ", enc_axes = %s" % motor.enc_axes
-                self.comment += "\n"
+                    comment += ", enc_axes = %s" % motor.enc_axes
+                if motor.search_speed is not None and htype != NOTHING:
+                    comment += ", search_speed = %s" % motor.search_speed
+                comment += "\n"
+        if self.resume is not None:
+            comment += "; Resumes an unfinished run using P%d and P%d, set " \
+                "P%d=0 to home everything again\n" % (self.resume,
+                self.resume + 1, self.resume)
                 
-        f.write(header % self.__dict__)        
+        out.append(header % dict(self.__dict__, comment=comment))
         plc = self.plc
         
         # default to old non-pausing behaviour
-        f.write("if (HomingStatus != StatusHoming)\n")
+        out.append("if (HomingStatus != StatusHoming)\n")
         if self.allow_debug:
-            f.write("and (HomingStatus != StatusDebugHoming)\n")        
-        f.write("\tHomingStatus = StatusHoming\n")
-        f.write("endif\n\n")                        
+            out.append("and (HomingStatus != StatusDebugHoming)\n")        
+        out.append("\tHomingStatus = StatusHoming\n")
+        out.append("endif\n\n")                        
         
         #---- Configuring state ----
-        f.write(";---- Configuring State ----\n")
-        f.write("HomingState=StateConfiguring\n")
-        f.write(";Save the Homing group to px03\n")
-        f.write("HomingBackupGroup=HomingGroup\n")        
-        f.write(";Save high soft limits to P variables px04..x19\n")
-        f.write(" ".join(["P%d%02d=i%d13" % 
-            (plc,m.i+04,m.ax) for m in Motor.instances])+"\n")
-        f.write(";Save the low soft limits to P variables px20..x35\n")
-        f.write(" ".join(["P%d%02d=i%d14" % 
-            (plc,m.i+20,m.ax) for m in Motor.instances])+"\n")
-        f.write(";Save the home capture flags to P variables px36..x51\n")
+        out.append(";---- Configuring State ----\n")
+        out.append("HomingState=StateConfiguring\n")
+        out.append(";Save the Homing group to px03\n")
+        out.append("HomingBackupGroup=HomingGroup\n")        
+        out.append(";Save high soft limits to P variables px04..x19\n")
+        out.append(" ".join(["P%d%02d=i%d13" % 
+            (plc,m.i+04,m.ax) for m in self.motors])+"\n")
+        out.append(";Save the low soft limits to P variables px20..x35\n")
+        out.append(" ".join(["P%d%02d=i%d14" % 
+            (plc,m.i+20,m.ax) for m in self.motors])+"\n")
+        out.append(";Save the home capture flags to P variables px36..x51\n")
         cmds = []
         mschecks = []
-        for m in Motor.instances:
+        for m in self.motors:
             if hasattr(m, "nx"):
                 cmds.append("P%d%02d=i7%02d2"%(plc,m.i+36,m.nx))
             else:
                 cmds.append("MSR%d,i912,P%d%02d"%(m.ms,plc,m.i+36))
                 mschecks.append("P%d%02d=0" % (plc,m.i+36))
-        f.write(" ".join(cmds)+"\n")                
+        self.__pack(out, cmds, False, tabs="")
         if mschecks:                
-            f.write(";If any are zero then there is probably a macro error\n")                
-            f.write('if (%s)\n'%(" or ".join(mschecks)))
-            f.write("\tHomingStatus=StatusInvalid\n")
-            f.write('endif\n')
-        f.write(";Store 'not flag' to use in moving off a flag in P variables px52..x67\n")
-        f.write(" ".join(["P%d%02d=P%d%02d^$C"%(plc,m.i+52,plc,m.i+36) for m in Motor.instances])+"\n")
-        f.write(";Save the limit flags to P variables px68..x83\n")
-        f.write(" ".join(["P%d%02d=i%d24"%(plc,m.i+68,m.ax) for m in Motor.instances])+"\n")
-        f.write(";Save the current position to P variables px84..x99\n")
-        f.write(" ".join(["P%d%02d=M%d62"%(plc,m.i+84,m.ax) for m in Motor.instances])+"\n")
-        f.write(';Clear the soft limits\n')
-        f.write(" ".join(["i%d13=0"%m.ax for m in Motor.instances])+"\n")
-        f.write(" ".join(["i%d14=0"%m.ax for m in Motor.instances])+"\n")       
-        f.write("\n")
+            out.append(";If any are zero then there is probably a macro error\n")                
+            out.append('if (%s)\n'%(" or ".join(mschecks)))
+            out.append("\tHomingStatus=StatusInvalid\n")
+            out.append('endif\n')
+        out.append(";Store 'not flag' to use in moving off a flag in P variables px52..x67\n")
+        out.append(" ".join(["P%d%02d=P%d%02d^$C"%(plc,m.i+52,plc,m.i+36) for m in self.motors])+"\n")
+        out.append(";Save the limit flags to P variables px68..x83\n")
+        out.append(" ".join(["P%d%02d=i%d24"%(plc,m.i+68,m.ax) for m in self.motors])+"\n")
+        out.append(";Save the current position to P variables px84..x99\n")
+        out.append(" ".join(["P%d%02d=M%d62"%(plc,m.i+84,m.ax) for m in self.motors])+"\n")
+        fast = [m for m in self.motors if m.search_speed is not None]
+        if fast:
+            out.append(";Save the jog speeds to P variables %d..%d\n" % (
+                self.speed_vars, self.speed_vars + 15))
+            out.append(" ".join(["P%d=i%d22"%(self.speed_vars+m.i,m.ax) for m in fast])+"\n")
+        out.append(';Clear the soft limits\n')
+        out.append(" ".join(["i%d13=0"%m.ax for m in self.motors])+"\n")
+        out.append(" ".join(["i%d14=0"%m.ax for m in self.motors])+"\n")       
+        out.append("\n")
+        yield "".join(out)
+        out = []
                 
         # write some PLC for each group
         put_back_avail = []
@@ -586,29 +870,48 @@ class PLC:
             test = "HomingBackupGroup = 1"
             if g != 1:
                 test += " or HomingBackupGroup = %d" % g            
-            f.write("if (%s)\n" % test)
+            out.append("if (%s)\n" % test)
             if self.allow_debug:
-                f.write("and (HomingStatus = StatusHoming or HomingStatus = StatusDebugHoming)\n")
+                out.append("and (HomingStatus = StatusHoming or HomingStatus = StatusDebugHoming)\n")
             else:
-                f.write("and (HomingStatus = StatusHoming)\n")            
+                out.append("and (HomingStatus = StatusHoming)\n")            
+            if self.resume is not None:
+                out.append("and (P%d&%d=0)\n" % (self.resume, 1 << g))
             ## Store the motor group that is currently being generated          
             self.group = group
-            f.write("\tHomingGroup=%d\n\n"%g) 
+            group.freeze()
+            out.append("\tHomingGroup=%d\n\n"%g) 
 
             #---- Remove all the home flags for this group ---- 
             ems = self.__sel(htypes = htypes_without(NOTHING))          
-            f.write("\t;Clear home flags\n")
-            f.write("\t"+" ".join(["m%d45=0"%m.ax for m in ems])+"\n")
+            if self.resume is None:
+                out.append("\t;Clear home flags\n")
+                out.append("\t"+" ".join(["m%d45=0"%m.ax for m in ems])+"\n")
+            else:
+                out.append("\t;Clear home flags if this group wasn't started "
+                    "before, otherwise skip\n")
+                out.append("\t;the motors that are already homed\n")
+                out.append("\tif (P%d&%d=0)\n" % (self.resume, 1 << (g + 10)))
+                out.append("\t\tP%d=P%d|%d\n" % (self.resume, self.resume,
+                    1 << (g + 10)))
+                out.append("\t\t"+" ".join(["m%d45=0"%m.ax for m in ems])+"\n")
+                out.append("\t\tP%d=0\n" % (self.resume + 1))
+                out.append("\telse\n")
+                out.append("\t\tP%d=%s\n" % (self.resume + 1, "+".join(
+                    ["m%d45*%d" % (m.ax, 1 << m.i) for m in ems])))
+                out.append("\tendif\n")
             
             #---- PreHomeMove State ----
             # Set the pre-home move jdist override
-            for m in Motor.instances:
+            for m in self.motors:
                 m.override_jdist_for_phase(Motor.PHASE_PRE_HOME_MOVE)
             # for hsw_dir motors, set the trigger to be the inverse flag
             self.__set_hflags([HSW_DIR],inv=True)
             # for hsw_hstop the motor position trigger should be set to
             # trigger on following error (value 3) and reset after movement
             self.__set_motor_position_trigger_mode_for_homing([HSW_HSTOP])
+            # jog at the search speed if there is one
+            self.__set_search_speed([HSW,HSW_DIR,HSW_HSTOP,RLIM,HSW_HLIM])
             # for hsw/hsw_dir motors jog until trigger in direction of -ix23
             self.__jog_until_trig([HSW,HSW_DIR,HSW_HSTOP],reverse=True)
             # for rlim motors jog in direction of -ix23
@@ -616,95 +919,99 @@ class PLC:
             # for hsw_hlim motors jog until trigger in direction of ix23        
             self.__jog_until_trig([HSW_HLIM])
             # add the commands, HSW_DIR can't hit the limit
-            self.__write_cmds(f,"PreHomeMove", lim_htypes=[HSW_DIR], ferr_htypes=htypes_without(HSW_HSTOP)) 
+            self.__write_cmds(out,"PreHomeMove", lim_htypes=[HSW_DIR], ferr_htypes=htypes_without(HSW_HSTOP)) 
 
             # for hsw_hlim we could have gone past the limit and hit the limit switch
             ems = self.__sel([HSW_HLIM])
             if ems:
-                f.write('\t;---- Check if HSW_HLIM missed home mark and hit a limit ----\n')
-                self.__check_not_aborted(f)               
-                f.write('\t\t; Execute the move commands if on a limit\n')            
+                out.append('\t;---- Check if HSW_HLIM missed home mark and hit a limit ----\n')
+                self.__check_not_aborted(out)               
+                out.append('\t\t; Execute the move commands if on a limit\n')            
             for m in ems:
                 # if stopped on position limit, jog until trigger in direction of -ix23
-                f.write('\t\tif (m%d30=1)\n'%m.ax)
-                f.write('\t\t\tm%d72=%d*(-i%d23/ABS(i%d23))\n'%(m.ax,LARGEJ,m.ax,m.ax))
-                f.write('\t\t\tcmd "#%dJ^*^%d"\n'%(m.ax,m.jdist))
-                f.write('\t\tendif\n')
+                out.append('\t\tif (m%d30=1)\n'%m.ax)
+                out.append('\t\t\tm%d72=%d*(-i%d23/ABS(i%d23))\n'%(m.ax,LARGEJ,m.ax,m.ax))
+                out.append('\t\t\tcmd "#%dJ^*^%d"\n'%(m.ax,m.jdist))
+                out.append('\t\tendif\n')
             if ems:
                 lstr = "|".join("m%d30"%m.ax for m in ems)
                 self.checks += "\t\tand (%s=0) ; Should not stop on position limit for selected motors\n" % lstr
                 self.results += "\t\tif (%s=1) ; If a motor hit a limit\n" % lstr
                 self.results += "\t\t\tHomingStatus = StatusLimit\n"
                 self.results += "\t\tendif\n"
-                f.write(wait_for_move % self.__dict__) 
-                f.write('\tendif\n\n')
+                out.append(wait_for_move % self.__dict__) 
+                out.append('\tendif\n\n')
 
             #---- FastSearch State ----
             # Set the fast search jdist override
-            for m in Motor.instances:
+            for m in self.motors:
                 m.override_jdist_for_phase(Motor.PHASE_FAST_SEARCH)
             # for hsw_dir motors, set the trigger to be the original flag
             self.__set_hflags([HSW_DIR]) 
+            # jog at the search speed if there is one
+            self.__set_search_speed(htypes_without(HOME, NOTHING))
             # for all motors except hsw_hlim jog until trigger in direction of ix23
             self.__jog_until_trig(htypes = htypes_without(HOME, NOTHING))
             # add the commands, wait for the moves to complete
-            self.__write_cmds(f,"FastSearch",lim_htypes=htypes_without(HOME, NOTHING, LIMIT, RLIM))
+            self.__write_cmds(out,"FastSearch",lim_htypes=htypes_without(HOME, NOTHING, LIMIT, RLIM))
             
             # store home points
             ems = self.__sel(htypes_without(HOME, NOTHING))  
             if ems:
-                f.write('\t;---- Store the difference between current pos and start pos ----\n')
-                self.__check_not_aborted(f)
+                out.append('\t;---- Store the difference between current pos and start pos ----\n')
+                self.__check_not_aborted(out)
                 for m in ems:
                     # put back pos = (start pos - current pos) converted to counts + jdist - home off * 16
-                    f.write('\t\tP%d%02d=(P%d%02d-M%d62)/(I%d08*32)+%d-(i%d26/16)\n'%(plc,m.i+84,plc,m.i+84,m.ax,m.ax,m.jdist,m.ax))
+                    out.append('\t\tP%d%02d=(P%d%02d-M%d62)/(I%d08*32)+%d-(i%d26/16)\n'%(plc,m.i+84,plc,m.i+84,m.ax,m.ax,m.jdist,m.ax))
                     assert m.ax not in put_back_avail, "Group %(grp)s, axis %(ax)d has already been homed, this isn't right..." %m
                     put_back_avail.append(m.ax)
-                f.write('\tendif\n\n')  
+                out.append('\tendif\n\n')  
                 
             #---- FastRetrace State ----
             # Set the fast retrace jdist override
-            for m in Motor.instances:
+            for m in self.motors:
                 m.override_jdist_for_phase(Motor.PHASE_FAST_RETRACE)
             htypes = htypes_without(HOME, NOTHING)
             # for limit/hsw_* motors, set the trigger to be the inverse flag
             self.__set_hflags(htypes,inv=True)
+            # retrace at the normal jog speed
+            self.__set_search_speed(htypes, restore=True)
             # then jog until trigger in direction of -ix23
             self.__jog_until_trig(htypes,reverse=True)
             # add the commands, wait for the moves to complete
-            self.__write_cmds(f,"FastRetrace",lim_htypes=htypes_without(HOME, NOTHING, LIMIT, RLIM))
+            self.__write_cmds(out,"FastRetrace",lim_htypes=htypes_without(HOME, NOTHING, LIMIT, RLIM))
 
             # check that the limit flags are reasonable for LIMIT motors, and remove limits if so  
             ems = self.__sel([LIMIT])  
             if ems:
-                f.write('\t;---- Check if any limits need disabling ----\n')
-                self.__check_not_aborted(f)     
-                f.write("\t\t;Save the user home flags to P variables px52..x67\n")
-                f.write("\t\t;NOTE: this overwrites inverse flag (ran out of P vars), so can't use inverse flag after this point\n\t")                
+                out.append('\t;---- Check if any limits need disabling ----\n')
+                self.__check_not_aborted(out)     
+                out.append("\t\t;Save the user home flags to P variables px52..x67\n")
+                out.append("\t\t;NOTE: this overwrites inverse flag (ran out of P vars), so can't use inverse flag after this point\n\t")                
                 cmds = []
                 for m in ems:
                     if hasattr(m, "nx"):
                         cmds.append("P%d%02d=i7%02d3"%(plc,m.i+52,m.nx))
                     else:
                         cmds.append("MSR%d,i913,P%d%02d"%(m.ms,plc,m.i+52))                             
-                f.write("\t\t" + " ".join(cmds)+"\n")
+                self.__pack(out, cmds, False)
             for m in ems:
-                f.write("\t\t; if capture on flag, and flag high, then we need to disable limits\n")
-                f.write("\t\tif (P%d%02d&2=2 and P%d%02d&8=0)\n"%(plc,m.i+36,plc,m.i+36))
-                f.write("\t\t\t; ix23 (h_vel) should be opposite to ix26 (h_off) and in direction of home flag\n")
-                f.write("\t\t\tif (P%d%02d=1 and i%d23>0 and i%d26<1)\n"%(plc,m.i+52,m.ax,m.ax))
-                f.write("\t\t\tor (P%d%02d=2 and i%d23<0 and i%d26>-1)\n"%(plc,m.i+52,m.ax,m.ax))
-                f.write("\t\t\t\ti%d24=i%d24 | $20000\n"%(m.ax,m.ax))
-                f.write("\t\t\telse\n")
-                f.write("\t\t\t\t; if it isn't then set it into invalid error\n")
-                f.write("\t\t\t\tHomingStatus=StatusInvalid\n")
-                f.write("\t\t\tendif\n")
-                f.write("\t\tendif\n")
+                out.append("\t\t; if capture on flag, and flag high, then we need to disable limits\n")
+                out.append("\t\tif (P%d%02d&2=2 and P%d%02d&8=0)\n"%(plc,m.i+36,plc,m.i+36))
+                out.append("\t\t\t; ix23 (h_vel) should be opposite to ix26 (h_off) and in direction of home flag\n")
+                out.append("\t\t\tif (P%d%02d=1 and i%d23>0 and i%d26<1)\n"%(plc,m.i+52,m.ax,m.ax))
+                out.append("\t\t\tor (P%d%02d=2 and i%d23<0 and i%d26>-1)\n"%(plc,m.i+52,m.ax,m.ax))
+                out.append("\t\t\t\ti%d24=i%d24 | $20000\n"%(m.ax,m.ax))
+                out.append("\t\t\telse\n")
+                out.append("\t\t\t\t; if it isn't then set it into invalid error\n")
+                out.append("\t\t\t\tHomingStatus=StatusInvalid\n")
+                out.append("\t\t\tendif\n")
+                out.append("\t\tendif\n")
             if ems:
-                f.write('\tendif\n\n')                
+                out.append('\tendif\n\n')                
 
             # Release all jdist overrides
-            for m in Motor.instances:
+            for m in self.motors:
                 m.release_jdist_override()
 
             #---- Homing State ----        
@@ -714,35 +1021,35 @@ class PLC:
             # Then execute the home command
             self.__home(htypes)
             # add the commands, wait for the moves to complete
-            self.__write_cmds(f,"Homing",lim_htypes=htypes_without(NOTHING, RLIM))
+            self.__write_cmds(out,"Homing",lim_htypes=htypes_without(NOTHING, RLIM))
 
             # restore limit flags for LIMIT motors  
             ems = self.__sel([LIMIT])  
             if ems:
-                f.write('\t;---- Restore limits if needed ----\n')
-                f.write('\t;Restore the limit flags to P variables px68..x83\n\t')        
-                f.write(" ".join(["i%d24=P%d%02d"%(m.ax,plc,m.i+68) for m in ems])+"\n")
-                f.write("\n")                
+                out.append('\t;---- Restore limits if needed ----\n')
+                out.append('\t;Restore the limit flags to P variables px68..x83\n\t')        
+                out.append(" ".join(["i%d24=P%d%02d"%(m.ax,plc,m.i+68) for m in ems])+"\n")
+                out.append("\n")                
 
             # Zero all encoders
             ems = self.__sel(htypes)          
             cmds = []
             for m in ems:
                 for e in m.enc_axes:
-                    cmds.append("#%dhmz"%e)
+                    cmds.append((m, "#%dhmz"%e))
             if cmds:
-                f.write('\t;---- Zero encoder channels ----\n')
-                self.__check_not_aborted(f) 
-                f.write("\t\tcmd \"" + " ".join(cmds)+"\"\n")                
-                f.write('\tendif\n\n')  
+                out.append('\t;---- Zero encoder channels ----\n')
+                self.__check_not_aborted(out) 
+                self.__write_cmd_set_to_file(out, cmds, use_cmd=True)
+                out.append('\tendif\n\n')  
 
             # check motors ALL have home complete flags set
             if ems:
-                f.write('\t;---- Check if all motors have homed ----\n')
-                self.__check_not_aborted(f) 
-                f.write('\tand (%s=0)\n'%("&".join(["m%d45"%m.ax for m in ems])))
-                f.write('\t\tHomingStatus=StatusIncomplete\n')
-                f.write('\tendif\n\n')          
+                out.append('\t;---- Check if all motors have homed ----\n')
+                self.__check_not_aborted(out) 
+                out.append('\tand (%s=0)\n'%("&".join(["m%d45"%m.ax for m in ems])))
+                out.append('\t\tHomingStatus=StatusIncomplete\n')
+                out.append('\tendif\n\n')          
                               
             #---- Put Back State ----        
             # these are the motors that require a limit check
@@ -755,86 +1062,480 @@ class PLC:
                     assert htype != HOME, "Home and put back not available on group %(grp)s, axis %(ax)d, with HOME htype" %m.__dict__
                     assert htype != NOTHING or m.ax in put_back_avail, "Home and put back not available on group %(grp)s, axis %(ax)d, as it hasn't been homed at this point" %m.__dict__
                     # go to initial pos
-                    self.__cmd1.append("m%d72=P%d%02d"%(m.ax,plc,m.i+84))
-                    self.__cmd2.append("#%dJ=*"%m.ax)
+                    self.__cmd1.append((m, "m%d72=P%d%02d"%(m.ax,plc,m.i+84)))
+                    self.__cmd2.append((m, "#%dJ=*"%m.ax))
                     lim_mtrs.append(m)
                 elif post=="h":
                     # go to high soft limit
-                    self.__cmd1.append("m%d72=P%d%02d"%(m.ax,plc,m.i+04))
-                    self.__cmd2.append("#%dJ=*"%m.ax)
+                    self.__cmd1.append((m, "m%d72=P%d%02d"%(m.ax,plc,m.i+04)))
+                    self.__cmd2.append((m, "#%dJ=*"%m.ax))
                     lim_mtrs.append(m)    
                 elif post=="l":
                     # go to low soft limit
-                    self.__cmd1.append("m%d72=P%d%02d"%(m.ax,plc,m.i+20))
-                    self.__cmd2.append("#%dJ=*"%m.ax)
+                    self.__cmd1.append((m, "m%d72=P%d%02d"%(m.ax,plc,m.i+20)))
+                    self.__cmd2.append((m, "#%dJ=*"%m.ax))
                     lim_mtrs.append(m)        
                 elif post=="H":
                     # go to high hard limit, don't check for limits
-                    self.__cmd2.append("#%dJ+"%m.ax)      
+                    self.__cmd2.append((m, "#%dJ+"%m.ax))      
                 elif post=="L":
                     # go to low hard limit, don't check for limits
-                    self.__cmd2.append("#%dJ-"%m.ax)    
+                    self.__cmd2.append((m, "#%dJ-"%m.ax))    
                 elif type(post)==str and post.startswith("r"):
                     # jog relative by post[1:]
-                    self.__cmd2.append("#%dJ=%d"%(m.ax,int(post[1:])))     
+                    self.__cmd2.append((m, "#%dJ=%d"%(m.ax,int(post[1:]))))     
                     lim_mtrs.append(m)                                                                   
                 elif type(post)==str and post.startswith("z"):
                     # go to post[1:]
-                    self.__cmd2.append("#%dJ=%d"%(m.ax,int(post[1:])))                                                    
+                    self.__cmd2.append((m, "#%dJ=%d"%(m.ax,int(post[1:]))))                                                    
                     lim_mtrs.append(m)
                     z_mtrs.append(m)                    
                 elif post not in (None, 0, "0"):
                     # go to post
-                    self.__cmd2.append("#%dJ=%d"%(m.ax,post))
+                    self.__cmd2.append((m, "#%dJ=%d"%(m.ax,post)))
                     lim_mtrs.append(m)                    
             # add the commands, wait for the moves to complete
-            self.__write_cmds(f,"PostHomeMove", lim_mtrs = lim_mtrs)
+            self.__write_cmds(out,"PostHomeMove", lim_mtrs = lim_mtrs)
             # make the current position zero if required
             if z_mtrs:
-                cmds = ["#%dhmz"%m.ax for m in z_mtrs]
-                f.write('\t;---- Make current position zero ----\n')
-                self.__check_not_aborted(f) 
-                f.write("\t\tcmd \"" + " ".join(cmds)+"\"\n")                
-                f.write('\tendif\n\n')  
+                cmds = [(m, "#%dhmz"%m.ax) for m in z_mtrs]
+                out.append('\t;---- Make current position zero ----\n')
+                self.__check_not_aborted(out) 
+                self.__write_cmd_set_to_file(out, cmds, use_cmd=True)
+                out.append('\tendif\n\n')  
+
+            # wait for any other PLCs homing this group
+            if self.workers.get(g):
+                self.__wait_for_workers(out, self.workers[g])
+
+            # record that the group is complete
+            if self.resume is not None:
+                out.append("\t;---- Mark group %d complete ----\n" % g)
+                self.__check_not_aborted(out)
+                out.append("\t\tP%d=P%d|%d\n" % (self.resume, self.resume,
+                    1 << g))
+                out.append("\tendif\n\n")
 
             # End of per group bit
-            f.write("endif\n\n")
+            out.append("endif\n\n")
+            yield "".join(out)
+            out = []
 
         #----- Done -----
-        f.write(";---- Done ----\n")
-        self.__check_not_aborted(f, tabs=0)
-        f.write("\t;If we've got this far without failing, set status and state done\n")        
-        f.write('\tHomingStatus=StatusDone\n') 
-        f.write('\tHomingState=StateDone\n') 
-        f.write("\t;Restore the homing group from px03\n")
-        f.write("\tHomingGroup=HomingBackupGroup\n")         
-        f.write("endif\n\n")
+        out.append(";---- Done ----\n")
+        self.__check_not_aborted(out, tabs=0)
+        out.append("\t;If we've got this far without failing, set status and state done\n")        
+        out.append('\tHomingStatus=StatusDone\n') 
+        out.append('\tHomingState=StateDone\n') 
+        out.append("\t;Restore the homing group from px03\n")
+        out.append("\tHomingGroup=HomingBackupGroup\n")         
+        if self.resume is not None:
+            out.append("\t;Clear the resume record, so the next run homes everything\n")
+            out.append("\tP%d=0\n" % self.resume)
+        out.append("endif\n\n")
 
         #----- Tidying Up -----
-        f.write(";---- Tidy Up ----\n")
-        f.write(";Stop all motors if they don't have a following error\n")
-        for m in Motor.instances:
+        out.append(";---- Tidy Up ----\n")
+        out.append(";Stop all motors if they don't have a following error\n")
+        for m in self.motors:
             # if no following error
-            f.write('if (m%d42=0)\n'%m.ax)
-            f.write('\tcmd "#%dJ/"\n'%m.ax)
-            f.write('endif\n')
-        f.write(';Restore the high soft limits from P variables px04..x19\n')   
-        f.write(" ".join(["i%d13=P%d%02d"%(m.ax,plc,m.i+04) for m in Motor.instances])+"\n")
-        f.write(';Restore the low soft limits from P variables px20..x35\n')        
-        f.write(" ".join(["i%d14=P%d%02d"%(m.ax,plc,m.i+20) for m in Motor.instances])+"\n")
-        f.write(';Restore the home capture flags from P variables px36..x51\n')        
+            out.append('if (m%d42=0)\n'%m.ax)
+            out.append('\tcmd "#%dJ/"\n'%m.ax)
+            out.append('endif\n')
+        out.append(';Restore the high soft limits from P variables px04..x19\n')   
+        out.append(" ".join(["i%d13=P%d%02d"%(m.ax,plc,m.i+04) for m in self.motors])+"\n")
+        out.append(';Restore the low soft limits from P variables px20..x35\n')        
+        out.append(" ".join(["i%d14=P%d%02d"%(m.ax,plc,m.i+20) for m in self.motors])+"\n")
+        out.append(';Restore the home capture flags from P variables px36..x51\n')        
         cmds = []
-        for m in Motor.instances:
+        for m in self.motors:
             if hasattr(m, "nx"):
                 cmds.append("i7%02d2=P%d%02d"%(m.nx,plc,m.i+36))
             else:
                 cmds.append("MSW%d,i912,P%d%02d"%(m.ms,plc,m.i+36))   
-        f.write(" ".join(cmds)+"\n")        
-        f.write(';Restore the limit flags to P variables px68..x83\n')        
-        f.write(" ".join(["i%d24=P%d%02d"%(m.ax,plc,m.i+68) for m in Motor.instances])+"\n")
-        f.write("\n")
-        f.write("DISABLE PLC%s\n"%plc)
-        f.write("CLOSE\n")
+        self.__pack(out, cmds, False, tabs="")
+        out.append(';Restore the limit flags to P variables px68..x83\n')        
+        out.append(" ".join(["i%d24=P%d%02d"%(m.ax,plc,m.i+68) for m in self.motors])+"\n")
+        if fast:
+            out.append(";Restore the jog speeds from P variables %d..%d\n" % (
+                self.speed_vars, self.speed_vars + 15))
+            out.append(" ".join(["i%d22=P%d"%(m.ax,self.speed_vars+m.i) for m in fast])+"\n")
+        out.append("\n")
+        out.append("DISABLE PLC%s\n"%plc)
+        out.append("CLOSE\n")
+        yield "".join(out)
+
+# Write the text of plc to a filename f, using the cache of generated text
+# indexed by plc.signature(). Used by PLC.write() and SplitPLC.write()
+def _write(plc, f, cache):
+    text = None
+    if cache is not None:
+        cached = os.path.join(cache, plc.signature() + ".pmc")
+        if os.path.exists(cached):
+            c = open(cached)
+            text = c.read()
+            c.close()
+    if text is None:
+        text = plc.render()
+        if cache is not None:
+            if not os.path.isdir(cache):
+                try:
+                    os.makedirs(cache)
+                except OSError:
+                    # another process may have made it
+                    assert os.path.isdir(cache), \
+                        "Can't make cache dir %s" % cache
+            # write then rename so other processes never see half a file
+            tmp = "%s.%d" % (cached, os.getpid())
+            c = open(tmp, "w")
+            c.write(text)
+            c.close()
+            os.rename(tmp, cached)
+    if os.path.exists(f):
+        old = open(f)
+        same = old.read() == text
+        old.close()
+        if same:
+            return False
+    # open the file and write the text
+    f = open(f,"w")
+    f.write(text)
+    f.close()
+    return True
+
+## A homing PLC for more motors than fit in a single PLC. The motors are
+# split between several PLCs, which are written to the same file. The first
+# PLC is the one that EPICS starts and monitors. It homes part of every group,
+# and for each group it starts the other PLCs that home the rest of it, by
+# setting their HomingGroup and HomingStatus P variables and enabling them,
+# then waits for them to finish before the next group is started. If any PLC
+# fails the others are aborted, and the first PLC takes its HomingStatus.
+#
+# Motors are added and groups configured in the same way as PLC. Within each
+# group the motors are shared out so the predicted homing time of each PLC is
+# balanced, so the parts of a group home concurrently on the controller. A
+# motor that is added more than once stays in the same PLC.
+class SplitPLC:
+    ## \param plcs List of PLC numbers to use, the first is the one started
+    # by EPICS. Only as many PLCs as needed are written.
+    # \param times Dict of axis number -> predicted time to home that axis,
+    # e.g. from \ref hometime. Axes that are not given take 1
+    # \param kwargs Other arguments for PLC(), used by every PLC. The PLCs use
+    # consecutive pairs of P variables from resume, and consecutive blocks of
+    # 16 from speed_vars
+    def __init__(self, plcs, times=None, **kwargs):
+        ## List of PLC numbers
+        self.plcs = [int(p) for p in plcs]
+        self.times = times or {}
+        self.kwargs = kwargs
+        self.comment = ""
+        # list of (axis, kwargs) for add_motor() and (group, kwargs) for
+        # configure_group(), replayed on the PLCs by split()
+        self.__motors = []
+        self.__configs = []
+
+    ## Add a motor for the PLC to home, see PLC.add_motor()
+    def add_motor(self, axis, group=1, **kwargs):
+        self.__motors.append((axis, dict(kwargs, group=group)))
+
+    ## Add code hooks and extra checks to a group home, see
+    # PLC.configure_group(). The checks are done by every PLC homing the
+    # group, pre and post are only run by the first PLC
+    def configure_group(self, group, checks=None, pre=None, post=None):
+        self.__configs.append((group, dict(checks=checks, pre=pre,
+            post=post)))
+
+    ## Share out the motors between the PLCs
+    # \return Dict of axis number -> index into self.plcs
+    def assign(self):
+        groups = {}
+        for axis, args in self.__motors:
+            if axis not in groups.get(args["group"], []):
+                groups.setdefault(args["group"], []).append(axis)
+        naxes = len(set([axis for axis, args in self.__motors]))
+        assert naxes <= 16 * len(self.plcs), \
+            "%d motors need at least %d PLCs" % (naxes, (naxes + 15) / 16)
+        home = {}
+        count = [0] * len(self.plcs)
+        load = [0] * len(self.plcs)
+        # the first PLC needs a motor in each group to run its pre and post
+        # code and start the others, so keep room for them
+        lead_needs = set(groups)
+        for g in sorted(groups):
+            if [a for a in groups[g] if home.get(a) == 0]:
+                lead_needs.discard(g)
+            axes = [a for a in groups[g] if a not in home]
+            axes.sort(key=lambda a: -self.times.get(a, 1))
+            assert axes or g not in lead_needs, \
+                "PLC%d can't have a motor in group %d, as its motors are " \
+                "in other PLCs" % (self.plcs[0], g)
+            for axis in axes:
+                if g in lead_needs:
+                    i = 0
+                else:
+                    room = [i for i in range(len(self.plcs))
+                        if count[i] < 16 - (i == 0) * len(lead_needs)]
+                    i = min(room, key=lambda i: (load[i], count[i], i))
+                home[axis] = i
+                count[i] += 1
+                load[i] += self.times.get(axis, 1)
+                if i == 0:
+                    lead_needs -= set([h for h in groups if axis in groups[h]])
+        return home
+
+    ## Make the PLCs
+    # \return List of PLC objects, the first is the one started by EPICS
+    def split(self):
+        home = self.assign()
+        plcs = []
+        for i, num in enumerate(self.plcs):
+            kwargs = dict(self.kwargs)
+            # each PLC needs its own resume and speed P variables
+            if kwargs.get("resume") is not None:
+                kwargs["resume"] = int(kwargs["resume"]) + 2 * i
+            if kwargs.get("speed_vars") is not None:
+                kwargs["speed_vars"] = int(kwargs["speed_vars"]) + 16 * i
+            plc = PLC(num, **kwargs)
+            for axis, args in self.__motors:
+                if home[axis] == i:
+                    plc.add_motor(axis, **args)
+            if plc.motors:
+                plcs.append(plc)
+        lead = plcs[0]
+        for plc in plcs[1:]:
+            plc.comment = "; Started by PLC%d to home part of each group\n" \
+                % lead.plc
+            for g in plc.groups:
+                lead.workers.setdefault(g, []).append(plc.plc)
+        lead.comment = self.comment
+        if len(plcs) > 1:
+            lead.comment += "; Homes each group with PLC%s\n" % ", ".join(
+                [str(p.plc) for p in plcs[1:]])
+        for g, args in self.__configs:
+            lead.configure_group(g, **args)
+            for plc in plcs[1:]:
+                if g in plc.groups and args["checks"] is not None:
+                    plc.configure_group(g, checks=args["checks"])
+        return plcs
+
+    ## Return a hash of everything that affects the generated text
+    def signature(self):
+        config = (generator_version, self.plcs, sorted(self.times.items()),
+            sorted(self.kwargs.items()), self.comment, self.__motors,
+            self.__configs)
+        return hashlib.md5(repr(config)).hexdigest()
+
+    ## Write the text of all the PLCs to a filename string f, see PLC.write()
+    def write(self, f, cache=None):
+        return _write(self, f, cache)
+
+    ## Write the text of all the PLCs to a file object f
+    def writeFile(self, f):
+        for chunk in self.chunks():
+            f.write(chunk)
+
+    ## Return the text of all the PLCs as a string
+    def render(self):
+        return "".join(self.chunks())
+
+    ## Generator that produces the text of each PLC in chunks
+    def chunks(self):
+        for plc in self.split():
+            for chunk in plc.chunks():
+                yield chunk
+
+## States that a homing PLC goes through, from the least to the most
+# advanced, used by Supervisor to report the least advanced worker
+state_order = ["Configuring", "PreHomeMove", "FastSearch", "FastRetrace",
+    "Homing", "PostHomeMove"]
+
+## A supervisor PLC that homes several independent sets of axes in parallel.
+# Each set is a worker PLC (or SplitPLC) with its own groups, which are homed
+# in sequence as usual, but the workers run at the same time in their own PLC
+# slots. EPICS starts and monitors the supervisor in the same way as a single
+# homing PLC: the autohome.template PLC macro should be the supervisor's
+# number.
+#
+# When started, the supervisor starts every worker that has a motor in the
+# requested group (all of them for group 1) by setting its HomingGroup and
+# HomingStatus P variables and enabling it. While any are homing its
+# HomingState is the state of the least advanced worker. When they have all
+# finished its HomingStatus is Done, or the status of the first worker that
+# failed. Aborting the supervisor aborts all the workers.
+#
+# Example:
+# \verbatim
+# s = Supervisor(20, ctype=GEOBRICK)
+# p = PLC(21, ctype=GEOBRICK)
+# p.add_motor(1, group=2, htype=HSW)
+# p.add_motor(2, group=3, htype=LIMIT)
+# s.add_plc(p)
+# p = PLC(22, ctype=GEOBRICK)
+# p.add_motor(5, htype=LIMIT)
+# s.add_plc(p)
+# s.write("PLCs/PLC20_ALL_HM.pmc")
+# \endverbatim
+class Supervisor:
+    ## \param plc Supervisor PLC number, started by EPICS
+    # \param ctype The controller type, PMAC or GEOBRICK
+    # \param allow_debug Honour StatusDebugHoming as well as StatusHoming, as
+    # PLC() does
+    def __init__(self, plc, ctype=PMAC, allow_debug=True):
+        ## plc number
+        self.plc = int(plc)
+        self.ctype = ctype
+        self.allow_debug = allow_debug
+        self.comment = ""
+        ## List of worker PLC or SplitPLC objects, in the order they were added
+        self.workers = []
+        # list of the PLC objects of each worker, a SplitPLC is split once
+        # when it is added
+        self.__plcs = []
+
+    ## Add a worker PLC or SplitPLC, which must not home any of the axes of
+    # the other workers. A SplitPLC is split when it is added, so must have
+    # its motors, groups and comment set up first
+    def add_plc(self, plc):
+        # the started flags px04..x19 allow 16 workers, px20 comes next
+        assert len(self.workers) < 16, "Supervisor PLC%d can't have more " \
+            "than 16 workers" % self.plc
+        if isinstance(plc, SplitPLC):
+            plcs = plc.split()
+        else:
+            plcs = [plc]
+        axes = set([m.ax for m in plcs[0].motors])
+        for w in self.__plcs:
+            common = axes & set([m.ax for m in w[0].motors])
+            assert not common, "Axes %s are homed by two workers" % \
+                sorted(common)
+        self.workers.append(plc)
+        self.__plcs.append(plcs)
+
+    ## Return a hash of everything that affects the generated text
+    def signature(self):
+        config = (generator_version, self.plc, self.ctype, self.allow_debug,
+            self.comment, [w.signature() for w in self.workers])
+        return hashlib.md5(repr(config)).hexdigest()
+
+    ## Write the text of the supervisor and workers to a filename string f,
+    # see PLC.write()
+    def write(self, f, cache=None):
+        return _write(self, f, cache)
+
+    ## Write the text of the supervisor and workers to a file object f
+    def writeFile(self, f):
+        for chunk in self.chunks():
+            f.write(chunk)
+
+    ## Return the text of the supervisor and workers as a string
+    def render(self):
+        return "".join(self.chunks())
+
+    ## Generator that produces the text of the supervisor, then each worker
+    def chunks(self):
+        assert self.workers, "Supervisor PLC%d has no workers" % self.plc
+        leads = [w[0] for w in self.__plcs]
+        plc = self.plc
+        if self.ctype == PMAC:
+            controller = "PMAC"
+        else:
+            controller = "GeoBrick"
+        comment = self.comment
+        for i, w in enumerate(leads):
+            comment += "; Worker PLC%d: groups %s, axes %s\n" % (w.plc,
+                ", ".join([str(g) for g in sorted(w.groups)]),
+                ", ".join([str(m.ax) for m in w.motors]))
+        if self.allow_debug:
+            homing = "HomingStatus = StatusHoming or HomingStatus = " \
+                "StatusDebugHoming"
+            aborted = "HomingStatus != StatusHoming and HomingStatus != " \
+                "StatusDebugHoming"
+        else:
+            homing = "HomingStatus = StatusHoming"
+            aborted = "HomingStatus != StatusHoming"
+        out = [header % dict(plc=plc, controller=controller, comment=comment)]
+        out.append("if (HomingStatus != StatusHoming)\n")
+        if self.allow_debug:
+            out.append("and (HomingStatus != StatusDebugHoming)\n")
+        out.append("\tHomingStatus = StatusHoming\n")
+        out.append("endif\n\n")
+        # P variables px04.. say which workers were started, px20 and px21
+        # are the number of workers running and the least advanced state
+        started = ["P%d%02d" % (plc, i + 4) for i in range(len(leads))]
+        running = "P%d20" % plc
+        state = "P%d21" % plc
+        out.append(";---- Configuring State ----\n")
+        out.append("HomingState=StateConfiguring\n")
+        out.append(";Save the Homing group to px03\n")
+        out.append("HomingBackupGroup=HomingGroup\n")
+        out.append(";Start the workers that home this group, and mark them "
+            "as started in px04..x%02d\n" % (len(leads) + 3))
+        out.append(" ".join(["%s=0" % p for p in started]) + "\n")
+        for p, w in zip(started, leads):
+            groups = sorted(set([1] + w.groups.keys()))
+            out.append("if (%s)\n" % " or ".join(
+                ["HomingBackupGroup = %d" % g for g in groups]))
+            if len(w.groups) == 1 and 1 in w.groups:
+                # a worker with only group 1 homes it for any group
+                out.append("\tP%d02=1" % w.plc)
+            else:
+                out.append("\tP%d02=HomingBackupGroup" % w.plc)
+            out.append(" P%d01=StatusHoming %s=1\n" % (w.plc, p))
+            out.append("\tENABLE PLC%d\n" % w.plc)
+            out.append("endif\n")
+        out.append(";If no worker homes this group then it is invalid\n")
+        out.append("if (%s)\n" % " and ".join(["%s=0" % p for p in started]))
+        out.append("\tHomingStatus=StatusInvalid\n")
+        out.append("endif\n\n")
+        out.append(";---- Wait for the workers ----\n")
+        out.append(";Count the running workers in px20, and show the state of "
+            "the least advanced one\n")
+        out.append("%s=1\n" % running)
+        out.append("while (%s)\n" % homing)
+        out.append("and (%s>0)\n" % running)
+        out.append("\t%s=0\n" % running)
+        for p, w in zip(started, leads):
+            out.append("\tif (%s=1 and P%d01=StatusHoming)\n" % (p, w.plc))
+            out.append("\t\t%s=%s+1\n" % (running, running))
+            out.append("\tendif\n")
+        out.append("\t%s=StateDone\n" % state)
+        for s in reversed(state_order):
+            conds = ["(%s=1 and P%d01=StatusHoming and P%d00=State%s)" % (
+                p, w.plc, w.plc, s) for p, w in zip(started, leads)]
+            out.append("\tif " + "\n\tor ".join(conds) + "\n")
+            out.append("\t\t%s=State%s\n" % (state, s))
+            out.append("\tendif\n")
+        out.append("\tif (%s>0)\n" % running)
+        out.append("\t\tHomingState=%s\n" % state)
+        out.append("\tendif\n")
+        out.append("endw\n\n")
+        out.append(";---- Done ----\n")
+        out.append(";Abort the workers if we were aborted\n")
+        out.append("if (%s)\n" % aborted)
+        for p, w in zip(started, leads):
+            out.append("\tif (%s=1 and P%d01=StatusHoming)\n" % (p, w.plc))
+            out.append("\t\tP%d01=StatusAborted\n" % w.plc)
+            out.append("\tendif\n")
+        out.append("endif\n")
+        out.append(";Fail with the status of the first worker that failed\n")
+        for p, w in zip(started, leads):
+            out.append("if (%s)\n" % homing)
+            out.append("and (%s=1 and P%d01!=StatusDone)\n" % (p, w.plc))
+            out.append("\tHomingStatus = P%d01\n" % w.plc)
+            out.append("endif\n")
+        out.append("if (%s)\n" % homing)
+        out.append("\tHomingStatus=StatusDone\n")
+        out.append("\tHomingState=StateDone\n")
+        out.append("\t;Restore the homing group from px03\n")
+        out.append("\tHomingGroup=HomingBackupGroup\n")
+        out.append("endif\n\n")
+        out.append("DISABLE PLC%d\n" % plc)
+        out.append("CLOSE\n")
+        yield "".join(out)
+        for plcs in self.__plcs:
+            for w in plcs:
+                for chunk in w.chunks():
+                    yield chunk
 
 header = """CLOSE
 
@@ -0,0 +1,195 @@
+#!/usr/bin/env dls-python
+## \namespace motorhome_batch
+# This contains helper functions for making the homing PLCs of many
+# controllers in one go, using a pool of processes.
+#
+# The PLCs are described by a JSON manifest, which is a list of entries. Each
+# entry gives the controller directory, plc number, name and the arguments
+# that would otherwise be passed to \ref motorhome::PLC "PLC()",
+# \ref motorhome::PLC::add_motor "PLC.add_motor()" and
+# \ref motorhome::PLC::configure_group "PLC.configure_group()". htypes and
+# ctypes are given by name. E.g.
+# \verbatim
+# [
+#   {"controller": "BL22B-MO-STEP-01", "plc": 10, "name": "S1",
+#    "ctype": "GEOBRICK", "post": "i",
+#    "motors": [{"axis": 1, "htype": "HSW", "jdist": -1000},
+#               {"axis": 2, "htype": "HSW", "jdist": -1000}]},
+#   {"controller": "BL22B-MO-STEP-02", "plc": 11, "name": "BOX1Z",
+#    "ctype": "GEOBRICK", "post": "i",
+#    "motors": [{"axis": 5, "htype": "LIMIT", "group": 2,
+#                "jdist_overrides": [null, 1000, null]}],
+#    "groups": {"2": {"checks": [["m531", "0", 5]]}}}
+# ]
+# \endverbatim
+# will write \c BL22B-MO-STEP-01/PLCs/PLC10_S1_HM.pmc and
+# \c BL22B-MO-STEP-02/PLCs/PLC11_BOX1Z_HM.pmc relative to the directory of
+# the manifest. The manifest may also be YAML, and is checked before any PLC
+# is made, see \ref homemanifest for the schema. The \c "model" of a motor is
+# used by \ref hometime, and is ignored here. An entry with more than 16
+# motors gives a list of \c "extra_plcs" numbers, and is made as a
+# \ref motorhome::SplitPLC "SplitPLC" that shares the motors out using the
+# \c "time" of each motor. An entry with a list of \c "workers" instead of
+# \c "motors" is made as a \ref motorhome::Supervisor "Supervisor" that homes
+# the workers in parallel. Generated PLCs are cached by their
+# \ref motorhome::PLC::signature "signature", so a PLC is only made again if
+# its entry or motorhome.py has changed, and outputs that would not change are
+# left untouched.
+#
+# Example invocation:
+# \verbatim
+#   dls-python motorhome_batch.py -j 8 iocs/pmc_builder/homing.json
+# \endverbatim
+
+import os, sys
+from multiprocessing import Pool
+from optparse import OptionParser
+
+import motorhome
+from homemanifest import load, ManifestError
+
+## Keyword arguments of an entry that are passed to motorhome.PLC()
+plc_args = ["timeout", "htype", "jdist", "post", "ctype", "allow_debug",
+    "resume", "search_speed", "speed_vars"]
+## Keyword arguments of a motor that are passed to motorhome.PLC.add_motor()
+motor_args = ["group", "htype", "jdist", "jdist_overrides", "post",
+    "enc_axes", "ms", "search_speed"]
+
+## Load a manifest from a JSON or YAML file, exiting with an error for each
+# problem found in it
+# \param filename Path to the manifest
+# \return List of entries
+def load_manifest(filename):
+    try:
+        return load(filename, require=["controller"])
+    except ManifestError, e:
+        for error in e.errors:
+            sys.stderr.write("***Error: %s:%d: %s\n" % error)
+        sys.exit(1)
+
+## Turn an htype or ctype name like "HSW" or "GEOBRICK" into its value
+def _enum(value):
+    if isinstance(value, str):
+        return getattr(motorhome, value)
+    return value
+
+## Return the entries of the homing PLCs that do the work for an entry: its
+# workers if it is a supervisor, with the supervisor's controller and PLC
+# arguments unless they give their own, or the entry itself
+# \param entry Dict describing the PLC, see \ref motorhome_batch
+# \return List of entries
+def plc_entries(entry):
+    if "workers" not in entry:
+        return [entry]
+    args = dict((k, entry[k]) for k in ["controller"] + plc_args
+        if k in entry)
+    return [dict(args, **worker) for worker in entry["workers"]]
+
+## Make a motorhome.PLC object from a manifest entry
+# \param entry Dict describing the PLC, see \ref motorhome_batch
+# \return Configured PLC object, or motorhome.Supervisor if the entry has
+# workers
+def make_plc(entry):
+    if "workers" in entry:
+        ctype = _enum(entry.get("ctype", motorhome.PMAC))
+        plc = motorhome.Supervisor(entry["plc"], ctype=ctype,
+            allow_debug=entry.get("allow_debug", True))
+        for worker in plc_entries(entry):
+            plc.add_plc(make_plc(worker))
+        return plc
+    kwargs = dict((k, entry[k]) for k in plc_args if k in entry)
+    for k in ("htype", "ctype"):
+        if k in kwargs:
+            kwargs[k] = _enum(kwargs[k])
+    if entry.get("extra_plcs"):
+        times = dict((m["axis"], m["time"]) for m in entry["motors"]
+            if "time" in m)
+        plc = motorhome.SplitPLC([entry["plc"]] + entry["extra_plcs"],
+            times=times, **kwargs)
+    else:
+        plc = motorhome.PLC(entry["plc"], **kwargs)
+    for motor in entry["motors"]:
+        kwargs = dict((k, motor[k]) for k in motor_args if k in motor)
+        if "htype" in kwargs:
+            kwargs["htype"] = _enum(kwargs["htype"])
+        if kwargs.get("jdist_overrides") is not None:
+            kwargs["jdist_overrides"] = tuple(kwargs["jdist_overrides"])
+        plc.add_motor(motor["axis"], **kwargs)
+    for group, config in sorted(entry.get("groups", {}).items()):
+        checks = config.get("checks")
+        if checks is not None:
+            checks = [tuple(c) for c in checks]
+        plc.configure_group(int(group), checks=checks,
+            pre=config.get("pre"), post=config.get("post"))
+    return plc
+
+## Return the filename that the PLC for a manifest entry is written to
+# \param root Directory that contains the controller directories
+# \param entry Dict describing the PLC
+def output_filename(root, entry):
+    return os.path.join(root, entry["controller"], "PLCs",
+        "PLC%d_%s_HM.pmc" % (entry["plc"], entry["name"]))
+
+# Worker for the process pool, make and write a single plc, returning
+# (written, error message or None)
+def _write_plc(args):
+    entry, filename, cache = args
+    try:
+        return make_plc(entry).write(filename, cache), None
+    except (IOError, OSError), e:
+        return False, "%s: %s" % (filename, e.strerror or e)
+
+## Make and write the homing PLCs for all the entries in a manifest
+# \param entries List of manifest entries
+# \param root Directory that contains the controller directories
+# \param cache Directory to cache generated PLCs in, see motorhome.PLC.write()
+# \param processes Number of worker processes, defaults to the number of cpus
+# \return List of filenames that were written. If any can't be written, the
+# errors are printed and the program exits
+def write_all(entries, root, cache=None, processes=None):
+    jobs = [(entry, output_filename(root, entry), cache) for entry in entries]
+    if processes == 1 or len(jobs) < 2:
+        written = map(_write_plc, jobs)
+    else:
+        pool = Pool(processes)
+        try:
+            written = pool.map(_write_plc, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    errors = [error for w, error in written if error]
+    for error in errors:
+        sys.stderr.write("***Error: %s\n" % error)
+    if errors:
+        sys.exit(1)
+    return [job[1] for job, (w, error) in zip(jobs, written) if w]
+
+def main():
+    parser = OptionParser("usage: %prog [options] <manifest> [<root>]\n"
+        "Make the homing PLCs described in <manifest>. Outputs are written "
+        "relative to <root>, which defaults to the directory of <manifest>")
+    parser.add_option("-j", "--jobs", type="int", default=None,
+        help="Number of processes to use, defaults to the number of cpus")
+    parser.add_option("-c", "--cache", default=os.environ.get(
+        "MOTORHOME_CACHE", os.path.expanduser("~/.motorhome_cache")),
+        help="Directory to cache generated PLCs in, defaults to "
+        "$MOTORHOME_CACHE or ~/.motorhome_cache")
+    parser.add_option("-f", "--force", action="store_true", default=False,
+        help="Make all PLCs, even if they are cached")
+    options, args = parser.parse_args()
+    if len(args) not in (1, 2):
+        parser.error("Incorrect number of arguments")
+    manifest = args[0]
+    if len(args) > 1:
+        root = args[1]
+    else:
+        root = os.path.dirname(manifest)
+    cache = options.cache
+    if options.force:
+        cache = None
+    for filename in write_all(load_manifest(manifest), root, cache,
+            options.jobs):
+        print "*** Autogenerated homing plc \"%s\"" % filename
+
+if __name__ == "__main__":
+    main()
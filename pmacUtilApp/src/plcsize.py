@@ -0,0 +1,250 @@
+#!/usr/bin/env dls-python
+## \namespace plcsize
+# This contains a static analysis pass that estimates the size and background
+# scan cost of PMAC PLCs, in particular the homing PLCs generated by
+# \ref motorhome. It can be used to fail a build if a PLC is over budget.
+#
+# For each PLC buffer (OPEN PLC .. CLOSE) in a pmc file it reports:
+# - the number of statements
+# - an estimate of the number of compiled words. This counts one word per
+# statement plus one per operand and operator, and 3 characters per word for
+# cmd strings. It is only meant for comparing PLCs, not as an exact figure
+# - the P variables that are used, as ranges
+# - for each homing group and state (or the whole PLC if it isn't a homing
+# PLC) the burst cost: the most words that can be run in a single scan
+# before reaching an ENDWHILE, and the scan cost: the words run every
+# background scan while waiting in a WHILE loop
+#
+# Example invocation:
+# \verbatim
+#   dls-python plcsize.py --max-words=4000 --max-scan=150 PLCs/*_HM.pmc
+# \endverbatim
+# This prints a report for each PLC, and exits with an error if any PLC is
+# over budget. The same checks are run on the homing PLCs made by
+# configure/PMC_RULES if HOMING_BUDGET is set to the options to pass.
+
+import sys, re
+from optparse import OptionParser
+
+from pmcparse import Parser, variables
+
+_token_re = re.compile(r'[A-Za-z_]+\d*|\$[0-9A-Fa-f]+|\d+\.?\d*|[-+*/&|^%<>=!~]+')
+_state_re = re.compile(r'HomingState\s*=\s*State(\w+)')
+_group_re = re.compile(r'HomingGroup\s*=\s*(\d+)')
+
+## Return an estimate of the number of compiled words for a Statement
+def words(statement):
+    if statement.kind == "cmd":
+        return 1 + (len(statement.cond) + 2) / 3
+    if statement.kind in ("if", "while", "and", "or"):
+        text = statement.cond
+    elif statement.kind in ("assign", "other"):
+        text = statement.text
+    else:
+        text = ""
+    n = 1 + len(_token_re.findall(text))
+    if statement.inline:
+        n += words(statement.inline)
+    return n
+
+## Turn a list of numbers into a list of (first, last) ranges
+def ranges(numbers):
+    out = []
+    for n in sorted(set(numbers)):
+        if out and out[-1][1] == n - 1:
+            out[-1] = (out[-1][0], n)
+        else:
+            out.append((n, n))
+    return out
+
+## Format a list of (first, last) ranges like P1100..1103,P1110
+def format_ranges(letter, rngs):
+    txt = []
+    for first, last in rngs:
+        if first == last:
+            txt.append("%s%d" % (letter, first))
+        else:
+            txt.append("%s%d..%d" % (letter, first, last))
+    return ",".join(txt)
+
+## Cost of a homing state in a single group
+class Phase:
+    def __init__(self, group, state):
+        ## Homing group number, or None if not in a group
+        self.group = group
+        ## Name of the homing state, e.g. "FastSearch", or "Main" if not a
+        ## homing PLC
+        self.state = state
+        ## Number of statements and estimated words
+        self.statements = 0
+        self.words = 0
+        ## Most words run in one scan before reaching an ENDWHILE
+        self.burst = 0
+        ## Most words run every scan while waiting in a WHILE loop
+        self.scan = 0
+
+## Results of analysing a single PLC buffer
+class Report:
+    def __init__(self, plc, filename):
+        ## PLC number (as a string, it may be a macro) and source filename
+        self.plc = plc
+        self.filename = filename
+        ## Number of statements and estimated words
+        self.statements = 0
+        self.words = 0
+        ## List of (first, last) ranges of P variables used by the file
+        self.pvars = []
+        ## List of Phase objects in the order they appear
+        self.phases = []
+
+    ## Number of P variables used
+    def npvars(self):
+        return sum([last - first + 1 for first, last in self.pvars])
+
+    ## Most words run in a single scan by any phase
+    def burst(self):
+        return max([p.burst for p in self.phases] + [0])
+
+    ## Most words run every scan while waiting by any phase
+    def scan(self):
+        return max([p.scan for p in self.phases] + [0])
+
+    def __str__(self):
+        lines = ["PLC%s (%s): %d statements, ~%d words, %d P variables %s" % (
+            self.plc, self.filename, self.statements, self.words,
+            self.npvars(), format_ranges("P", self.pvars))]
+        lines.append("  %-6s %-16s %10s %6s %6s %6s" % (
+            "group", "state", "statements", "words", "burst", "scan"))
+        for p in self.phases:
+            if p.group is None:
+                group = "-"
+            else:
+                group = str(p.group)
+            lines.append("  %-6s %-16s %10d %6d %6d %6d" % (
+                group, p.state, p.statements, p.words, p.burst, p.scan))
+        return "\n".join(lines)
+
+## Analyse the PLC buffers in the text of a pmc file
+# \param text Contents of the pmc file
+# \param filename Filename to report
+# \return List of Report objects, one for each PLC buffer
+def analyse(text, filename="<string>"):
+    statements = Parser().parse(text, filename)
+    pvars = []
+    for s in statements:
+        if s.kind not in ("define", "include"):
+            pvars += [n for letter, first, last in variables(s.text)
+                if letter == "P" for n in range(first, last + 1)]
+    pvars = ranges(pvars)
+    reports = []
+    report = None
+    for s in statements:
+        if s.kind == "open" and s.cond.upper().startswith("PLC"):
+            plc = s.cond[3:].split()[0]
+            report = Report(plc, filename)
+            report.pvars = pvars
+            reports.append(report)
+            group = None
+            phase = None
+            phases = {}
+            # words run since the start of the scan, and the words at the
+            # start of each WHILE loop we are in
+            burst = 0
+            loops = []
+            continue
+        if report is None:
+            continue
+        if s.kind == "close":
+            if phase is not None:
+                phase.burst = max(phase.burst, burst)
+            report = None
+            continue
+        # find which group and state we are in from the source line
+        new_group = False
+        match = _group_re.search(s.raw)
+        if match and s.kind == "assign":
+            new_group = int(match.group(1)) != group
+            group = int(match.group(1))
+        match = _state_re.search(s.raw)
+        if match and s.kind == "assign":
+            state = match.group(1)
+        elif phase is None:
+            state = "Main"
+        elif new_group:
+            # the lines before PreHomeMove set up the new group
+            state = "Configuring"
+        else:
+            state = phase.state
+        if phase is None or (group, state) != (phase.group, phase.state):
+            if phase is not None:
+                phase.burst = max(phase.burst, burst)
+            if (group, state) not in phases:
+                phases[(group, state)] = Phase(group, state)
+                report.phases.append(phases[(group, state)])
+            phase = phases[(group, state)]
+        n = words(s)
+        report.statements += 1
+        report.words += n
+        phase.statements += 1
+        phase.words += n
+        if s.kind == "while" and not s.inline:
+            loops.append(burst)
+        burst += n
+        if s.kind == "endwhile" and loops:
+            # the loop runs once every scan until its condition is false
+            start = loops.pop()
+            phase.scan = max(phase.scan, burst - start)
+            phase.burst = max(phase.burst, burst)
+            burst = burst - start
+    return reports
+
+## Check reports against a budget
+# \param reports List of Report objects
+# \param budget Dict of limits, with keys "statements", "words", "pvars",
+# "burst" and "scan". Missing keys are not checked
+# \return List of error messages
+def check(reports, budget):
+    errors = []
+    for r in reports:
+        for name, value in [("statements", r.statements),
+                ("words", r.words), ("pvars", r.npvars()),
+                ("burst", r.burst()), ("scan", r.scan())]:
+            limit = budget.get(name)
+            if limit is not None and value > limit:
+                errors.append("PLC%s (%s): %s of %d is over the budget of "
+                    "%d" % (r.plc, r.filename, name, value, limit))
+    return errors
+
+def main():
+    parser = OptionParser("usage: %prog [options] <pmc_file> ...\n"
+        "Estimate the size and scan cost of the PLCs in some pmc files")
+    for name, help in [
+            ("statements", "statements in a PLC"),
+            ("words", "estimated compiled words in a PLC"),
+            ("pvars", "P variables used by a file"),
+            ("burst", "words run in a single scan"),
+            ("scan", "words run every scan while waiting")]:
+        parser.add_option("--max-" + name, type="int", dest=name,
+            help="Fail if there are more than this many " + help)
+    parser.add_option("-q", "--quiet", action="store_true", default=False,
+        help="Only print errors")
+    options, args = parser.parse_args()
+    if not args:
+        parser.error("No pmc files given")
+    budget = {}
+    for name in ("statements", "words", "pvars", "burst", "scan"):
+        budget[name] = getattr(options, name)
+    errors = []
+    for filename in args:
+        reports = analyse(open(filename).read(), filename)
+        if not options.quiet:
+            for r in reports:
+                print r
+        errors += check(reports, budget)
+    for error in errors:
+        sys.stderr.write("***Error: %s\n" % error)
+    if errors:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,353 @@
+#!/usr/bin/env dls-python
+## \namespace pmclint
+# This contains a static checker for pmc files, both the homing PLCs
+# generated by \ref motorhome and the hand-written ones in pmacUtilApp/pmc.
+# It uses \ref pmcparse to read the files, and reports all the problems it
+# finds in a single pass. The checks are:
+# - blocks: IF/ENDIF and WHILE/ENDWHILE are balanced, ELSE, AND and OR are
+# where they should be, and each OPEN buffer is closed before the next
+# - lines: no line is longer than the PMAC will accept
+# - pvars: no P variable is written by two different PLCs or PROGs, none
+# of them writes to the Pxx00..xx99 block of a \ref motorhome PLC other than the
+# HomingState, HomingStatus, HomingGroup and HomingBackupGroup variables
+# used to start and monitor it, and no PLC is defined by two files
+# - mvars: every M variable that is used has a definition (Mxx->). This is
+# only checked if some definitions have been seen, e.g. by linting a
+# Master.pmc that includes BRICK_M_variables.pmc
+# - include: every \#include file exists
+#
+# Each file given is treated as the whole download to one controller, and is
+# checked along with every file it includes, in order, so P variables are
+# compared between all the PLCs that are loaded onto the same controller.
+#
+# Example invocation:
+# \verbatim
+#   dls-python pmclint.py BL22B-MO-STEP-01/Master.pmc pmacUtilApp/pmc/*.pmc
+# \endverbatim
+# This prints each problem as filename:line: check: message, and exits with
+# an error if there were any. The same checks are run on the Master.pmc of
+# each controller by configure/PMC_RULES if PMC_LINT is set.
+
+import os, re, sys
+from optparse import OptionParser
+
+from pmcparse import Parser, variables, block_start, conditions, \
+    strip_comment, expand_macros, buffer_name, owned, handshake_pvars, \
+    homing_plc, write_conflicts
+from plcsize import ranges, format_ranges
+
+## Names of all the checks
+all_checks = ["blocks", "lines", "pvars", "mvars", "include"]
+## Longest line the PMAC will accept
+max_line = 255
+
+_mdef_re = re.compile(r'^M(\d+)(?:\.\.(\d+))?->', re.I)
+_pvar_re = re.compile(r'^P(\d+)$', re.I)
+_msr_re = re.compile(r'^MSR\d+,\w+,P(\d+)', re.I)
+_macro_re = re.compile(r'\$\(')
+
+## A problem found in a pmc file
+class Finding:
+    def __init__(self, filename, line, check, message):
+        ## Filename and line number of the problem
+        self.filename = filename
+        self.line = line
+        ## Name of the check that found it, one of all_checks
+        self.check = check
+        self.message = message
+
+    def __str__(self):
+        return "%s:%d: %s: %s" % (self.filename, self.line, self.check,
+            self.message)
+
+## Checker for a set of pmc files. Lint each file with lint_file(), then call
+# finish() to do the checks that compare files and get the findings.
+class Linter:
+    ## \param checks List of names of checks to run, see all_checks
+    # \param max_line Longest line allowed
+    # \param macros Dict of msi macro values to substitute, see
+    # pmcparse.expand_macros()
+    # \param follow If True, lint the files that are \#included as well
+    def __init__(self, checks=all_checks, max_line=max_line, macros=None,
+            follow=True):
+        self.checks = set(checks)
+        self.max_line = max_line
+        self.follow = follow
+        self.parser = Parser(macros=macros)
+        ## List of Finding objects
+        self.findings = []
+        ## List of the absolute paths of the files linted
+        self.files = []
+        # P variable -> {owner: (filename, line)} of the writes to it
+        self.__writes = {}
+        # P variables used for the homing handshake
+        self.__handshake = set()
+        # PLC number -> (filename, line) of the motorhome PLCs
+        self.__homing = {}
+        # owner -> (filename, line) where it was opened
+        self.__buffers = {}
+        # list of (first, last) M variable definitions, and M variable ->
+        # (filename, line) of its first use
+        self.__mdefs = []
+        self.__muses = {}
+
+    # Add a finding if its check is enabled
+    def __add(self, filename, line, check, message):
+        if check in self.checks:
+            self.findings.append(Finding(filename, line, check, message))
+
+    ## Lint a file, and the files it includes
+    def lint_file(self, filename):
+        path = os.path.abspath(filename)
+        if path in self.files:
+            return
+        self.files.append(path)
+        self.lint_text(open(filename).read(), filename)
+
+    ## Lint the text of a pmc file
+    # \param text Contents of the file
+    # \param filename Filename to report, and to find includes relative to
+    def lint_text(self, text, filename="<string>"):
+        if "lines" in self.checks:
+            for i, raw in enumerate(text.splitlines()):
+                if len(raw) <= self.max_line:
+                    continue
+                # comments and indentation are not sent to the PMAC
+                if self.parser.macros is not None:
+                    raw = expand_macros(raw, self.parser.macros)
+                line = strip_comment(raw)
+                if len(line) > self.max_line:
+                    self.__add(filename, i + 1, "lines", "Line is %d "
+                        "characters long, the maximum is %d" % (len(line),
+                        self.max_line))
+        statements = self.parser.parse(text, filename)
+        self.__walk(statements, filename)
+
+    # Check the blocks, record the variables, and follow the includes
+    def __walk(self, statements, filename):
+        # stack of [statement, seen an else] for the open if and while blocks
+        stack = []
+        # the open statement and name of the buffer being written
+        opened = None
+        name = None
+        undefined = False
+        prev = None
+        for s, owner, initial in owned(statements):
+            kind = s.kind
+            if undefined and kind not in ("open", "close", "clear"):
+                # the first statement in a buffer defines it
+                undefined = False
+                first = self.__buffers.setdefault(name, (filename,
+                    opened.line))
+                if first[0] != filename:
+                    self.__add(filename, opened.line, "pvars", "%s is also "
+                        "defined in %s:%d" % ((name,) + first))
+            if kind == "define":
+                self.__handshake.update(handshake_pvars(s))
+                plc = homing_plc(s, initial)
+                if plc is not None:
+                    self.__homing[plc] = (filename, s.line)
+            elif kind == "include":
+                path = os.path.join(os.path.dirname(filename), s.cond)
+                if not os.path.exists(path):
+                    self.__add(filename, s.line, "include", "Can't find "
+                        "included file %s" % s.cond)
+                elif self.follow:
+                    self.lint_file(path)
+            elif kind == "open":
+                if opened is not None:
+                    self.__add(filename, s.line, "blocks", "OPEN before the "
+                        "CLOSE of %s opened on line %d" % (name,
+                        opened.line))
+                self.__unclosed(stack, filename, "OPEN")
+                opened = s
+                name, numbered = buffer_name(s)
+                # only PLCs and PROGs are numbered across the controller,
+                # kinematics etc. belong to a coordinate system
+                undefined = numbered and not _macro_re.search(name)
+                # OPEN PLCn CLEAR CLOSE on one line just empties the buffer
+                if s.cond.split()[-1].upper() == "CLOSE":
+                    opened = None
+                    name = None
+                    undefined = False
+            elif kind == "close":
+                self.__unclosed(stack, filename, "CLOSE")
+                opened = None
+                name = None
+                # OPEN PLCn CLEAR CLOSE just empties the buffer
+                undefined = False
+            elif kind in block_start:
+                if opened is None:
+                    self.__add(filename, s.line, "blocks", "%s outside of an "
+                        "OPEN buffer" % kind.upper())
+                if not s.inline:
+                    stack.append([s, False])
+            elif kind in conditions:
+                if prev is None or prev.inline or \
+                        prev.kind not in tuple(block_start) + conditions:
+                    self.__add(filename, s.line, "blocks", "%s is not part "
+                        "of an IF or WHILE condition" % kind.upper())
+            elif kind == "else":
+                if not stack or stack[-1][0].kind != "if":
+                    self.__add(filename, s.line, "blocks", "ELSE without an "
+                        "IF")
+                elif stack[-1][1]:
+                    self.__add(filename, s.line, "blocks", "Second ELSE for "
+                        "the IF on line %d" % stack[-1][0].line)
+                elif s.inline:
+                    # a single line else finishes the if
+                    stack.pop()
+                else:
+                    stack[-1][1] = True
+            elif kind in block_start.values():
+                start = kind[3:]
+                if not stack:
+                    self.__add(filename, s.line, "blocks", "%s without a "
+                        "matching %s" % (kind.upper(), start.upper()))
+                elif stack[-1][0].kind != start:
+                    self.__add(filename, s.line, "blocks", "%s, but the "
+                        "%s on line %d is still open" % (kind.upper(),
+                        stack[-1][0].kind.upper(), stack[-1][0].line))
+                    # assume the inner block was not closed
+                    while stack and stack[-1][0].kind != start:
+                        stack.pop()
+                    if stack:
+                        stack.pop()
+                else:
+                    stack.pop()
+            # record the variables
+            self.__variables(s, filename, owner)
+            if s.inline:
+                self.__variables(s.inline, filename, owner)
+            prev = s
+        if opened is not None:
+            self.__add(filename, opened.line, "blocks", "%s is not closed" %
+                name)
+        self.__unclosed(stack, filename, "the end of the file")
+
+    # Add a finding for each block that is still open
+    def __unclosed(self, stack, filename, where):
+        for s, seen_else in stack:
+            self.__add(filename, s.line, "blocks", "%s is not closed before "
+                "%s" % (s.kind.upper(), where))
+        del stack[:]
+
+    # Record the M variables used or defined, and the P variables written
+    def __variables(self, s, filename, owner):
+        text = s.text
+        match = _mdef_re.match(text)
+        if match:
+            first, last = match.groups()
+            self.__mdefs.append((int(first), int(last or first)))
+            text = text[match.end():]
+        for letter, first, last in variables(text):
+            if letter == "M":
+                for m in range(first, last + 1):
+                    self.__muses.setdefault(m, (filename, s.line))
+        written = None
+        if s.kind == "assign":
+            written = _pvar_re.match(s.target)
+        elif s.kind == "other":
+            written = _msr_re.match(s.text)
+        # files with no buffers only set initial values, so don't own their
+        # P variables
+        if written and owner is not None:
+            self.__writes.setdefault(int(written.group(1)), {}).setdefault(
+                owner, (filename, s.line))
+
+    ## Do the checks that compare files
+    # \return List of all Finding objects, sorted by file and line
+    def finish(self):
+        self.__check_pvars()
+        self.__check_mvars()
+        self.findings.sort(key=lambda f: (f.filename, f.line))
+        return self.findings
+
+    # P variables written by two owners, or inside the block of another
+    # homing PLC
+    def __check_pvars(self):
+        for o, other, ps, claimed in write_conflicts(self.__writes,
+                self.__homing, self.__handshake):
+            filename, line = self.__writes[ps[0]][o]
+            if claimed:
+                where = "in the block of homing %s at %s:%d" % ((other,) +
+                    self.__homing[ps[0] / 100])
+            else:
+                where = "also written by %s at %s:%d" % ((other,) +
+                    self.__writes[ps[0]][other])
+            self.__add(filename, line, "pvars", "%s writes %s, %s" % (o,
+                format_ranges("P", ranges(ps)), where))
+
+    # M variables used without a definition
+    def __check_mvars(self):
+        if not self.__mdefs:
+            return
+        defined = set()
+        for first, last in self.__mdefs:
+            defined.update(range(first, last + 1))
+        undefined = {}
+        for m, where in self.__muses.items():
+            if m not in defined:
+                undefined.setdefault(where, []).append(m)
+        for (filename, line), ms in sorted(undefined.items()):
+            self.__add(filename, line, "mvars", "%s used but not defined" %
+                format_ranges("M", ranges(ms)))
+
+## Lint some pmc files, each one as the download to a separate controller
+# \param filenames List of filenames
+# \param kwargs Arguments for Linter()
+# \return List of Finding objects
+def lint(filenames, **kwargs):
+    findings = []
+    for filename in filenames:
+        linter = Linter(**kwargs)
+        linter.lint_file(filename)
+        findings += linter.finish()
+    return findings
+
+def main():
+    parser = OptionParser("usage: %prog [options] <pmc_file> ...\n"
+        "Check some pmc files, each the download to one controller, for "
+        "unbalanced blocks, long lines, P variable "
+        "collisions and undefined M variables")
+    parser.add_option("-l", "--max-line", type="int", default=max_line,
+        help="Longest line allowed, default %default")
+    parser.add_option("-d", "--disable", action="append", default=[],
+        help="Don't run this check, one of " + ", ".join(all_checks))
+    parser.add_option("-m", "--macro", action="append", default=[],
+        help="NAME=VALUE msi macro to substitute")
+    parser.add_option("-n", "--no-follow", action="store_true",
+        default=False, help="Don't lint the files that are #included")
+    parser.add_option("-q", "--quiet", action="store_true", default=False,
+        help="Don't print a summary")
+    options, args = parser.parse_args()
+    if not args:
+        parser.error("No pmc files given")
+    for name in options.disable:
+        if name not in all_checks:
+            parser.error("Unknown check %s" % name)
+    macros = None
+    if options.macro:
+        macros = dict([m.split("=", 1) for m in options.macro])
+    checks = [c for c in all_checks if c not in options.disable]
+    findings = []
+    files = set()
+    for filename in args:
+        linter = Linter(checks, options.max_line, macros,
+            not options.no_follow)
+        try:
+            linter.lint_file(filename)
+        except IOError, e:
+            sys.stderr.write("***Error: %s\n" % e)
+            sys.exit(1)
+        findings += linter.finish()
+        files.update(linter.files)
+    for f in findings:
+        sys.stderr.write("***Error: %s\n" % f)
+    if not options.quiet:
+        print "Checked %d files, %d problems" % (len(files), len(findings))
+    if findings:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,483 @@
+#!/usr/bin/env dls-python
+## \namespace pmcmap
+# This contains a tool that builds a map of the P, M, I and Q variables used
+# by everything that is loaded onto a controller, and finds the conflicts
+# between them.
+#
+# It walks a Master.pmc and every file it \#includes, in order, including
+# the homing PLCs generated by \ref motorhome. Each variable range that is
+# written, read or defined (Mxx->) is put in an interval index with the
+# buffer (PLC or PROG) that uses it. A \ref motorhome PLC also claims its
+# whole Pxx00..xx99 block. The conflicts are:
+# - a P or I variable written by two different buffers. Q variables belong
+# to the coordinate system a buffer addresses, so they are mapped but not
+# checked
+# - a P variable written inside the block claimed by another homing PLC,
+# other than the HomingState, HomingStatus, HomingGroup and
+# HomingBackupGroup variables used to start and monitor it
+# - an M variable defined to two different addresses
+#
+# Writes outside a buffer are initial values, and belong to the next buffer
+# in the file (or the last one if there isn't a next), so they don't
+# conflict with the PLC that they set up. Files with no buffers don't own
+# the variables they set.
+#
+# Parsing is the slow part, so the summary of each file is cached on disk,
+# keyed by a hash of its contents and the \#define values and macros in
+# effect when it is included. Rebuilding the map after changing one file
+# only parses that file again.
+#
+# Example invocation:
+# \verbatim
+#   dls-python pmcmap.py BL22B-MO-STEP-01/Master.pmc
+#   dls-python pmcmap.py -v P1201 BL22B-MO-STEP-01/Master.pmc
+# \endverbatim
+# The first prints the variables used by each buffer, the second prints
+# everything that uses P1201. Conflicts are printed as errors, and make the
+# exit code non-zero. configure/PMC_RULES runs it on Master.pmc if PMC_MAP is
+# set.
+
+import os, re, sys, hashlib, cPickle
+from bisect import bisect_right
+from optparse import OptionParser
+
+from pmcparse import Parser, variables, block_start, conditions, owned, \
+    handshake_pvars, homing_plc, write_conflicts
+from plcsize import ranges, format_ranges
+
+## Letters of the variables that are mapped
+letters = "PMIQ"
+## Letters of the variables that can't be written by two buffers
+shared_letters = "PI"
+# Bump this when the summaries change so old cache files aren't used
+_cache_version = 2
+
+_mdef_re = re.compile(r'^M(\d+)(?:\.\.(\d+))?->(.*)$', re.I)
+_var_re = re.compile(r'^([PIQ])(\d+)$', re.I)
+_ms_re = re.compile(r'^MS([RW])\d+,\w+,P(\d+)$', re.I)
+
+## A range of variables used by a buffer
+class Use:
+    def __init__(self, letter, first, last, owner, access, filename, line,
+            detail=None):
+        ## Variable letter, one of letters, and the first and last in the
+        # range
+        self.letter = letter
+        self.first = first
+        self.last = last
+        ## Name of the buffer that uses it, like PLC11, or None for initial
+        # values in a file with no buffers
+        self.owner = owner
+        ## "write", "read", "define" or "claim"
+        self.access = access
+        ## Filename and line number of the first use in the range
+        self.filename = filename
+        self.line = line
+        ## For define: the address the M variable points to
+        self.detail = detail
+
+    def name(self):
+        return format_ranges(self.letter, [(self.first, self.last)])
+
+    def where(self):
+        return "%s:%d" % (self.filename, self.line)
+
+    def __repr__(self):
+        return "<Use %s %s %s %s>" % (self.name(), self.owner, self.access,
+            self.where())
+
+## The result of parsing a single file, which is what is cached
+class Summary:
+    def __init__(self, filename):
+        self.filename = filename
+        ## List of Use objects
+        self.uses = []
+        ## List of (filename, line, defines) for each \#include, where
+        # defines is the dict of \#define values in effect at that point
+        self.includes = []
+        ## Dict of the \#define values in effect at the end of the file
+        self.defines = {}
+        ## Set of the P variables that homing PLCs use for their handshake,
+        # see pmcparse.handshake
+        self.handshake = set()
+
+## Parse the text of a file into a Summary
+# \param text Contents of the file
+# \param filename Filename to store in the uses
+# \param defines Dict of \#define values in effect at the start of the file
+# \param macros Dict of msi macro values, see pmcparse.expand_macros()
+def summarise(text, filename="<string>", defines=None, macros=None):
+    parser = Parser(defines, macros)
+    statements = parser.parse(text, filename)
+    summary = Summary(filename)
+    summary.defines = parser.defines
+    # letter, owner, access, detail -> {number: line}
+    found = {}
+    def add(letter, first, last, owner, access, line, detail=None):
+        numbers = found.setdefault((letter, owner, access, detail), {})
+        for n in range(first, last + 1):
+            if n not in numbers:
+                numbers[n] = line
+    # defines at each point, to give to the included files
+    current = dict(defines or {})
+    for s, owner, initial in owned(statements):
+        if s.kind == "define":
+            current[s.target] = s.expr
+            summary.handshake.update(handshake_pvars(s))
+            plc = homing_plc(s, initial)
+            if plc is not None:
+                add("P", plc * 100, plc * 100 + 99, "PLC%d" % plc, "claim",
+                    s.line)
+            continue
+        if s.kind == "include":
+            summary.includes.append((s.cond, s.line, dict(current)))
+            continue
+        if s.kind in ("open", "close"):
+            continue
+        for letter, first, last, access, detail in _accesses(s):
+            # M variable definitions outside a buffer aren't initial values
+            if access == "define" and initial:
+                add(letter, first, last, None, access, s.line, detail)
+            else:
+                add(letter, first, last, owner, access, s.line, detail)
+    for (letter, owner, access, detail), numbers in found.items():
+        for first, last in ranges(numbers):
+            line = min([numbers[n] for n in range(first, last + 1)])
+            summary.uses.append(Use(letter, first, last, owner, access,
+                filename, line, detail))
+    summary.uses.sort(key=lambda u: (u.letter, u.first, u.line))
+    return summary
+
+# Return a list of (letter, first, last, access, detail) for the variables
+# used by a Statement
+def _accesses(s):
+    out = []
+    if s.kind in block_start or s.kind in conditions:
+        text = s.cond
+    elif s.kind == "cmd":
+        # the command string can be any online command, like i122=P4100
+        for inner in Parser().parse(s.cond):
+            out += _accesses(inner)
+        text = ""
+    elif s.kind == "assign":
+        match = _var_re.match(s.target)
+        if match:
+            n = int(match.group(2))
+            out.append((match.group(1).upper(), n, n, "write", None))
+            text = s.expr
+        else:
+            # indirect or M variable target, M variables are memory so
+            # aren't allocated by writing to them
+            text = s.text
+    elif s.kind == "other":
+        text = s.text
+        match = _mdef_re.match(text)
+        if match:
+            first, last, address = match.groups()
+            first = int(first)
+            last = int(last or first)
+            # Mxx->* makes them self referenced, which isn't a definition
+            if address != "*":
+                out.append(("M", first, last, "define", address))
+            text = ""
+        match = _ms_re.match(text)
+        if match:
+            n = int(match.group(2))
+            if match.group(1).upper() == "R":
+                out.append(("P", n, n, "write", None))
+            else:
+                out.append(("P", n, n, "read", None))
+            text = ""
+    else:
+        text = ""
+    for letter, first, last in variables(text):
+        if letter in letters:
+            out.append((letter, first, last, "read", None))
+    if s.inline:
+        out += _accesses(s.inline)
+    return out
+
+## An index of (first, last) intervals that can find the ones overlapping a
+# range quickly
+class IntervalIndex:
+    def __init__(self):
+        self.__items = []
+        self.__starts = None
+        self.__maxends = None
+
+    ## Add an interval
+    # \param value Any object to return with it
+    def add(self, first, last, value):
+        self.__items.append((first, last, value))
+        self.__starts = None
+
+    # Sort the intervals, and make a running maximum of their ends so a
+    # search can stop as soon as nothing earlier reaches the range
+    def __build(self):
+        self.__items.sort(key=lambda x: (x[0], x[1]))
+        self.__starts = [first for first, last, value in self.__items]
+        self.__maxends = []
+        maxend = None
+        for first, last, value in self.__items:
+            maxend = max(maxend, last)
+            self.__maxends.append(maxend)
+
+    ## Return the list of (first, last, value) that overlap first..last
+    def find(self, first, last):
+        if self.__starts is None:
+            self.__build()
+        out = []
+        i = bisect_right(self.__starts, last) - 1
+        while i >= 0 and self.__maxends[i] >= first:
+            if self.__items[i][1] >= first:
+                out.append(self.__items[i])
+            i -= 1
+        out.reverse()
+        return out
+
+    def __len__(self):
+        return len(self.__items)
+
+## A conflict between two uses of the same variables
+class Conflict:
+    def __init__(self, use, other, rngs, message):
+        ## The Use that conflicts, and the one it conflicts with
+        self.use = use
+        self.other = other
+        ## List of (first, last) of the variables in both
+        self.ranges = rngs
+        ## Description of the conflict, with %s for the variables
+        self.message = message
+
+    def __str__(self):
+        return "%s: %s at %s" % (self.use.where(), self.message %
+            format_ranges(self.use.letter, self.ranges), self.other.where())
+
+## The map of the variables used by all the files loaded onto a controller
+class AllocationMap:
+    ## \param cache Directory to cache the file summaries in, or None
+    # \param macros Dict of msi macro values, see pmcparse.expand_macros()
+    def __init__(self, cache=None, macros=None):
+        self.cache = cache
+        self.macros = macros
+        ## List of the filenames added, in order
+        self.files = []
+        ## List of all the Use objects
+        self.uses = []
+        ## Set of the P variables that homing PLCs use for their handshake
+        self.handshake = set()
+        ## Number of files parsed, the rest came from the cache
+        self.parsed = 0
+        self.__indexes = {}
+
+    ## Add a file, and the files it includes, to the map
+    # \param defines Dict of \#define values in effect at the start of it
+    def add_file(self, filename, defines=None):
+        path = os.path.abspath(filename)
+        if path in [os.path.abspath(f) for f in self.files]:
+            return
+        self.files.append(filename)
+        summary = self.__summary(filename, defines or {})
+        self.handshake.update(summary.handshake)
+        for use in summary.uses:
+            self.uses.append(use)
+            self.__indexes.setdefault(use.letter, IntervalIndex()).add(
+                use.first, use.last, use)
+        for name, line, defines in summary.includes:
+            include = os.path.join(os.path.dirname(filename), name)
+            if os.path.exists(include):
+                self.add_file(include, defines)
+
+    # Get the Summary of a file from the cache or by parsing it
+    def __summary(self, filename, defines):
+        text = open(filename).read()
+        if self.cache is None:
+            self.parsed += 1
+            return summarise(text, filename, defines, self.macros)
+        key = hashlib.sha1(repr((_cache_version, filename, text,
+            sorted(defines.items()), sorted((self.macros or {}).items()))))
+        cached = os.path.join(self.cache, key.hexdigest() + ".pickle")
+        if os.path.exists(cached):
+            try:
+                return cPickle.load(open(cached, "rb"))
+            except Exception:
+                # a broken cache file is just made again
+                pass
+        self.parsed += 1
+        summary = summarise(text, filename, defines, self.macros)
+        if not os.path.isdir(self.cache):
+            try:
+                os.makedirs(self.cache)
+            except OSError:
+                # another process may have made it
+                assert os.path.isdir(self.cache), \
+                    "Can't make cache dir %s" % self.cache
+        # write then rename so other processes never see half a file
+        tmp = "%s.%d" % (cached, os.getpid())
+        f = open(tmp, "wb")
+        cPickle.dump(summary, f, cPickle.HIGHEST_PROTOCOL)
+        f.close()
+        os.rename(tmp, cached)
+        return summary
+
+    ## Return a list of the uses of letter first..last, in order
+    def find(self, letter, first, last=None):
+        if last is None:
+            last = first
+        index = self.__indexes.get(letter)
+        if index is None:
+            return []
+        return [use for f, l, use in index.find(first, last)]
+
+    ## Return a list of Conflict objects
+    def conflicts(self):
+        out = []
+        for letter in shared_letters:
+            # variable -> {owner: first Use that writes it}, and homing PLC
+            # number -> the Use that claims its block
+            writes = {}
+            homing = {}
+            for use in self.uses:
+                if use.letter != letter or use.owner is None:
+                    continue
+                if use.access == "write":
+                    for n in range(use.first, use.last + 1):
+                        writes.setdefault(n, {}).setdefault(use.owner, use)
+                elif use.access == "claim":
+                    homing[use.first / 100] = use
+            shared = ()
+            if letter == "P":
+                shared = self.handshake
+            for owner, other, numbers, claimed in write_conflicts(writes,
+                    homing, shared):
+                use = writes[numbers[0]][owner]
+                if claimed:
+                    out.append(Conflict(use, homing[numbers[0] / 100],
+                        ranges(numbers), "%s writes %%s in the block of "
+                        "homing %s" % (owner, other)))
+                else:
+                    out.append(Conflict(use, writes[numbers[0]][other],
+                        ranges(numbers), "%s writes %%s, also written by "
+                        "%s" % (owner, other)))
+        # M variables defined to a different address after an earlier
+        # definition, reported once for each pair of addresses
+        seen = {}
+        order = dict((f, i) for i, f in enumerate(self.files))
+        for use in self.uses:
+            if use.access != "define":
+                continue
+            for other in self.find("M", use.first, use.last):
+                if other.access == "define" and \
+                        other.detail != use.detail and \
+                        (order[other.filename], other.line) < \
+                        (order[use.filename], use.line):
+                    rngs = ranges(_overlap(use, other))
+                    key = (use.detail, other.detail)
+                    if key in seen:
+                        seen[key].ranges = ranges(
+                            _numbers(seen[key].ranges) + _numbers(rngs))
+                    else:
+                        seen[key] = Conflict(use, other, rngs, "%%s "
+                            "redefined as %s, was %s" % key)
+                        out.append(seen[key])
+        out.sort(key=lambda c: (c.use.filename, c.use.line))
+        return out
+
+    ## Return a dict of owner -> {access: {letter: list of (first, last)}}
+    def owners(self):
+        out = {}
+        for use in self.uses:
+            letters = out.setdefault(use.owner, {}).setdefault(use.access, {})
+            letters.setdefault(use.letter, []).append(
+                (use.first, use.last))
+        for accesses in out.values():
+            for rngs in accesses.values():
+                for letter in rngs:
+                    rngs[letter] = ranges(_numbers(rngs[letter]))
+        return out
+
+# Return the list of numbers in a list of (first, last)
+def _numbers(rngs):
+    out = []
+    for first, last in rngs:
+        out += range(first, last + 1)
+    return out
+
+# Return the list of numbers used by two Use objects
+def _overlap(use, other):
+    return range(max(use.first, other.first), min(use.last, other.last) + 1)
+
+## Build the map of a Master.pmc and the files it includes
+# \param filename The Master.pmc
+# \param cache Directory to cache the file summaries in, or None
+# \param macros Dict of msi macro values, see pmcparse.expand_macros()
+# \return AllocationMap
+def build_map(filename, cache=None, macros=None):
+    m = AllocationMap(cache, macros)
+    m.add_file(filename)
+    return m
+
+def main():
+    parser = OptionParser("usage: %prog [options] <Master.pmc> ...\n"
+        "Map the P, M, I and Q variables used by each PLC loaded onto a "
+        "controller, and report the conflicts between them")
+    parser.add_option("-v", "--variable", action="append", default=[],
+        help="Print the uses of this variable or range, like P1201 or "
+        "P1100..1199, instead of the map")
+    parser.add_option("-c", "--cache", default=os.environ.get(
+        "PMCMAP_CACHE"), help="Directory to cache file summaries in, "
+        "defaults to $PMCMAP_CACHE or .pmcmap_cache next to the Master.pmc")
+    parser.add_option("-n", "--no-cache", action="store_true", default=False,
+        help="Parse every file, don't use the cache")
+    parser.add_option("-m", "--macro", action="append", default=[],
+        help="NAME=VALUE msi macro to substitute")
+    parser.add_option("-q", "--quiet", action="store_true", default=False,
+        help="Only print conflicts")
+    options, args = parser.parse_args()
+    if not args:
+        parser.error("No Master.pmc given")
+    queries = []
+    for v in options.variable:
+        vs = variables(v)
+        if len(vs) != 1:
+            parser.error("Can't understand variable %s" % v)
+        queries.append(vs[0])
+    macros = None
+    if options.macro:
+        macros = dict([m.split("=", 1) for m in options.macro])
+    errors = []
+    for filename in args:
+        if options.no_cache:
+            cache = None
+        elif options.cache:
+            cache = options.cache
+        else:
+            cache = os.path.join(os.path.dirname(filename), ".pmcmap_cache")
+        try:
+            m = build_map(filename, cache, macros)
+        except IOError, e:
+            sys.stderr.write("***Error: %s\n" % e)
+            sys.exit(1)
+        if queries:
+            for letter, first, last in queries:
+                for use in m.find(letter, first, last):
+                    print "%s %s by %s at %s" % (use.name(), use.access,
+                        use.owner or "initial values", use.where())
+        elif not options.quiet:
+            print "%s: %d files, %d parsed" % (filename, len(m.files),
+                m.parsed)
+            for owner, accesses in sorted(m.owners().items()):
+                print "  %s" % (owner or "initial values")
+                for access in ("claim", "write", "read", "define"):
+                    if access in accesses:
+                        print "    %-6s %s" % (access, ",".join([
+                            format_ranges(letter, rngs) for letter, rngs in
+                            sorted(accesses[access].items())]))
+        errors += m.conflicts()
+    for c in errors:
+        sys.stderr.write("***Error: %s\n" % c)
+    if errors:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,382 @@
+#!/usr/bin/env dls-python
+## \namespace pmcparse
+# This contains a lightweight parser for the PMAC PLC dialect used in pmc
+# files, both the ones generated by \ref motorhome and the hand-written ones
+# in pmacUtilApp/pmc.
+#
+# It splits a file into Statement objects, one per PLC statement (several
+# statements may be on one line), after removing comments and substituting
+# \#define values. It doesn't try to understand everything the PMAC does,
+# only enough to find blocks, assignments, conditions and variables.
+#
+# Example:
+# \verbatim
+# from pmcparse import Parser
+# for s in Parser().parse_file("PLCs/PLC10_S1_HM.pmc"):
+#     print s.line, s.kind, s.text
+# \endverbatim
+
+import re
+
+## Statement kinds that start a block of code
+block_start = {"if": "endif", "while": "endwhile"}
+## Statement kinds that continue the condition of an if or while
+conditions = ("and", "or")
+## Names of the \#define values of a \ref motorhome PLC that give the P
+# variables other PLCs and EPICS use to start and monitor it
+handshake = ("HomingState", "HomingStatus", "HomingGroup",
+    "HomingBackupGroup")
+
+# Keywords that start a statement, with the kind that they map to
+_keywords = {
+    "if": "if", "while": "while", "and": "and", "or": "or", "else": "else",
+    "endif": "endif", "endi": "endif", "endwhile": "endwhile",
+    "endw": "endwhile", "cmd": "cmd", "command": "cmd", "open": "open",
+    "close": "close", "end": "end",
+    "clear": "clear", "enable": "enable", "disable": "disable",
+    "ena": "enable", "dis": "disable", "send": "send", "sendp": "send",
+    "sends": "send", "return": "return", "call": "call", "gosub": "call",
+    "delete": "delete"}
+# Keywords that take the rest of the line as their arguments
+_whole_line = ("open", "enable", "disable", "send", "delete", "call",
+    "return")
+
+_comment_re = re.compile(r'/\*.*?\*/|//.*$')
+_word_re = re.compile(r'[A-Za-z_]\w*')
+_macro_re = re.compile(r'\$\((\w+)(?:=([^)]*))?\)')
+_define_re = re.compile(r'#define\s+(\w+)\s*(.*)$', re.I)
+_include_re = re.compile(r'#include\s+["<]([^">]+)[">]', re.I)
+_keyword_re = re.compile(r'([A-Za-z]+)\b\s*(.*)$')
+# spaces around operators, and inside brackets
+_space_re = re.compile(r'\s*([-+*/&|^%<>=!,~])\s*|(?<=\()\s+|\s+(?=\))')
+_assign_re = re.compile(r'^([^=<>!]+?)=(?!=)(.*)$')
+_open_re = re.compile(r'^(PLCC|PLC|PROG|ROT)\s*(\S+)', re.I)
+## Regular expression matching direct P, M, I or Q variable references,
+# including ranges like P465..496
+variable_re = re.compile(r'(?<![\w$.])([PMIQpmiq])(\d+)(?:\.\.(\d+))?(?![\w(])')
+# macrostation variables like MSR1,i912 or ms0,i21 are not I variables
+_ms_re = re.compile(r'\bms[rw]?\d+,i\d+', re.I)
+
+## A single statement from a pmc file
+class Statement:
+    def __init__(self, kind, text, filename, line, raw, cond=None,
+            target=None, expr=None, inline=None):
+        ## Kind of statement: "if", "while", "and", "or", "else", "endif",
+        ## "endwhile", "cmd", "assign", "open", "close", "clear", "enable",
+        ## "disable", "define", "include" or "other"
+        self.kind = kind
+        ## Text of the statement, with defines substituted and the spaces
+        ## around operators removed
+        self.text = text
+        ## Filename and line number the statement came from
+        self.filename = filename
+        self.line = line
+        ## The source line, before comments and defines were removed
+        self.raw = raw
+        ## For if, while, and, or: the condition inside the brackets.
+        ## For cmd: the command string. For include: the filename
+        self.cond = cond
+        ## For assign: the variable and expression. For define: the name
+        ## and value
+        self.target = target
+        self.expr = expr
+        ## For if, while and else with a statement on the same line: that
+        ## statement. No closing endif or endwhile is needed in this case
+        self.inline = inline
+
+    def __repr__(self):
+        return "<Statement %s:%d %s %r>" % (
+            self.filename, self.line, self.kind, self.text)
+
+## Return a list of (letter, first, last) for each direct variable reference
+# in text. letter is upper case, last == first unless it was a range
+def variables(text):
+    out = []
+    if "," in text:
+        text = _ms_re.sub("", text)
+    for letter, first, last in variable_re.findall(text):
+        first = int(first)
+        if last:
+            last = int(last)
+        else:
+            last = first
+        out.append((letter.upper(), first, last))
+    return out
+
+## Substitute msi style $(NAME) and $(NAME=default) macros in text. Macros
+# without a value or default are left alone
+def expand_macros(text, macros):
+    def sub(match):
+        name, default = match.groups()
+        if name in macros:
+            return str(macros[name])
+        elif default is not None:
+            return default
+        return match.group(0)
+    return _macro_re.sub(sub, text)
+
+## Return the name of the buffer opened by an open Statement, like PLC11, and
+# True if it is a PLC or PROG that is numbered across the controller, or
+# False for things like kinematics that belong to a coordinate system
+def buffer_name(s):
+    match = _open_re.match(s.cond)
+    if match:
+        return (match.group(1) + match.group(2)).upper(), True
+    return s.cond.split()[0].upper(), False
+
+## Work out which buffer each Statement belongs to. Statements outside a
+# buffer set initial values, so belong to the next buffer in the file, or the
+# last one if there isn't a next. Files with no buffers don't own anything.
+# \param statements List of Statement objects from one file
+# \return List of (statement, owner, initial), where owner is the name of the
+# buffer or None, and initial is True if the statement is outside a buffer
+def owned(statements):
+    out = []
+    owner = None
+    last_owner = None
+    # indexes in out of the statements waiting for the next buffer
+    pending = []
+    for s in statements:
+        if s.kind == "open":
+            owner = buffer_name(s)[0]
+            for i in pending:
+                out[i] = (out[i][0], owner, True)
+            pending = []
+            last_owner = owner
+            out.append((s, owner, False))
+            # OPEN PLCn CLEAR CLOSE on one line just empties the buffer
+            if s.cond.split()[-1].upper() == "CLOSE":
+                owner = None
+        elif s.kind == "close":
+            out.append((s, owner, False))
+            owner = None
+        elif owner is None:
+            pending.append(len(out))
+            out.append((s, None, True))
+        else:
+            out.append((s, owner, False))
+    for i in pending:
+        out[i] = (out[i][0], last_owner, True)
+    return out
+
+## Return the list of P variable numbers given by a Statement that is the
+# \#define of one of the handshake variables, or an empty list
+def handshake_pvars(s):
+    if s.kind != "define" or s.target not in handshake:
+        return []
+    return [first for letter, first, last in variables(s.expr)
+        if letter == "P"]
+
+## Return the PLC number if a Statement is the \#define of HomingState in the
+# header of a \ref motorhome PLC, otherwise None
+# \param initial True if the statement is outside a buffer, see owned()
+def homing_plc(s, initial):
+    if initial and s.kind == "define" and s.target == "HomingState":
+        for first in handshake_pvars(s):
+            return first / 100
+    return None
+
+## Find the variables written by more than one buffer, and the P variables
+# that a buffer writes in the Pxx00..xx99 block of a \ref motorhome PLC
+# \param writes Dict of variable number -> collection of the names of the
+# buffers that write it, see owned(). Initial values in files with no
+# buffers don't belong to one, so should be left out
+# \param homing Collection of the numbers of the motorhome PLCs, found with
+# homing_plc(), whose blocks are checked
+# \param shared Collection of the variable numbers that may be written by
+# anything, e.g. the handshake P variables found with handshake_pvars()
+# \return Sorted list of (owner, other, numbers, claimed), where numbers is
+# the sorted list of variables that buffer owner writes. If claimed is
+# False, buffer other writes them too and owner < other. If claimed is True,
+# they are in the block of motorhome PLC other
+def write_conflicts(writes, homing=(), shared=()):
+    # (owner, other, claimed) -> list of variable numbers
+    clashes = {}
+    for n, owners in writes.items():
+        if n in shared:
+            continue
+        names = sorted(owners)
+        for i, owner in enumerate(names):
+            for other in names[i + 1:]:
+                clashes.setdefault((owner, other, False), []).append(n)
+        if n / 100 in homing:
+            home = "PLC%d" % (n / 100)
+            for owner in names:
+                if owner != home:
+                    clashes.setdefault((owner, home, True), []).append(n)
+    return [(owner, other, sorted(numbers), claimed) for
+        (owner, other, claimed), numbers in sorted(clashes.items())]
+
+# Remove the spaces around operators so a statement is a single word
+def _collapse(text):
+    return _space_re.sub(lambda m: m.group(1) or "", text)
+
+## Remove a ; comment that isn't inside a string, and any // or /* */
+# comments, from a line
+def strip_comment(line):
+    if ";" in line:
+        quoted = False
+        for i, c in enumerate(line):
+            if c == '"':
+                quoted = not quoted
+            elif c == ";" and not quoted:
+                line = line[:i]
+                break
+    if "/" in line:
+        line = _comment_re.sub("", line)
+    return line.strip()
+
+# Return the index after the bracket that matches the one at text[start]
+def _match_bracket(text, start):
+    depth = 0
+    for i in range(start, len(text)):
+        if text[i] == "(":
+            depth += 1
+        elif text[i] == ")":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    return len(text)
+
+## Parser for pmc files. It remembers \#define values between calls, so a
+# number of files can be parsed in order as the PMAC would see them.
+class Parser:
+    ## \param defines Dict of initial \#define values
+    # \param macros Dict of msi macro values to substitute, see expand_macros()
+    def __init__(self, defines=None, macros=None):
+        ## Dict of \#define name -> value, with values already expanded
+        self.defines = dict(defines or {})
+        self.macros = macros
+
+    ## Substitute any \#define values in text
+    def expand(self, text):
+        if not self.defines:
+            return text
+        defines = self.defines
+        return _word_re.sub(lambda m: defines.get(m.group(0), m.group(0)),
+            text)
+
+    ## Parse a file, returning a list of Statement objects
+    def parse_file(self, filename):
+        return self.parse(open(filename).read(), filename)
+
+    ## Parse some text, returning a list of Statement objects
+    # \param text The contents of a pmc file
+    # \param filename Filename to store in the statements
+    def parse(self, text, filename="<string>"):
+        out = []
+        for i, raw in enumerate(text.splitlines()):
+            line = raw
+            if self.macros is not None:
+                line = expand_macros(line, self.macros)
+            line = strip_comment(line)
+            if not line:
+                continue
+            if line.startswith("#"):
+                match = _define_re.match(line)
+                if match:
+                    name, value = match.groups()
+                    value = self.expand(value.strip())
+                    self.defines[name] = value
+                    out.append(Statement("define", line, filename, i + 1,
+                        raw, target=name, expr=value))
+                    continue
+                match = _include_re.match(line)
+                if match:
+                    out.append(Statement("include", line, filename, i + 1,
+                        raw, cond=match.group(1)))
+                    continue
+            self._parse_line(self.expand(line), filename, i + 1, raw, out)
+        return out
+
+    # Split a line into statements and add them to out
+    def _parse_line(self, line, filename, lineno, raw, out):
+        while line:
+            match = _keyword_re.match(line)
+            kind = None
+            if match:
+                kind = _keywords.get(match.group(1).lower())
+            if kind is None:
+                # one or more assignments or other commands separated by 
+                # spaces, up to the next keyword. Leave strings alone
+                quote = line.find('"')
+                if quote < 0:
+                    head, tail = line, ""
+                else:
+                    head, tail = line[:quote], line[quote:]
+                tokens = _collapse(head).split()
+                line = tail
+                for j, text in enumerate(tokens):
+                    match = _keyword_re.match(text)
+                    if j > 0 and match and match.group(1).lower() in _keywords:
+                        line = " ".join(tokens[j:]) + tail
+                        break
+                    out.append(self._simple(text, filename, lineno, raw))
+                else:
+                    if tail:
+                        out.append(Statement("other", tail, filename, lineno,
+                            raw))
+                    return
+                continue
+            rest = match.group(2)
+            if kind == "end":
+                # END IF and END WHILE are the same as ENDIF and ENDWHILE
+                match = _keyword_re.match(rest)
+                if match and match.group(1).lower() in ("if", "while"):
+                    kind = "end" + match.group(1).lower()
+                    rest = match.group(2)
+                else:
+                    kind = "other"
+            if kind in ("if", "while", "and", "or") and rest.startswith("("):
+                end = _match_bracket(rest, 0)
+                cond = _collapse(rest[1:end - 1]).strip()
+                s = Statement(kind, "%s(%s)" % (kind, cond), filename, lineno,
+                    raw, cond=cond)
+                out.append(s)
+                line = rest[end:].strip()
+                if line and kind in block_start:
+                    inline = []
+                    self._parse_line(line, filename, lineno, raw, inline)
+                    if inline[0].kind in block_start.values():
+                        # an empty block like "while (timer > 0) endw"
+                        out += inline
+                    else:
+                        # single line if or while, doesn't need an end
+                        s.inline = inline[0]
+                        out += inline[1:]
+                    return
+            elif kind == "else" and rest:
+                s = Statement(kind, kind, filename, lineno, raw)
+                inline = []
+                self._parse_line(rest, filename, lineno, raw, inline)
+                s.inline = inline[0]
+                out.append(s)
+                out += inline[1:]
+                return
+            elif kind == "cmd":
+                string = rest.strip()
+                if string.startswith('"'):
+                    end = string.find('"', 1)
+                    if end < 0:
+                        end = len(string)
+                    cond, line = string[1:end], string[end + 1:].strip()
+                else:
+                    cond, line = string, ""
+                out.append(Statement(kind, 'cmd"%s"' % cond, filename, lineno,
+                    raw, cond=cond))
+            elif kind in _whole_line:
+                out.append(Statement(kind, line, filename, lineno, raw,
+                    cond=rest.strip()))
+                return
+            else:
+                out.append(Statement(kind, kind, filename, lineno, raw))
+                line = rest.strip()
+
+    # Make a statement from something that isn't a keyword
+    def _simple(self, text, filename, lineno, raw):
+        match = _assign_re.match(text)
+        if match and "->" not in text:
+            target, expr = match.groups()
+            return Statement("assign", text, filename, lineno, raw,
+                target=target, expr=expr)
+        return Statement("other", text, filename, lineno, raw)
@@ -3,6 +3,47 @@
 # read_archiver.py is a python script to read bits
 # from pmac status mbbo records in the archiver
 # The intended use case is to query for changes in status bits
+#
+# Several queries can be given at once, and long time ranges are split into
+# chunks that are fetched concurrently over a pool of connections, in pages
+# of up to 10000 samples. Each page starts from the last sample of the one
+# before to the nanosecond, and calls that fail are retried with a backoff.
+# The samples are kept in a local cache, see Cache, so only the times that
+# haven't been fetched before are requested from the archiver. A chunk that
+# is being fetched is checkpointed to the cache every 30 seconds, so an
+# export that is interrupted carries on from where it stopped. Each query
+# can have a list of masks, which are given by name for the status and
+# PLCDISBITS pvs, and the transitions of all of them are found from a single
+# retrieval. The transitions from all the queries are streamed in time order
+# as the chunks arrive, as text, CSV, JSON Lines, or a .npy or HDF5 file of
+# record_dtype, so months of data can be exported in constant memory. It can
+# also be used as a library:
+# \verbatim
+# from read_archiver import Archiver, parse_time, parse_masks, \
+#     mask_transitions, iter_transitions
+# archiver = Archiver()
+# samples = archiver.fetch_many([(pv, parse_time("2015-02-10@00:00"),
+#     parse_time("2015-02-11@11:40")) for pv in pvs])
+# for pv in pvs:
+#     print pv, mask_transitions(samples[pv], parse_masks("all", pv))
+# # or one transition at a time
+# for secs, nano, pv, name, value, sevr, count in iter_transitions(archiver,
+#         pv, parse_masks("all", pv), start, end):
+#     print time.ctime(secs), name, value
+# \endverbatim
+# For monitoring, --follow keeps the last sample read of each pv in a state
+# file (see FollowState), and each run only fetches and prints the
+# transitions since the last one, so it can be run every few minutes over
+# hundreds of pvs with an end time of "now", or left polling with
+# --interval.
+#
+# To find what else changed when an axis tripped, --window indexes the
+# transitions of all the queries in a TransitionIndex and joins each
+# following error onset (or other --trigger mask) with the transitions
+# within that many seconds of it.
+#
+# The URL of the archiver can be changed to test against a local stand-in
+# XML-RPC server that provides archiver.values()
 #  
 # Example query:
 # \verbatim
@@ -21,167 +62,1086 @@
 #
 # Help text from read_archiver.py -h
 #\verbatim
+#Usage: read_archiver.py [options] <pvname> <value> <start_time> <end_time> ...
 #read bits from bit field records in DLS archiver
-#Invocation:
-#   read_archiver.py <pvname> <value> <start_time> <end_time>
 #
 #Where:
 #   <pvname> is a bit field pv, e.g. BL23I-MO-STEP-01:PLCDISBITS00
-#   <value>  is a bit field mask in decimal or hex, e.g. 0x800 or 2048
+#   <value>  is a bit field mask in decimal or hex, e.g. 0x800 or 2048, a
+#            mask name, NAME=VALUE, or a comma separated list of these
 #   <start_time> is a time in the format "%Y-%m-%d@%H:%M" (no seconds)
 #                for example 2012-11-11@17:10
 #   <end_time>   is a time in the format "%Y-%m-%d@%H:%M" (no seconds)
+#                or now
+#
+#More queries can be given as further groups of 4 arguments, or one per line
+#in a file with --file. The samples of each pv are only fetched once, and
+#the transitions of all the masks are found from them.
 #
 #The output is of the form:
 #
 #  count date_time [True/False] severity
-# 
-#Example pvs and masks:
+#
+#with the pvname and mask first if there is more than one query or mask.
+#--format gives other formats with the columns of record_dtype.
+#
+#With --window, the transitions of all the queries are indexed, and each
+#onset of a --trigger mask is printed with the transitions of the other
+#masks and pvs within that many seconds of it, and their offset from it.
+#
+#Options:
+#  -h, --help            show this help message and exit
+#  -u URL, --url=URL     URL of the archiver data server
+#  -k KEY, --key=KEY     Archive key, default 1000 for all archives
+#  -p PAGE, --page=PAGE  Samples to request in each call, default 10000
+#  -c HOURS, --chunk=HOURS
+#                        Split time ranges into chunks of this many hours that
+#                        are fetched concurrently, default 24.0
+#  -j CONNECTIONS, --connections=CONNECTIONS
+#                        Number of concurrent connections, default 8
+#  -f FILE, --file=FILE  Read queries from FILE, one per line
+#  -C CACHE, --cache=CACHE
+#                        Directory to cache samples in, defaults to
+#                        $READ_ARCHIVER_CACHE or ~/.read_archiver_cache
+#  -n, --no-cache        Fetch everything from the archiver, don't use the
+#                        cache
+#  -r RETRIES, --retries=RETRIES
+#                        Number of times to retry a failed call, default 5
+#  -F FORMAT, --format=FORMAT
+#                        Output format, one of csv, hdf5, jsonl, npy, text,
+#                        default text
+#  -o OUTPUT, --output=OUTPUT
+#                        Write the transitions to OUTPUT instead of stdout
+#  -w SECONDS, --window=SECONDS
+#                        Give the transitions within this many seconds of each
+#                        onset of a trigger mask
+#  -t TRIGGER, --trigger=TRIGGER
+#                        Mask name to trigger --window on, can be given more
+#                        than once, default following_error
+#  --follow=STATE        Only give the transitions since the last run with the
+#                        same STATE file, which keeps the last sample read of
+#                        each pv. End times are capped at now
+#  --interval=SECONDS    With --follow, keep polling for new samples every
+#                        SECONDS
+#
+#Masks can be given by name, or "all" for every named mask of a pv:
 #
 #  for $(pmac):PLCDISBITS00 use these values
-#       plc0           0x1             
-#       plc1           0x2   
-#       plc2           0x4   
-#       plc3           0x8   
-#       plc4           0x10  
-#       plc5           0x20  
-#       plc6           0x40  
-#       plc7           0x80  
-#       plc8           0x100 
-#       plc9           0x200 
-#       plc10          0x400 
-#       plc11          0x800 
-#       plc12          0x1000
-#       plc13          0x2000
-#       plc14          0x4000
-#       plc15          0x8000
+#       plc0                      0x1      plc0 disabled
+#       plc1                      0x2      plc1 disabled
+#       plc2                      0x4      plc2 disabled
+#       plc3                      0x8      plc3 disabled
+#       plc4                      0x10     plc4 disabled
+#       plc5                      0x20     plc5 disabled
+#       plc6                      0x40     plc6 disabled
+#       plc7                      0x80     plc7 disabled
+#       plc8                      0x100    plc8 disabled
+#       plc9                      0x200    plc9 disabled
+#       plc10                     0x400    plc10 disabled
+#       plc11                     0x800    plc11 disabled
+#       plc12                     0x1000   plc12 disabled
+#       plc13                     0x2000   plc13 disabled
+#       plc14                     0x4000   plc14 disabled
+#       plc15                     0x8000   plc15 disabled
 #
 #  for $(pmac):AXIS<N>:status1 use these values cf. Turbo SRM p. 310-315
-#       motor activated           0x8000
-#       negative end limit set    0x4000
-#       positive end limit set    0x2000
-#       amplifier enabled         0x800
-#       open loop mode            0x400
-#       desired velocity zero     0x20
-#       home search in progress   0x4
+#       activated                 0x8000   motor activated
+#       neg_limit                 0x4000   negative end limit set
+#       pos_limit                 0x2000   positive end limit set
+#       amp_enabled               0x800    amplifier enabled
+#       open_loop                 0x400    open loop mode
+#       velocity_zero             0x20     desired velocity zero
+#       homing                    0x4      home search in progress
 #
 #  for $(pmac):AXIS<N>:status3 use these values
-#       assigned to c.s.          0x8000
-#       stopped on position limit 0x800
-#       home complete             0x400
-#       fatal following error     0x4
-#       warning following error   0x2
-#       in position               0x1
+#       assigned_cs               0x8000   assigned to c.s.
+#       stopped_on_limit          0x800    stopped on position limit
+#       home_complete             0x400    home complete
+#       following_error           0x4      fatal following error
+#       warning_following_error   0x2      warning following error
+#       in_position               0x1      in position
 #\endverbatim
 
+import os
+import re
 import time
+import math
 import sys
-from xmlrpclib import ServerProxy, Error
+import json
+import hashlib
+import threading
+import socket
+import httplib
+import csv
+import struct
+from collections import deque
+from heapq import merge
+from multiprocessing.dummy import Pool
+from optparse import OptionParser
+from xmlrpclib import ServerProxy, Error, ProtocolError
+
+import numpy
+try:
+    import h5py
+except ImportError:
+    h5py = None
 
 Archiver_URL = "http://archiver.pri.diamond.ac.uk/" \
                 + "archive/cgi/ArchiveDataServer.cgi"
+## Key for the "all" archive
+Archiver_key = 1000
+## Default number of samples to request in each archiver.values() call
+page_size = 10000
+## Default length of the chunks a time range is split into, in seconds
+chunk_secs = 24 * 60 * 60
+## Default number of concurrent connections to the archiver
+connections = 8
+## Default number of times to retry a failed archiver call
+retries = 5
+## Default seconds to wait before retrying, doubling for each retry
+backoff = 1.0
+## Default seconds between checkpoints of a chunk to the cache
+checkpoint_secs = 30
+## Format of times on the command line
+time_format = "%Y-%m-%d@%H:%M"
 
-def help():
-    print sys.argv[0] + """
+## Named masks for the bit field pvs, as a dict of pv suffix -> list of
+# (name, mask, description)
+status_masks = {
+    "status1": [
+        ("activated", 0x8000, "motor activated"),
+        ("neg_limit", 0x4000, "negative end limit set"),
+        ("pos_limit", 0x2000, "positive end limit set"),
+        ("amp_enabled", 0x800, "amplifier enabled"),
+        ("open_loop", 0x400, "open loop mode"),
+        ("velocity_zero", 0x20, "desired velocity zero"),
+        ("homing", 0x4, "home search in progress")],
+    "status3": [
+        ("assigned_cs", 0x8000, "assigned to c.s."),
+        ("stopped_on_limit", 0x800, "stopped on position limit"),
+        ("home_complete", 0x400, "home complete"),
+        ("following_error", 0x4, "fatal following error"),
+        ("warning_following_error", 0x2, "warning following error"),
+        ("in_position", 0x1, "in position")]}
+_plcdisbits_re = re.compile(r'PLCDISBITS(\d+)$')
+_chunk_file_re = re.compile(r'^(-?\d+)-(-?\d+)-(-?\d+)\.npy$')
+
+usage = """%prog [options] <pvname> <value> <start_time> <end_time> ...
 read bits from bit field records in DLS archiver
-Invocation:
-   read_archiver.py <pvname> <value> <start_time> <end_time>
 
 Where:
    <pvname> is a bit field pv, e.g. BL23I-MO-STEP-01:PLCDISBITS00
-   <value>  is a bit field mask in decimal or hex, e.g. 0x800 or 2048
+   <value>  is a bit field mask in decimal or hex, e.g. 0x800 or 2048, a
+            mask name, NAME=VALUE, or a comma separated list of these
    <start_time> is a time in the format "%Y-%m-%d@%H:%M" (no seconds)
                 for example 2012-11-11@17:10
    <end_time>   is a time in the format "%Y-%m-%d@%H:%M" (no seconds)
+                or now
+
+More queries can be given as further groups of 4 arguments, or one per line
+in a file with --file. The samples of each pv are only fetched once, and
+the transitions of all the masks are found from them.
 
 The output is of the form:
 
   count date_time [True/False] severity
- 
-Example pvs and masks:
-
-  for $(pmac):PLCDISBITS00 use these values
-       plc0           0x1             
-       plc1           0x2   
-       plc2           0x4   
-       plc3           0x8   
-       plc4           0x10  
-       plc5           0x20  
-       plc6           0x40  
-       plc7           0x80  
-       plc8           0x100 
-       plc9           0x200 
-       plc10          0x400 
-       plc11          0x800 
-       plc12          0x1000
-       plc13          0x2000
-       plc14          0x4000
-       plc15          0x8000
-
-  for $(pmac):AXIS<N>:status1 use these values cf. Turbo SRM p. 310-315
-       motor activated           0x8000
-       negative end limit set    0x4000
-       positive end limit set    0x2000
-       amplifier enabled         0x800
-       open loop mode            0x400
-       desired velocity zero     0x20
-       home search in progress   0x4
-
-  for $(pmac):AXIS<N>:status3 use these values
-       assigned to c.s.          0x8000
-       stopped on position limit 0x800
-       home complete             0x400
-       fatal following error     0x4
-       warning following error   0x2
-       in position               0x1
-
-"""
-
-def main(pvname, check_value_str, start_str, end_str ):
-    server = ServerProxy(Archiver_URL)
-    archiver_key = 1000 # key for "all" archiver
-    # start time
-    t1 = time.strptime(start_str, "%Y-%m-%d@%H:%M")
-    time1 = time.mktime(t1)
-    t2 = time.strptime(end_str, "%Y-%m-%d@%H:%M")
-    time2 = time.mktime(t2)
-    check_value = int(check_value_str,0)
-
-    complete = False
-    no_data = False
-    count = 1
-    while not complete:
-        result = server.archiver.values(archiver_key, [pvname], 
-                                    int(time1), 0, int(time2), 0, 100, 0)
-        assert(len(result) == 1)
-        if len(result[0]['values']) == 0:
-            no_data = True
-        if len(result[0]['values']) != 100:
-            complete = True
-        for entry in result[0]['values']:
-            bit_value = entry['value'][0] & check_value == check_value 
-            if count == 1:
-                last_value = not bit_value
-            if bit_value != last_value:
-                print count, time.ctime(entry['secs']), bit_value, entry['sevr']
-                last_value = bit_value
-            count = count + 1
-        #Time of latest value
-        if not no_data:
-            if result[0]['values'][-1]['secs'] >= time2:
-                complete = True
+
+with the pvname and mask first if there is more than one query or mask.
+--format gives other formats with the columns of record_dtype.
+
+With --window, the transitions of all the queries are indexed, and each
+onset of a --trigger mask is printed with the transitions of the other
+masks and pvs within that many seconds of it, and their offset from it."""
+
+## Return the named masks for a pv, as a list of (name, mask, description).
+# $(pmac):PLCDISBITS00 has a mask for each of plc0..15, PLCDISBITS16 for
+# plc16..31, and $(pmac):AXIS<N>:status1 and status3 have the masks in
+# status_masks
+def named_masks(pvname):
+    match = _plcdisbits_re.search(pvname)
+    if match:
+        first = int(match.group(1))
+        return [("plc%d" % (first + i), 1 << i, "plc%d disabled" % (first + i))
+            for i in range(16)]
+    for suffix, masks in status_masks.items():
+        if pvname.endswith(suffix):
+            return masks
+    return []
+
+## Turn a comma separated list of masks into a list of (name, mask). Each
+# mask is a number in decimal or hex, a name from named_masks(), NAME=VALUE
+# to name a number, or "all" for all the named masks of the pv
+def parse_masks(text, pvname):
+    named = named_masks(pvname)
+    lookup = dict([(name, mask) for name, mask, description in named])
+    out = []
+    for item in text.split(","):
+        if item == "all" and named:
+            out += [(name, mask) for name, mask, description in named]
+        elif "=" in item:
+            name, value = item.split("=", 1)
+            out.append((name, int(value, 0)))
+        elif item in lookup:
+            out.append((item, lookup[item]))
+        else:
+            try:
+                out.append(("0x%x" % int(item, 0), int(item, 0)))
+            except ValueError:
+                raise ValueError("Unknown mask %s for %s" % (item, pvname))
+    return out
+
+# Make the help text of the named masks
+def _masks_help():
+    lines = ["", "Masks can be given by name, or \"all\" for every named mask "
+        "of a pv:"]
+    for pvname in ["$(pmac):PLCDISBITS00"] + ["$(pmac):AXIS<N>:%s" % suffix
+            for suffix in sorted(status_masks)]:
+        lines += ["", "  for %s use these values" % pvname]
+        if pvname.endswith("status1"):
+            lines[-1] += " cf. Turbo SRM p. 310-315"
+        for name, mask, description in named_masks(pvname):
+            lines.append("       %-25s %-8s %s" % (name, "0x%x" % mask,
+                description))
+    return "\n".join(lines) + "\n\n"
+
+## Turn a time in time_format, or "now", into seconds since the epoch
+# \param now Time to give for "now", defaults to the current time
+def parse_time(text, now=None):
+    if text == "now":
+        if now is None:
+            return time.time()
+        return now
+    return time.mktime(time.strptime(text, time_format))
+
+## Split the time range start..end into a list of (chunk, start, end) where
+# chunk is the start of a chunk of chunk seconds, aligned to a multiple of
+# chunk, and start..end is the part of the range in it
+def split_range(start, end, chunk=chunk_secs):
+    out = []
+    c = int(start) - int(start) % chunk
+    while True:
+        out.append((c, max(start, c), min(end, c + chunk)))
+        c += chunk
+        if c >= end:
+            return out
+
+## Turn a list of (secs, nano, value, severity) into a 4 x n numpy array of
+# samples, with a row for each of secs, nano, value and severity. An array
+# is returned as it is
+def to_array(samples):
+    if isinstance(samples, numpy.ndarray):
+        return samples
+    if not samples:
+        return numpy.zeros((4, 0), dtype=numpy.int64)
+    return numpy.array(samples, dtype=numpy.int64).T.copy()
+
+## Merge some arrays of samples, see to_array(), into one in time order with
+# any duplicates removed
+def merge_samples(arrays):
+    samples = numpy.concatenate([to_array(a) for a in arrays] +
+        [numpy.zeros((4, 0), dtype=numpy.int64)], axis=1)
+    order = numpy.lexsort((samples[1], samples[0]))
+    samples = samples[:, order]
+    keep = numpy.ones(samples.shape[1], dtype=bool)
+    keep[1:] = (samples[0, 1:] != samples[0, :-1]) | \
+        (samples[1, 1:] != samples[1, :-1])
+    return samples[:, keep]
+
+## A local cache of archiver samples. There is a directory for each pv with
+# a numpy .npy file for each chunk, holding the samples as a 4 x n array
+# (see to_array()) that is memory mapped when it is read. The file is named
+# <chunk>-<first>-<last>.npy, where first and last are the times that have
+# been fetched, so a query that overlaps a cached chunk only fetches the
+# times that are missing. The samples and the times they cover are written
+# in one rename, so several processes can share the cache. The most recent
+# settle seconds are never marked as fetched, as the archiver may not have
+# stored them yet.
+class Cache:
+    ## \param directory Directory to store the cache in
+    # \param url URL and key of the archiver, so different archivers don't
+    # share samples
+    # \param settle Seconds before now that are not marked as fetched
+    def __init__(self, directory, url=Archiver_URL, key=Archiver_key,
+            settle=300):
+        self.directory = os.path.join(directory,
+            hashlib.sha1("%s %s" % (url, key)).hexdigest()[:12])
+        self.settle = settle
+
+    # Return the directory of a pv
+    def __pvdir(self, pvname):
+        return os.path.join(self.directory, pvname.replace("/", "_"))
+
+    # Return a dict of chunk -> list of (first, last) of the files of a pv
+    def __files(self, pvname):
+        try:
+            names = os.listdir(self.__pvdir(pvname))
+        except OSError:
+            return {}
+        out = {}
+        for name in names:
+            match = _chunk_file_re.match(name)
+            if match:
+                chunk, first, last = [int(x) for x in match.groups()]
+                out.setdefault(chunk, []).append((first, last))
+        return out
+
+    # Return the filename of a chunk that covers first to last
+    def __filename(self, pvname, chunk, first, last):
+        return os.path.join(self.__pvdir(pvname), "%d-%d-%d.npy" % (chunk,
+            first, last))
+
+    ## Return a dict of chunk -> (first, last) times fetched for a pv
+    def coverage(self, pvname):
+        return dict([(chunk, max(covers, key=lambda (f, l): l - f))
+            for chunk, covers in self.__files(pvname).items()])
+
+    ## Return the samples of a chunk as a memory mapped array
+    # \param cover (first, last) times needed, as given by coverage()
+    def load(self, pvname, chunk, cover):
+        try:
+            return numpy.load(self.__filename(pvname, chunk, *cover),
+                mmap_mode="r")
+        except IOError:
+            # another process has replaced it with one that covers more
+            for first, last in self.__files(pvname).get(chunk, []):
+                if first <= cover[0] and last >= cover[1]:
+                    return numpy.load(self.__filename(pvname, chunk, first,
+                        last), mmap_mode="r")
+            raise
+
+    ## Store the samples of a chunk
+    # \param samples Array of samples, see to_array()
+    # \param first, last Times that have been fetched
+    def store(self, pvname, chunk, samples, first, last):
+        first = int(math.ceil(first))
+        last = int(min(last, time.time() - self.settle))
+        if last < first:
+            return
+        pvdir = self.__pvdir(pvname)
+        if not os.path.isdir(pvdir):
+            try:
+                os.makedirs(pvdir)
+            except OSError:
+                # another process may have made it
+                assert os.path.isdir(pvdir), "Can't make cache dir %s" % pvdir
+        # write then rename so other processes never see half a file
+        filename = self.__filename(pvname, chunk, first, last)
+        tmp = "%s.%d.%d.tmp" % (filename, os.getpid(),
+            threading.current_thread().ident)
+        f = open(tmp, "wb")
+        numpy.save(f, samples)
+        f.close()
+        os.rename(tmp, filename)
+        # remove the files that this one replaces
+        for f, l in self.__files(pvname).get(chunk, []):
+            if f >= first and l <= last and (f, l) != (first, last):
+                try:
+                    os.remove(self.__filename(pvname, chunk, f, l))
+                except OSError:
+                    pass
+
+## A connection pool to the archiver data server. Each thread in the pool
+# has its own ServerProxy, as they can't be shared between threads.
+class Archiver:
+    ## \param url URL of the archiver data server
+    # \param key Archive key to query
+    # \param page Samples to request in each archiver.values() call
+    # \param chunk Length of the chunks a time range is split into, in
+    # seconds
+    # \param connections Number of concurrent connections
+    # \param cache Cache object to keep the samples in, or None
+    # \param retries Number of times to retry a call that fails
+    # \param backoff Seconds to wait before the first retry, doubling for
+    # each one after it
+    # \param checkpoint Seconds between storing the samples of a chunk that
+    # is being fetched in the cache
+    def __init__(self, url=Archiver_URL, key=Archiver_key, page=page_size,
+            chunk=chunk_secs, connections=connections, cache=None,
+            retries=retries, backoff=backoff, checkpoint=checkpoint_secs):
+        self.url = url
+        self.key = key
+        self.page = page
+        self.chunk = chunk
+        self.connections = connections
+        self.cache = cache
+        self.retries = retries
+        self.backoff = backoff
+        self.checkpoint = checkpoint
+        ## Number of archiver.values() calls made
+        self.calls = 0
+        ## Number of calls that failed and were retried
+        self.retried = 0
+        self.__local = threading.local()
+        self.__pool = None
+
+    # Return the ServerProxy of this thread
+    def __server(self):
+        server = getattr(self.__local, "server", None)
+        if server is None:
+            server = self.__local.server = ServerProxy(self.url)
+        return server
+
+    # Call archiver.values() for a page of samples from a time to the
+    # nanosecond, retrying with a backoff that doubles each time if the
+    # connection fails
+    def __values(self, pvname, secs, nano, end):
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            self.calls += 1
+            try:
+                return self.__server().archiver.values(self.key, [pvname],
+                    secs, nano, int(end), 0, self.page, 0)
+            except (socket.error, httplib.HTTPException, ProtocolError):
+                if attempt == self.retries:
+                    raise
+                # start again with a new connection
+                self.__local.server = None
+                self.retried += 1
+                time.sleep(delay)
+                delay = min(2 * delay, 60)
+
+    ## Fetch the samples of a pv between two times, one page at a time. Each
+    # page starts at the last sample of the one before, to the nanosecond, so
+    # samples that share a second are not skipped
+    # \param checkpoint Function to call with the list of samples so far
+    # every few seconds, or None
+    # \return List of (secs, nano, value, severity) in time order. The first
+    # may be before start, giving the value at start
+    def fetch(self, pvname, start, end, checkpoint=None):
+        out = []
+        secs, nano = int(start), 0
+        saved = time.time()
+        while True:
+            result = self.__values(pvname, secs, nano, end)
+            assert len(result) == 1, \
+                "Expected 1 result for %s, got %d" % (pvname, len(result))
+            values = [(v["secs"], v["nano"], v["value"][0], v["sevr"])
+                for v in result[0]["values"]]
+            full = len(values) >= self.page
+            if out:
+                # the page starts with the last sample of the one before
+                values = [v for v in values if v[:2] > out[-1][:2]]
+            out += values
+            if not full or not values or out[-1][0] >= end:
+                return out
+            secs, nano = out[-1][:2]
+            if checkpoint is not None and \
+                    time.time() - saved >= self.checkpoint:
+                checkpoint(out)
+                saved = time.time()
+
+    # Return a list of (pvname, chunk, cached, gaps) for the chunks that
+    # cover some time ranges of a pv, where cached is the (first, last) times
+    # in the cache or None, and gaps is a list of (start, end) to fetch
+    def __plan(self, pvname, spans):
+        coverage = {}
+        if self.cache is not None:
+            coverage = self.cache.coverage(pvname)
+        # chunk -> [start, end] of the times needed in it
+        needed = {}
+        for start, end in spans:
+            for chunk, t1, t2 in split_range(start, end, self.chunk):
+                if chunk in needed:
+                    t1 = min(t1, needed[chunk][0])
+                    t2 = max(t2, needed[chunk][1])
+                needed[chunk] = (t1, t2)
+        out = []
+        for chunk, (t1, t2) in sorted(needed.items()):
+            have = coverage.get(chunk)
+            if have is None:
+                gaps = [(t1, t2)]
             else:
-                time1 = result[0]['values'][-1]['secs'] + 1
-    if no_data:
-        print "no data available"
+                # fetch either side of what is cached, joining up with it so
+                # the times fetched stay contiguous
+                gaps = []
+                if t1 < have[0]:
+                    gaps.append((t1, have[0]))
+                if t2 > have[1]:
+                    gaps.append((have[1], t2))
+            out.append((pvname, chunk, have, gaps))
+        return out
 
-if __name__ == "__main__":
-    if len(sys.argv) < 2 or sys.argv[1] == "-h":
-        help()
-        sys.exit(1)
-    if len(sys.argv) < 5:
-        help()
+    # Worker for the thread pool, fetch the gaps in a chunk. If there is a
+    # cache, the samples fetched so far are stored in it every few seconds, so
+    # if the fetch is interrupted the next one carries on from there
+    def _fetch_chunk(self, job):
+        pvname, chunk, have, gaps = job
+        out = []
+        covered = have
+        for t1, t2 in gaps:
+            checkpoint = None
+            # only times that join up with the ones covered can be stored
+            if self.cache is not None and (covered is None or
+                    t1 == covered[1]):
+                first = covered is None and t1 or covered[0]
+                def checkpoint(samples, first=first, arrays=list(out)):
+                    arrays = arrays + [to_array(samples)]
+                    if have is not None:
+                        arrays.append(self.cache.load(pvname, chunk, have))
+                    self.cache.store(pvname, chunk, merge_samples(arrays),
+                        first, samples[-1][0])
+            out.append(to_array(self.fetch(pvname, t1, t2, checkpoint)))
+            if covered is None:
+                covered = (t1, t2)
+            else:
+                covered = (min(covered[0], t1), max(covered[1], t2))
+        return out
+
+    # Merge the samples fetched for a chunk with the ones in the cache, and
+    # store them in the cache
+    def __finish(self, job, fetched):
+        pvname, chunk, have, gaps = job
+        arrays = list(fetched)
+        if have is not None:
+            arrays.append(self.cache.load(pvname, chunk, have))
+        # chunks overlap by the sample before the start of each one
+        samples = merge_samples(arrays)
+        if self.cache is not None and gaps:
+            times = [t for gap in gaps for t in gap] + list(have or ())
+            self.cache.store(pvname, chunk, samples, min(times), max(times))
+        return samples
+
+    # Generator that fetches the chunks of some jobs in the thread pool and
+    # yields (job, fetched) in order. If ahead is given, at most this many
+    # jobs are fetched before they are used
+    def __run(self, jobs, ahead=None):
+        if self.connections == 1 or len(jobs) < 2:
+            for job in jobs:
+                yield job, self._fetch_chunk(job)
+            return
+        if self.__pool is None:
+            self.__pool = Pool(self.connections)
+        queue = deque()
+        for job in jobs:
+            queue.append((job, self.__pool.apply_async(self._fetch_chunk,
+                (job,))))
+            if ahead is not None and len(queue) >= ahead:
+                job, result = queue.popleft()
+                yield job, result.get()
+        while queue:
+            job, result = queue.popleft()
+            yield job, result.get()
+
+    ## Stop the threads that fetch the samples
+    def close(self):
+        if self.__pool is not None:
+            self.__pool.close()
+            self.__pool.join()
+            self.__pool = None
+
+    ## Fetch the samples for a number of queries concurrently. If there is a
+    # cache, only the times that are not in it are fetched
+    # \param queries List of (pvname, start, end)
+    # \return Dict of pvname -> array of samples in time order, see
+    # to_array(), with the samples of all the queries for that pv merged
+    def fetch_many(self, queries):
+        # fetch overlapping ranges of the same pv only once
+        spans = {}
+        for pvname, start, end in queries:
+            spans.setdefault(pvname, []).append((start, end))
+        jobs = []
+        for pvname, pv_spans in sorted(spans.items()):
+            jobs += self.__plan(pvname, pv_spans)
+        out = {}
+        for job, fetched in self.__run(jobs):
+            out.setdefault(job[0], []).append(self.__finish(job, fetched))
+        for pvname, arrays in out.items():
+            out[pvname] = merge_samples(arrays)
+        return out
+
+    ## Generator that yields the samples of a pv between two times, one
+    # chunk at a time, so any length of time can be read in constant memory.
+    # The next few chunks are fetched concurrently while one is being used
+    # \return Arrays of samples in time order, see to_array(). The first
+    # sample may be before start, giving the value at start
+    def iter_samples(self, pvname, start, end):
+        last = None
+        for job, fetched in self.__run(self.__plan(pvname, [(start, end)]),
+                2 * self.connections):
+            samples = select(self.__finish(job, fetched), start, end)
+            if last is not None:
+                # drop the samples that were in the last chunk
+                secs, nano = samples[0], samples[1]
+                samples = samples[:, (secs > last[0]) |
+                    ((secs == last[0]) & (nano > last[1]))]
+            if samples.shape[1]:
+                last = samples[0, -1], samples[1, -1]
+                yield samples
+
+## Return the samples between start and end, and the one at or before start
+# that gives the value at start. Times are compared to the nanosecond, so
+# the result doesn't depend on how far either side of them was fetched
+# \param samples Array of samples in time order, see to_array()
+def select(samples, start, end):
+    samples = to_array(samples)
+    times = samples[0] + samples[1] * 1e-9
+    first = max(numpy.searchsorted(times, start, "right") - 1, 0)
+    return samples[:, first:numpy.searchsorted(times, end, "right")]
+
+## Return a tuple of numpy arrays of the secs, nano, value and severity of
+# some samples, see to_array()
+def columns(samples):
+    return tuple(to_array(samples))
+
+## Find the changes of the bits in a number of masks in some samples. All the
+# masks are checked against all the samples at once
+# \param samples Array or list of samples in time order, see to_array()
+# \param masks List of (name, mask)
+# \return List of (count, secs, name, bit value, severity) in time order, for
+# the first sample and each one where all the bits in a mask being set
+# changes. count is the number of the sample, starting at 1
+# \param previous Array of the state of each mask before the first sample,
+# or None to give the first sample as a transition
+# \param count Number of samples before the first one
+def mask_transitions(samples, masks, previous=None, count=0):
+    secs, nano, values, sevr = columns(samples)
+    states = mask_states(values, masks)
+    changed = numpy.ones(states.shape, dtype=bool)
+    changed[1:] = states[1:] != states[:-1]
+    if previous is not None and len(states):
+        changed[0] = states[0] != previous
+    rows, cols = numpy.nonzero(changed)
+    return [(count + int(i) + 1, int(secs[i]), masks[j][0],
+        bool(states[i, j]), int(sevr[i])) for i, j in zip(rows, cols)]
+
+## Return a boolean array with a row for each value and a column for each of
+# a list of (name, mask), that is True where all the bits in mask are set
+def mask_states(values, masks):
+    bits = numpy.array([mask for name, mask in masks], dtype=numpy.int64)
+    return (values[:, None] & bits) == bits
+
+## Generator that yields the transitions of some masks in a pv as the
+# samples arrive from the archiver
+# \param archiver Archiver to fetch the samples with
+# \param masks List of (name, mask)
+# \return Tuples of (secs, nano, pvname, mask name, new value, severity,
+# count) in time order, where count is the number of the sample, starting
+# at 1. The first sample is always given
+def iter_transitions(archiver, pvname, masks, start, end):
+    previous = None
+    count = 0
+    for samples in archiver.iter_samples(pvname, start, end):
+        for n, secs, name, value, sevr in mask_transitions(samples, masks,
+                previous, count):
+            yield (secs, int(samples[1, n - count - 1]), pvname, name, value,
+                sevr, n)
+        previous = mask_states(samples[2, -1:], masks)[0]
+        count += samples.shape[1]
+
+## A time sorted index of the transitions of many pvs and masks, that finds
+# the transitions near some times with a binary search, so a window join of
+# m triggers against n transitions takes O((n + m) log n) plus the size of
+# the result, rather than a scan of every pair
+class TransitionIndex:
+    ## \param records Iterable of records given by iter_transitions(). The
+    # first sample of each mask is its state at the start rather than a
+    # transition, so it is left out
+    def __init__(self, records):
+        records = [r for r in records if r[6] > 1]
+        times = numpy.array([r[0] + r[1] * 1e-9 for r in records],
+            dtype=float)
+        order = numpy.argsort(times, kind="mergesort")
+        ## Array of the time of each transition in seconds
+        self.times = times[order]
+        ## List of the records in time order
+        self.records = [records[i] for i in order]
+
+    def __len__(self):
+        return len(self.records)
+
+    ## Return a list of the indexes of the onsets of some masks, where all
+    # their bits became set
+    # \param names List of mask names
+    def onsets(self, names):
+        return [i for i, r in enumerate(self.records)
+            if r[3] in names and r[4]]
+
+    ## Find the transitions within dt seconds of each of some transitions
+    # \param triggers List of indexes of the transitions, e.g. from onsets()
+    # \return List of (trigger record, list of (offset in seconds, record))
+    # with the records in time order, not including the trigger
+    def window_join(self, triggers, dt):
+        triggers = numpy.array(triggers, dtype=int)
+        t = self.times[triggers]
+        lo = numpy.searchsorted(self.times, t - dt, "left")
+        hi = numpy.searchsorted(self.times, t + dt, "right")
+        return [(self.records[i], [(self.times[k] - self.times[i],
+            self.records[k]) for k in range(a, b) if k != i])
+            for i, a, b in zip(triggers, lo, hi)]
+
+## Find the changes of the bits in mask in some samples
+# \param samples Array or list of samples in time order, see to_array()
+# \param mask Bit mask to check
+# \param start Only return changes at or after this time, the samples before
+# it just give the starting value
+# \return List of (count, secs, bit value, severity) for the first sample
+# and each one where all the bits in mask being set changes. count is the
+# number of the sample, starting at 1
+def transitions(samples, mask, start=None):
+    if start is not None:
+        samples = to_array(samples)
+        samples = samples[:, samples[0] >= start]
+    return [(count, secs, bit_value, sevr) for count, secs, name, bit_value,
+        sevr in mask_transitions(samples, [(None, mask)])]
+
+## The last sample that has been read of each pv, kept in a JSON file so
+# that follow_transitions() only gives the transitions that are new each
+# time it is run. The value of the sample gives the state of every mask.
+class FollowState:
+    ## \param filename JSON file to keep the state in. It is made by save()
+    # if it doesn't exist
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            f = open(filename)
+        except IOError:
+            last = {}
+        else:
+            last = json.load(f)
+            f.close()
+        ## Dict of pvname -> (secs, nano, value) of the last sample read
+        self.last = dict([(pvname, tuple(v)) for pvname, v in last.items()])
+
+    ## Write the state to the file
+    def save(self):
+        tmp = "%s.%d" % (self.filename, os.getpid())
+        f = open(tmp, "w")
+        json.dump(self.last, f, indent=1, sort_keys=True)
+        f.close()
+        os.rename(tmp, self.filename)
+
+## Find the transitions of some queries since the last call with the same
+# state. The samples of all the pvs are fetched concurrently, from the last
+# sample read of each pv, so each call only fetches what is new. A query of a
+# pv that isn't in the state yet, or was last read before the query starts,
+# starts at the start time of the query, and gives its first sample as well
+# \param queries List of (pvname, masks, start, end). The end is capped at
+# now
+# \param state FollowState, which is updated with the samples read but not
+# saved
+# \return List of records as given by iter_transitions(), in time order
+def follow_transitions(archiver, queries, state):
+    now = time.time()
+    spans = []
+    for pvname, masks, start, end in queries:
+        # another query of the pv may have read it up to before this starts
+        resume = pvname in state.last and state.last[pvname][0] >= start
+        if resume:
+            start = state.last[pvname][0]
+        spans.append((start, min(end, now), resume))
+    samples = archiver.fetch_many([(query[0], t1, t2)
+        for query, (t1, t2, resume) in zip(queries, spans) if t1 < t2])
+    records = []
+    last = {}
+    for (pvname, masks, start, end), (t1, t2, resume) in zip(queries, spans):
+        if t1 >= t2:
+            continue
+        new = select(samples[pvname], t1, t2)
+        previous = None
+        if resume:
+            secs, nano, value = state.last[pvname]
+            new = new[:, (new[0] > secs) | ((new[0] == secs) &
+                (new[1] > nano))]
+            previous = mask_states(numpy.array([value]), masks)[0]
+        for n, secs, name, value, sevr in mask_transitions(new, masks,
+                previous):
+            records.append((secs, int(new[1, n - 1]), pvname, name, value,
+                sevr, n))
+        if new.shape[1]:
+            last[pvname] = max(last.get(pvname, ()),
+                tuple([int(x) for x in new[[0, 1, 2], -1]]))
+    # update the state when all the queries have used it
+    state.last.update(last)
+    records.sort()
+    return records
+
+# Write the transitions of some queries since the last run with a
+# FollowState, then save it, and then poll again every interval seconds if
+# it isn't None
+def _follow(archiver, queries, state, writer, interval):
+    while True:
+        try:
+            for record in follow_transitions(archiver, queries, state):
+                writer.write(record)
+        except (Error, socket.error), e:
+            sys.stderr.write("***Error: %s\n" % e)
+            if interval is None:
+                sys.exit(1)
+        else:
+            # only save what has been written
+            writer.close()
+            state.save()
+        if interval is None:
+            return
+        time.sleep(interval)
+
+## Read queries from a file with a pvname, mask, start and end time on each
+# line. Blank lines and lines starting with # are ignored
+def read_queries(filename):
+    out = []
+    for line in open(filename):
+        line = line.strip()
+        if line and not line.startswith("#"):
+            out.append(line.split())
+    return out
+
+## numpy dtype of the records written by the binary output formats
+record_dtype = numpy.dtype([("secs", "<i8"), ("nano", "<i4"), ("pv", "S64"),
+    ("mask", "S32"), ("value", "?"), ("severity", "<i2"), ("count", "<i8")])
+
+## Writes transitions in the original text format, a line of count, time,
+# value and severity, prefixed by pvname and mask name if there are several
+class TextWriter:
+    binary = False
+
+    ## \param prefix Put the pvname and mask name before each line
+    # \param window Write the results of TransitionIndex.window_join() with
+    # write_window() instead of transitions with write()
+    def __init__(self, f, prefix=True, window=False):
+        self.f = f
+        self.prefix = prefix
+
+    ## Write a record given by iter_transitions()
+    def write(self, record):
+        secs, nano, pvname, name, value, sevr, count = record
+        if self.prefix:
+            self.f.write("%s %s " % (pvname, name))
+        self.f.write("%d %s %s %s\n" % (count, time.ctime(secs), value, sevr))
+
+    ## Write a trigger record and the (offset, record) pairs of the other
+    # transitions near it, indented below it
+    # \param n Number of the trigger, starting at 1
+    def write_window(self, n, trigger, related):
+        self.write(trigger)
+        for offset, record in related:
+            self.f.write("    %+.3f " % offset)
+            self.write(record)
+
+    ## Write anything that is buffered
+    def close(self):
+        self.f.flush()
+
+## Writes transitions as CSV with a header line
+class CsvWriter(TextWriter):
+    columns = ["secs", "nano", "pv", "mask", "value", "severity", "count"]
+
+    def __init__(self, f, prefix=True, window=False):
+        self.f = f
+        self.writer = csv.writer(f)
+        self.writer.writerow(self.columns + (window and ["trigger", "offset"]
+            or []))
+
+    def write(self, record, extra=[]):
+        secs, nano, pvname, name, value, sevr, count = record
+        self.writer.writerow([secs, nano, pvname, name, int(value), sevr,
+            count] + extra)
+
+    ## Write each record with the number of its trigger and its offset in
+    # seconds from it, which is 0 for the trigger itself
+    def write_window(self, n, trigger, related):
+        self.write(trigger, [n, 0.0])
+        for offset, record in related:
+            self.write(record, [n, round(offset, 6)])
+
+## Writes transitions as JSON Lines, one object per transition
+class JsonWriter(CsvWriter):
+    def __init__(self, f, prefix=True, window=False):
+        self.f = f
+
+    def write(self, record, extra=[]):
+        self.f.write(json.dumps(dict(zip(CsvWriter.columns, record) +
+            zip(["trigger", "offset"], extra)), sort_keys=True) + "\n")
+
+## Writes transitions as a .npy file of record_dtype. The header is written
+# with room for any length, then rewritten with the real one on close, so
+# the records can be streamed to the file in blocks
+class NpyWriter:
+    binary = True
+    header_size = 256
+
+    ## \param block Number of records to buffer before writing them
+    def __init__(self, f, prefix=True, window=False, block=10000):
+        self.f = f
+        self.block = block
+        self.records = []
+        self.count = 0
+        self.__header()
+
+    def __header(self):
+        header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (
+            numpy.lib.format.dtype_to_descr(record_dtype), self.count)
+        header = header.ljust(self.header_size - 11) + "\n"
+        self.f.seek(0)
+        self.f.write("\x93NUMPY\x01\x00" +
+            struct.pack("<H", len(header)) + header)
+
+    def write(self, record):
+        self.records.append(tuple(record))
+        if len(self.records) >= self.block:
+            self.flush()
+
+    ## Write the buffered records to the file
+    def flush(self):
+        if self.records:
+            self.f.write(numpy.array(self.records, record_dtype).tostring())
+            self.count += len(self.records)
+            self.records = []
+
+    def close(self):
+        self.flush()
+        self.__header()
+        self.f.close()
+
+## Writes transitions to a resizable "transitions" dataset of record_dtype
+# in a HDF5 file, using h5py
+class Hdf5Writer(NpyWriter):
+    def __init__(self, f, prefix=True, window=False, block=10000):
+        if h5py is None:
+            raise ValueError("h5py is needed for hdf5 output")
+        self.f = h5py.File(f.name, "w")
+        f.close()
+        self.block = block
+        self.records = []
+        self.dataset = self.f.create_dataset("transitions", (0,),
+            record_dtype, maxshape=(None,), chunks=(block,))
+
+    def flush(self):
+        if self.records:
+            n = len(self.dataset)
+            self.dataset.resize((n + len(self.records),))
+            self.dataset[n:] = numpy.array(self.records, record_dtype)
+            self.records = []
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+## Output formats and the classes that write them
+writers = {"text": TextWriter, "csv": CsvWriter, "jsonl": JsonWriter,
+    "npy": NpyWriter, "hdf5": Hdf5Writer}
+
+def main():
+    parser = OptionParser(usage)
+    parser.format_epilog = lambda formatter: _masks_help()
+    parser.add_option("-u", "--url", default=Archiver_URL,
+        help="URL of the archiver data server")
+    parser.add_option("-k", "--key", type="int", default=Archiver_key,
+        help="Archive key, default %default for all archives")
+    parser.add_option("-p", "--page", type="int", default=page_size,
+        help="Samples to request in each call, default %default")
+    parser.add_option("-c", "--chunk", type="float", metavar="HOURS",
+        default=chunk_secs / 3600.0, help="Split time ranges into chunks of "
+        "this many hours that are fetched concurrently, default %default")
+    parser.add_option("-j", "--connections", type="int",
+        default=connections, help="Number of concurrent connections, "
+        "default %default")
+    parser.add_option("-f", "--file", action="append", default=[],
+        help="Read queries from FILE, one per line")
+    parser.add_option("-C", "--cache", default=os.environ.get(
+        "READ_ARCHIVER_CACHE", os.path.expanduser("~/.read_archiver_cache")),
+        help="Directory to cache samples in, defaults to "
+        "$READ_ARCHIVER_CACHE or ~/.read_archiver_cache")
+    parser.add_option("-n", "--no-cache", action="store_true", default=False,
+        help="Fetch everything from the archiver, don't use the cache")
+    parser.add_option("-r", "--retries", type="int", default=retries,
+        help="Number of times to retry a failed call, default %default")
+    parser.add_option("-F", "--format", type="choice",
+        choices=sorted(writers), default="text", help="Output format, one of "
+        "%s, default %%default" % ", ".join(sorted(writers)))
+    parser.add_option("-o", "--output", help="Write the transitions to OUTPUT "
+        "instead of stdout")
+    parser.add_option("-w", "--window", type="float", metavar="SECONDS",
+        help="Give the transitions within this many seconds of each onset of "
+        "a trigger mask")
+    parser.add_option("-t", "--trigger", action="append", default=[],
+        help="Mask name to trigger --window on, can be given more than once, "
+        "default following_error")
+    parser.add_option("--follow", metavar="STATE", help="Only give the "
+        "transitions since the last run with the same STATE file, which "
+        "keeps the last sample read of each pv. End times are capped at now")
+    parser.add_option("--interval", type="float", metavar="SECONDS",
+        help="With --follow, keep polling for new samples every SECONDS")
+    options, args = parser.parse_args()
+    if len(args) % 4:
+        parser.error("Incorrect number of arguments")
+    if options.chunk <= 0:
+        parser.error("Chunk length must be positive")
+    if options.page < 2:
+        parser.error("Pages must be at least 2 samples")
+    queries = [args[i:i + 4] for i in range(0, len(args), 4)]
+    for filename in options.file:
+        queries += read_queries(filename)
+    if not queries:
+        parser.error("No queries given")
+    try:
+        # follow_transitions() caps the end at the time of each poll
+        now = options.follow and float("inf") or None
+        queries = [(pvname, parse_masks(masks, pvname), parse_time(start),
+            parse_time(end, now)) for pvname, masks, start, end in queries]
+    except ValueError, e:
+        parser.error(str(e))
+    writer = writers[options.format]
+    if writer.binary and not options.output:
+        parser.error("%s output needs a file, use -o" % options.format)
+    if writer is Hdf5Writer and h5py is None:
+        parser.error("hdf5 output needs h5py")
+    if options.window is not None and writer.binary:
+        parser.error("--window can't give %s output" % options.format)
+    if options.follow and (writer.binary or options.window is not None):
+        parser.error("--follow can't be used with --window or %s output" %
+            options.format)
+    if options.interval is not None and not options.follow:
+        parser.error("--interval needs --follow")
+    cache = None
+    if not options.no_cache:
+        cache = Cache(options.cache, options.url, options.key)
+    archiver = Archiver(options.url, options.key, options.page,
+        int(options.chunk * 3600), options.connections, cache,
+        options.retries)
+    if options.output:
+        f = open(options.output, writer.binary and "wb" or "w")
+    else:
+        f = sys.stdout
+    window = options.window is not None
+    writer = writer(f, window or len(queries) > 1 or len(queries[0][1]) > 1,
+        window=window)
+    if options.follow:
+        try:
+            state = FollowState(options.follow)
+        except ValueError, e:
+            parser.error("Can't read %s: %s" % (options.follow, e))
+        _follow(archiver, queries, state, writer, options.interval)
+        archiver.close()
+        return
+    # stream the transitions of all the queries in time order
+    found = set()
+    try:
+        records = merge(*[iter_transitions(archiver, pvname, masks,
+            start, end) for pvname, masks, start, end in queries])
+        if window:
+            records = list(records)
+            found.update([r[2] for r in records])
+            index = TransitionIndex(records)
+            for n, (trigger, related) in enumerate(index.window_join(
+                    index.onsets(options.trigger or ["following_error"]),
+                    options.window)):
+                writer.write_window(n + 1, trigger, related)
+        else:
+            for record in records:
+                found.add(record[2])
+                writer.write(record)
+    except (Error, socket.error), e:
+        sys.stderr.write("***Error: %s\n" % e)
         sys.exit(1)
+    writer.close()
+    archiver.close()
+    # the text format gives this in the output, as it always has
+    if options.format != "text":
+        f = sys.stderr
+    for pvname, masks, start, end in queries:
+        if pvname not in found:
+            f.write("%sno data available\n" % (len(queries) > 1 and
+                pvname + " " or ""))
 
-    (pvname, check_value_str, start_str, end_str ) = sys.argv[1:5]
-    main(pvname, check_value_str, start_str, end_str )
+if __name__ == "__main__":
+    main()